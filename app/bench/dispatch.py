@@ -0,0 +1,140 @@
+"""
+Per-message cost of the client request dispatch.
+Compares the action table of MessageProcessor with the former elif chain.
+Database and sockets are replaced by stubs, so only the dispatch and the handler bodies are measured.
+
+Run from the app directory: python -m bench.dispatch [number [repeat]]
+"""
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+from common.variables import *
+from server.connection import Connection
+from server.core import MessageProcessor
+
+
+class StubDatabase:
+    """Database which answers at once"""
+
+    def process_message(self, sender, recipient):
+        pass
+
+    def get_contacts(self, username):
+        return []
+
+    def add_contact(self, user, contact):
+        pass
+
+    def remove_contact(self, user, contact):
+        pass
+
+    def users_list(self):
+        return []
+
+    def get_pubkey(self, username):
+        return 'key'
+
+
+class BenchProcessor(MessageProcessor):
+    """Server without network and DB thread: DB calls are made at once, responses are dropped"""
+
+    def try_send_msg_or_close(self, client, response):
+        pass
+
+    def process_message(self, message):
+        pass
+
+    def remove_client(self, client):
+        pass
+
+    def storage_call(self, client, callback, func, *args):
+        callback(func(*args))
+
+    def storage_submit(self, func, *args):
+        func(*args)
+
+
+def legacy_process_client_message(self, message, client):
+    """The elif chain process_client_message was before the action table"""
+    if ACTION in message and message[ACTION] == PRESENCE and TIME in message and USER in message:
+        response = RESPONSE_400
+        response[ERROR] = 'Already authorised'
+        self.try_send_msg_or_close(client, response)
+    elif ACTION in message and message[ACTION] == MESSAGE and \
+            DESTINATION in message and TIME in message and \
+            SENDER in message and MESSAGE_TEXT in message and \
+            self.names[message[SENDER]] == client:
+        if self.is_online(message[DESTINATION]):
+            self.database.process_message(message[SENDER], message[DESTINATION])
+            self.process_message(message)
+            self.try_send_msg_or_close(client, RESPONSE_200)
+        else:
+            response = RESPONSE_400
+            response[ERROR] = 'User did not registered on server'
+            self.try_send_msg_or_close(client, response)
+    elif ACTION in message and message[ACTION] == EXIT and ACCOUNT_NAME in message and \
+            self.names[message[ACCOUNT_NAME]] == client:
+        self.remove_client(client)
+    elif ACTION in message and message[ACTION] == GET_CONTACTS and USER in message and \
+            self.names[message[USER]] == client:
+        response = RESPONSE_202
+        response[LIST_INFO] = self.database.get_contacts(message[USER])
+        self.try_send_msg_or_close(client, response)
+    elif ACTION in message and message[ACTION] == ADD_CONTACT and ACCOUNT_NAME in message and USER in message \
+            and self.names[message[USER]] == client:
+        self.database.add_contact(message[USER], message[ACCOUNT_NAME])
+        self.try_send_msg_or_close(client, RESPONSE_200)
+    elif ACTION in message and message[ACTION] == REMOVE_CONTACT and ACCOUNT_NAME in message and USER in message \
+            and self.names[message[USER]] == client:
+        self.database.remove_contact(message[USER], message[ACCOUNT_NAME])
+        self.try_send_msg_or_close(client, RESPONSE_200)
+    elif ACTION in message and message[ACTION] == USERS_REQUEST and ACCOUNT_NAME in message \
+            and self.names[message[ACCOUNT_NAME]] == client:
+        response = RESPONSE_202
+        response[LIST_INFO] = [user[0] for user in self.database.users_list()]
+        self.try_send_msg_or_close(client, response)
+    elif ACTION in message and message[ACTION] == PUBLIC_KEY_REQUEST and ACCOUNT_NAME in message:
+        response = RESPONSE_511
+        response[DATA] = self.database.get_pubkey(message[ACCOUNT_NAME])
+        self.try_send_msg_or_close(client, response)
+    else:
+        response = RESPONSE_400
+        response[ERROR] = 'Bad request'
+        self.try_send_msg_or_close(client, response)
+
+
+def requests():
+    """One request of every kind, the order of the elif chain"""
+    return {
+        MESSAGE: {ACTION: MESSAGE, SENDER: 'alice', DESTINATION: 'bob', TIME: 1, MESSAGE_TEXT: 'Hi'},
+        GET_CONTACTS: {ACTION: GET_CONTACTS, TIME: 1, USER: 'alice'},
+        ADD_CONTACT: {ACTION: ADD_CONTACT, TIME: 1, USER: 'alice', ACCOUNT_NAME: 'bob'},
+        USERS_REQUEST: {ACTION: USERS_REQUEST, TIME: 1, ACCOUNT_NAME: 'alice'},
+        PUBLIC_KEY_REQUEST: {ACTION: PUBLIC_KEY_REQUEST, TIME: 1, ACCOUNT_NAME: 'bob'},
+        'bad request': {ACTION: 'unknown', TIME: 1},
+    }
+
+
+def best(func, number, repeat):
+    """Best time of one call, ns"""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e9
+
+
+def main(number=100000, repeat=7):
+    server = BenchProcessor('127.0.0.1', DEFAULT_SERVER_PORT, StubDatabase())
+    client = object()
+    server.connections[client] = Connection(client, ('127.0.0.1', 0), None)
+    server.names['alice'] = client
+    server.names['bob'] = object()
+
+    print(f'{"request":<16}{"elif chain, ns":>16}{"action table, ns":>18}')
+    for name, message in requests().items():
+        legacy = best(lambda: legacy_process_client_message(server, message, client), number, repeat)
+        table = best(lambda: server.process_client_message(message, client), number, repeat)
+        print(f'{name:<16}{legacy:>16.0f}{table:>18.0f}')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,339 @@
+"""
+Load test of the server: N synthetic users log in with the real PRESENCE/challenge handshake
+and send messages in one of the patterns:
+  one_to_one - every user writes to the next one
+  hot - all users write to one user
+  churn - every message is sent between adding the recipient to the contacts and removing it
+The result is printed as JSON: logins/s, messages/s and delivery latency quantiles.
+
+Run from the app directory: python -m bench.load --users 200 --messages 20000 --pattern hot
+By default the server is started in a child process with a temporary DB.
+A running server (python run_server.py --no_gui) is loaded with --connect and the path of its DB file:
+python -m bench.load --connect 127.0.0.1:7777 --database server_database.db3
+The users are added to that DB before the test (it clears the active users list of the DB,
+so the server must not have real users then).
+"""
+import argparse
+import asyncio
+import binascii
+import contextlib
+import hashlib
+import hmac
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+from common.errors import ServerError
+from common.utils import encode_message, FrameDecoder
+from common.variables import *
+from logs.queue_logging import set_level
+from run_server import SERVER_ENGINES
+from server.cluster import ServerCluster
+from server.core import raise_open_files_limit
+from server.metrics import Histogram
+from server.server_database import ServerStorage
+
+PATTERNS = ('one_to_one', 'hot', 'churn')
+# Names of the synthetic users are the prefix and the number
+USER_PREFIX = 'load'
+# Public key the synthetic users send at login, the server does not check it
+PUBLIC_KEY_STUB = 'load test key'
+# Logins which are in progress at once
+LOGIN_CONCURRENCY = 100
+# Contacts each user of the churn pattern writes to
+CHURN_CONTACTS = 10
+# How long the messages are waited for after the last one is sent, seconds
+DELIVERY_TIMEOUT = 10
+# How long the started server is waited for, seconds
+SERVER_START_TIMEOUT = 10
+
+
+def password_hash(username):
+    """Synthetic users have cheap password hashes, the handshake is the same as with the real ones"""
+    return binascii.hexlify(hashlib.sha512(username.encode(ENCODING)).digest())
+
+
+def register_users(database_path, count):
+    """Add the users which are not in the DB yet, returns their names"""
+    database = ServerStorage(database_path)
+    usernames = [f'{USER_PREFIX}{index}' for index in range(count)]
+    for username in usernames:
+        if not database.check_user(username):
+            database.add_user(username, password_hash(username))
+    database.close_session()
+    database.engine.dispose()
+    return usernames
+
+
+def serve(address, port, database_path, engine, log_level):
+    """Server process: the engine run_server.py starts with --no_gui"""
+    set_level(log_level, ('server_log',))
+    server = SERVER_ENGINES[engine](address, port, ServerStorage(database_path))
+
+    def stop(signum, frame):
+        server.running = False
+
+    signal.signal(signal.SIGTERM, stop)
+    server.run()
+
+
+def wait_for_server(address, port):
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while True:
+        try:
+            socket.create_connection((address, port)).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+class LoadStats:
+    """Results of the test, shared by all the clients"""
+
+    def __init__(self):
+        self.sent = 0
+        self.delivered = 0
+        self.errors = 0
+        self.last_delivery = None
+        # Delivery time of the messages, microseconds
+        self.latency = Histogram()
+        self.all_delivered = asyncio.Event()
+
+    def message_delivered(self, message):
+        now = time.perf_counter_ns()
+        self.latency.record((now - int(message[MESSAGE_TEXT])) // 1000)
+        self.delivered += 1
+        self.last_delivery = now
+        if self.delivered >= self.sent:
+            self.all_delivered.set()
+
+
+class LoadClient:
+    """Synthetic user on an asyncio connection, the requests carry ids and are answered by futures"""
+
+    def __init__(self, username, stats):
+        self.username = username
+        self.stats = stats
+        self.reader = None
+        self.writer = None
+        self.decoder = FrameDecoder()
+        self.request_ids = itertools.count(1)
+        # Requests waiting for the reply: id -> future
+        self.replies = dict()
+        self.receiver = None
+
+    async def read_message(self):
+        message = self.decoder.next_message()
+        while message is None:
+            data = await self.reader.read(RECV_BUFFER_SIZE)
+            if not data:
+                raise ConnectionResetError('Connection closed by server')
+            self.decoder.feed(data)
+            message = self.decoder.next_message()
+        return message
+
+    async def login(self, address, port):
+        self.reader, self.writer = await asyncio.open_connection(address, port)
+        self.writer.write(encode_message({
+            ACTION: PRESENCE,
+            TIME: time.time(),
+            USER: {ACCOUNT_NAME: self.username, PUBLIC_KEY: PUBLIC_KEY_STUB}
+        }))
+        answer = await self.read_message()
+        if answer.get(RESPONSE) != 511:
+            raise ServerError(answer.get(ERROR))
+        digest = hmac.new(password_hash(self.username), answer[DATA].encode(ENCODING), 'MD5').digest()
+        self.writer.write(encode_message({RESPONSE: 511, DATA: binascii.b2a_base64(digest).decode('ascii')}))
+        answer = await self.read_message()
+        if answer.get(RESPONSE) != 200:
+            raise ServerError(answer.get(ERROR))
+        self.receiver = asyncio.create_task(self.receive())
+
+    async def receive(self):
+        while True:
+            message = await self.read_message()
+            if message.get(ACTION) == MESSAGE:
+                self.stats.message_delivered(message)
+                continue
+            future = self.replies.pop(message.get(REQUEST_ID), None)
+            if future is not None:
+                future.set_result(message)
+
+    async def request(self, message):
+        message[REQUEST_ID] = request_id = next(self.request_ids)
+        future = self.replies[request_id] = asyncio.get_running_loop().create_future()
+        self.writer.write(encode_message(message))
+        await self.writer.drain()
+        answer = await future
+        if answer.get(RESPONSE) not in (200, 202):
+            self.stats.errors += 1
+        return answer
+
+    async def send_messages(self, recipients, count, churn):
+        for number in range(count):
+            recipient = recipients[number % len(recipients)]
+            if churn:
+                await self.request({ACTION: ADD_CONTACT, TIME: time.time(), USER: self.username,
+                                    ACCOUNT_NAME: recipient})
+            self.stats.sent += 1
+            await self.request({ACTION: MESSAGE, TIME: time.time(), SENDER: self.username, DESTINATION: recipient,
+                                MESSAGE_TEXT: str(time.perf_counter_ns())})
+            if churn:
+                await self.request({ACTION: REMOVE_CONTACT, TIME: time.time(), USER: self.username,
+                                    ACCOUNT_NAME: recipient})
+
+    def close(self):
+        if self.receiver is not None:
+            self.receiver.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+
+def recipients_of(index, usernames, pattern):
+    """Users the user number index writes to"""
+    count = len(usernames)
+    if pattern == 'one_to_one':
+        return [usernames[(index + 1) % count]]
+    if pattern == 'hot':
+        return [usernames[1] if index == 0 else usernames[0]]
+    others = usernames[:index] + usernames[index + 1:]
+    return random.sample(others, min(CHURN_CONTACTS, len(others)))
+
+
+async def run_load(address, port, usernames, pattern, messages, window):
+    stats = LoadStats()
+    clients = [LoadClient(username, stats) for username in usernames]
+    semaphore = asyncio.Semaphore(LOGIN_CONCURRENCY)
+
+    async def login(client):
+        async with semaphore:
+            await client.login(address, port)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(login(client) for client in clients))
+    login_time = time.perf_counter() - start
+
+    # Every user sends its share of the messages by window coroutines, each waits for the reply before the next one
+    senders = []
+    for index, client in enumerate(clients):
+        recipients = recipients_of(index, usernames, pattern)
+        for part in range(window):
+            count = messages // (len(clients) * window) + (index * window + part < messages % (len(clients) * window))
+            if count:
+                senders.append(client.send_messages(recipients, count, pattern == 'churn'))
+
+    start = time.perf_counter_ns()
+    await asyncio.gather(*senders)
+    if stats.delivered < stats.sent:
+        # The event could be set while the senders were still sending, it counts only from now
+        stats.all_delivered.clear()
+        try:
+            await asyncio.wait_for(stats.all_delivered.wait(), DELIVERY_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+    send_time = ((stats.last_delivery or time.perf_counter_ns()) - start) / 1e9
+
+    for client in clients:
+        client.close()
+
+    return {
+        'logins': len(clients),
+        'logins_per_second': round(len(clients) / login_time, 1),
+        'messages': stats.sent,
+        'delivered': stats.delivered,
+        'errors': stats.errors,
+        'messages_per_second': round(stats.delivered / send_time, 1) if send_time > 0 else 0,
+        'latency_ms': {
+            'p50': stats.latency.quantile(0.5) / 1000,
+            'p99': stats.latency.quantile(0.99) / 1000,
+            'p999': stats.latency.quantile(0.999) / 1000,
+            'max': stats.latency.quantile(1) / 1000,
+        },
+    }
+
+
+def get_params():
+    parser = argparse.ArgumentParser(description='Server load test')
+    parser.add_argument('--users', default=100, type=int)
+    parser.add_argument('--messages', default=10000, type=int, help='messages sent by all the users together')
+    parser.add_argument('--pattern', default='one_to_one', choices=PATTERNS)
+    parser.add_argument('--window', default=1, type=int, help='messages of one user waiting for the reply at once')
+    parser.add_argument('--engine', default='selectors', choices=SERVER_ENGINES.keys())
+    parser.add_argument('--workers', default=1, type=int, help='processes of the started server, they use selectors')
+    parser.add_argument('--log-level', default='WARNING', help='log level of the started server')
+    parser.add_argument('--port', default=DEFAULT_SERVER_PORT, type=int, help='port of the started server')
+    parser.add_argument('--connect', default=None, help='address:port of the running server instead of starting one')
+    parser.add_argument('--database', default=None, help='DB file of the server')
+    parser.add_argument('--output', default=None, help='file for the JSON report, stdout by default')
+    params = parser.parse_args(sys.argv[1:])
+    if params.users < 2:
+        parser.error('at least 2 users are needed')
+    if params.workers > 1 and params.engine != 'selectors':
+        parser.error('--workers needs the selectors engine')
+    if params.connect and not params.database:
+        parser.error('--connect needs --database of the running server')
+    return params
+
+
+def main():
+    params = get_params()
+    raise_open_files_limit()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        database_path = params.database or os.path.join(temp_dir, 'load.db3')
+        usernames = register_users(database_path, params.users)
+
+        process = cluster = None
+        # The started server prints to the stdout, the report is printed there too
+        devnull = open(os.devnull, 'w')
+        if params.connect:
+            address, port = params.connect.rsplit(':', 1)
+            port = int(port)
+        else:
+            address, port = '127.0.0.1', params.port
+            with contextlib.redirect_stdout(devnull):
+                if params.workers > 1:
+                    set_level(params.log_level, ('server_log',))
+                    cluster = ServerCluster(params.workers, address, port, database_path)
+                    cluster.start()
+                else:
+                    process = multiprocessing.get_context('fork').Process(
+                        target=serve, args=(address, port, database_path, params.engine, params.log_level))
+                    process.start()
+        try:
+            wait_for_server(address, port)
+            result = asyncio.run(run_load(address, port, usernames, params.pattern, params.messages, params.window))
+        finally:
+            if process is not None:
+                process.terminate()
+                process.join()
+            if cluster is not None:
+                cluster.stop()
+            devnull.close()
+
+    report = {
+        'pattern': params.pattern,
+        'users': params.users,
+        'window': params.window,
+        'server': params.connect or {'engine': params.engine, 'workers': params.workers},
+        **result,
+    }
+    text = json.dumps(report, indent=2)
+    if params.output:
+        with open(params.output, 'w', encoding=ENCODING) as file:
+            file.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+"""
+Microbenchmarks of the hot paths: message codec, request dispatch and the storage methods.
+Results can be saved as the baseline, the next runs are compared with it: a benchmark is a regression
+when it is slower by more than REGRESSION_THRESHOLD and the Mann-Whitney test says it is not noise.
+The exit code is 1 if there are regressions.
+A fixed reference loop is measured before every benchmark and the times are corrected by the median of
+its times over the run, so a machine which is busier or slower than during the baseline run does not give
+false regressions.
+
+Run from the app directory:
+python -m bench.micro --save                    measure and save the baseline
+python -m bench.micro                           measure and compare with the baseline
+python -m bench.micro --filter codec --sizes 1000,100000
+"""
+import argparse
+import datetime
+import json
+import math
+import os
+import platform
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+from common.utils import encode_message, decode_message, send_json_message, get_message, FrameDecoder
+from common.variables import *
+from server.connection import Connection
+from bench.dispatch import BenchProcessor, StubDatabase, requests
+from bench.storage import server_storage_benchmarks, client_database_benchmarks
+
+# Where the baseline is kept by default
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+# Minimal duration of one sample, the number of calls in a sample is chosen to reach it, seconds
+SAMPLE_TIME = 0.05
+# Samples of one benchmark: wanted number, minimal number and time limit after which no more are taken
+SAMPLES = 20
+MIN_SAMPLES = 5
+BENCHMARK_TIME = 10
+# Samples of the reference loop taken before every benchmark
+REFERENCE_SAMPLES = 3
+# Slowdown which is not reported even if it is significant
+REGRESSION_THRESHOLD = 0.1
+# Significance level of the Mann-Whitney test
+ALPHA = 0.01
+# Sizes of the tables for the storage benchmarks
+STORAGE_SIZES = (1000, 100000, 1000000)
+
+
+class MockSocket:
+    """Socket of tests/test_utils.py: sent data is kept, recv returns the same frame every time"""
+
+    def __init__(self, message):
+        self.frame = encode_message(message)
+        self.sent = None
+
+    def sendall(self, data):
+        self.sent = data
+
+    def recv(self, max_len):
+        return self.frame
+
+
+class DispatchProcessor(BenchProcessor):
+    """Dispatch benchmark server: the replies are encoded and written to the mock socket of the client"""
+
+    def try_send_msg_or_close(self, client, response):
+        client.sendall(encode_message(response))
+
+
+def chat_message():
+    return {ACTION: MESSAGE, SENDER: 'alice', DESTINATION: 'bob', TIME: time.time(), MESSAGE_TEXT: 'Hello! ' * 15}
+
+
+def codec_benchmarks():
+    message = chat_message()
+    frame = encode_message(message)
+    sock = MockSocket(message)
+    decoder = FrameDecoder()
+    batch = frame * 100
+    batch_decoder = FrameDecoder()
+
+    def decode_batch():
+        batch_decoder.feed(batch)
+        for _ in batch_decoder.messages():
+            pass
+
+    yield 'codec.encode_message', lambda: encode_message(message)
+    yield 'codec.decode_message', lambda: decode_message(frame[4:])
+    yield 'codec.send_json_message', lambda: send_json_message(sock, message)
+    yield 'codec.get_message', lambda: get_message(sock, decoder)
+    yield 'codec.decode_100_frames', decode_batch
+
+
+def dispatch_benchmarks():
+    server = DispatchProcessor('127.0.0.1', DEFAULT_SERVER_PORT, StubDatabase())
+    client = MockSocket(RESPONSE_200)
+    server.connections[client] = Connection(client, ('127.0.0.1', 0), None)
+    server.names['alice'] = client
+    server.names['bob'] = MockSocket(RESPONSE_200)
+    for name, message in requests().items():
+        def dispatch(message=message):
+            server.process_client_message(message, client)
+
+        yield f'dispatch.{name.replace(" ", "_")}', dispatch
+
+
+def reference_loop():
+    """Fixed pure Python work, its time shows the current speed of the machine"""
+    total = 0
+    for number in range(1000):
+        total += number * number
+    return total
+
+
+def measure(func, samples=SAMPLES):
+    """Time of one call in ns for every sample and the time of the reference loop"""
+    reference = median(sample(reference_loop, REFERENCE_SAMPLES)['samples'])
+    result = sample(func, samples)
+    result['reference'] = reference
+    return result
+
+
+def sample(func, samples):
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= SAMPLE_TIME:
+            break
+        number *= 10 if elapsed < SAMPLE_TIME / 10 else 2
+    results = [elapsed / number * 1e9]
+    deadline = time.perf_counter() + BENCHMARK_TIME
+    while len(results) < samples and (len(results) < MIN_SAMPLES or time.perf_counter() < deadline):
+        results.append(timer.timeit(number) / number * 1e9)
+    return {'number': number, 'samples': results}
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+
+def mann_whitney(before, after):
+    """
+    One-sided p-value of the Mann-Whitney U test for the hypothesis that the values after are bigger.
+    The normal approximation with the ties correction is used.
+    """
+    n1, n2 = len(before), len(after)
+    values = sorted([(value, 0) for value in before] + [(value, 1) for value in after])
+    count = n1 + n2
+    rank_after = 0
+    ties = 0
+    start = 0
+    while start < count:
+        end = start
+        while end + 1 < count and values[end + 1][0] == values[start][0]:
+            end += 1
+        size = end - start + 1
+        rank = (start + end) / 2 + 1
+        rank_after += rank * sum(group for value, group in values[start:end + 1])
+        ties += size ** 3 - size
+        start = end + 1
+    u = rank_after - n2 * (n2 + 1) / 2
+    variance = n1 * n2 / 12 * ((count + 1) - ties / (count * (count - 1)))
+    if variance <= 0:
+        return 0.5
+    z = (u - n1 * n2 / 2 - 0.5) / math.sqrt(variance)
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def compare(baseline, results, threshold=REGRESSION_THRESHOLD):
+    """Rows (name, baseline median, median, change, status) and the number of regressions"""
+    rows = []
+    regressions = 0
+    common = [name for name in results if name in baseline]
+    if common:
+        # Times on the machine as fast as it was during the baseline run
+        speed = median([baseline[name]['reference'] for name in common]) / \
+            median([results[name]['reference'] for name in common])
+    for name, result in results.items():
+        current = median(result['samples'])
+        if name not in baseline:
+            rows.append((name, None, current, None, 'new'))
+            continue
+        before = baseline[name]['samples']
+        after = [value * speed for value in result['samples']]
+        change = median(after) / median(before) - 1
+        status = ''
+        if change > threshold and mann_whitney(before, after) < ALPHA:
+            status = 'REGRESSION'
+            regressions += 1
+        elif change < -threshold and mann_whitney(after, before) < ALPHA:
+            status = 'faster'
+        rows.append((name, median(before), current, change, status))
+    return rows, regressions
+
+
+def format_time(ns):
+    if ns is None:
+        return '-'
+    for unit, scale in (('s', 1e9), ('ms', 1e6), ('us', 1e3)):
+        if ns >= scale:
+            return f'{ns / scale:.2f} {unit}'
+    return f'{ns:.0f} ns'
+
+
+def get_params():
+    parser = argparse.ArgumentParser(description='Microbenchmarks of the hot paths')
+    parser.add_argument('--filter', default='', help='run the benchmarks with this text in the name')
+    parser.add_argument('--sizes', default=','.join(map(str, STORAGE_SIZES)), help='rows in the storage tables')
+    parser.add_argument('--samples', default=SAMPLES, type=int)
+    parser.add_argument('--threshold', default=REGRESSION_THRESHOLD, type=float,
+                        help='slowdown which is reported, 0.1 is 10%%')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save', action='store_true', help='save the results as the baseline')
+    return parser.parse_args(sys.argv[1:])
+
+
+def main():
+    params = get_params()
+    sizes = [int(size) for size in params.sizes.split(',') if size]
+    baseline = {}
+    if not params.save and os.path.exists(params.baseline):
+        with open(params.baseline, encoding=ENCODING) as file:
+            baseline = json.load(file)['results']
+
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        def selected(name):
+            return params.filter in name
+
+        suites = (codec_benchmarks(), dispatch_benchmarks(),
+                  server_storage_benchmarks(temp_dir, sizes, selected),
+                  client_database_benchmarks(temp_dir, sizes, selected))
+        for suite in suites:
+            for name, func in suite:
+                if not selected(name):
+                    continue
+                results[name] = measure(func, params.samples)
+                print(f'{name:<48}{format_time(median(results[name]["samples"])):>12}')
+
+    if params.save:
+        with open(params.baseline, 'w', encoding=ENCODING) as file:
+            json.dump({
+                'created': datetime.datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'machine': platform.platform(),
+                'results': results,
+            }, file, indent=1)
+        print(f'Baseline is saved to {params.baseline}')
+        return 0
+    if not baseline:
+        return 0
+
+    rows, regressions = compare(baseline, results, params.threshold)
+    print(f'\n{"benchmark":<48}{"baseline":>12}{"now":>12}{"change":>9}')
+    for name, before, current, change, status in rows:
+        change = f'{change:+.1%}' if change is not None else ''
+        print(f'{name:<48}{format_time(before):>12}{format_time(current):>12}{change:>9}  {status}')
+    if regressions:
+        print(f'{regressions} regressions: ' + ', '.join(row[0] for row in rows if row[4] == 'REGRESSION'))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,181 @@
+"""
+Benchmarks of the ServerStorage and ClientDatabase methods on tables of the given sizes.
+The tables are filled by executemany of the SQLite connection, the ORM would take minutes for 1M rows.
+Methods which change the data are measured in pairs which return the tables to the same state
+(add and remove a contact, login and logout).
+"""
+import datetime
+import os
+import sqlite3
+import sys
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+from common.variables import *
+from client.client_database import ClientDatabase, key_fingerprint
+from server.server_database import ServerStorage
+
+# Message history of the client is shared between this number of peers
+HISTORY_PEERS = 100
+# Users asked by one bulk public keys request
+KEYS_REQUEST_SIZE = 100
+
+
+def user_name(index):
+    return f'user{index}'
+
+
+def fill_server_storage(path, size):
+    """ServerStorage with size users, contacts, login records and the last changes of the lists"""
+    ServerStorage(path).engine.dispose()
+    now = str(datetime.datetime.now())
+    connection = sqlite3.connect(path)
+    with connection:
+        connection.executemany(
+            'INSERT INTO user (id, username, last_login, password_hash, pub_key) VALUES (?, ?, ?, ?, ?)',
+            ((index + 1, user_name(index), now, 'hash', f'key{index}') for index in range(size)))
+        connection.executemany(
+            'INSERT INTO user_history (id, user, sent, accepted) VALUES (?, ?, 0, 0)',
+            ((index + 1, index + 1) for index in range(size)))
+        connection.executemany(
+            'INSERT INTO users_contacts (id, user, contact) VALUES (?, ?, ?)',
+            ((index + 1, index + 1, (index + 1) % size + 1) for index in range(size)))
+        connection.executemany(
+            'INSERT INTO login_history (id, user, ip, port, last_login) VALUES (?, ?, ?, ?, ?)',
+            ((index + 1, index + 1, '127.0.0.1', DEFAULT_SERVER_PORT, now) for index in range(size)))
+        connection.executemany(
+            'INSERT INTO change_log (id, owner, name, added) VALUES (?, NULL, ?, 1)',
+            ((index + 1, user_name(index)) for index in range(max(0, size - CHANGE_LOG_SIZE), size)))
+    connection.close()
+    return ServerStorage(path)
+
+
+def server_storage_benchmarks(temp_dir, sizes, selected):
+    """Yields (name, function), the tables are filled only for the sizes with selected benchmarks"""
+    for size in sizes:
+        database = None
+        user = user_name(size // 2)
+        contact = user_name((size // 2 + 2) % size)
+        names = [user_name(index) for index in range(0, size, max(1, size // KEYS_REQUEST_SIZE))]
+
+        def get_user_uncached():
+            database.invalidate_user(user)
+            database.get_user(user)
+
+        def login_logout():
+            database.user_login(user, '127.0.0.1', DEFAULT_SERVER_PORT, f'key{size // 2}')
+            database.user_logout(user)
+
+        def add_remove_contact():
+            database.add_contact(user, contact)
+            database.remove_contact(user, contact)
+
+        def flush_counters():
+            database.process_message(user, contact)
+            database.flush_counters()
+
+        benchmarks = {
+            'get_user': lambda: database.get_user(user),
+            'get_user_uncached': get_user_uncached,
+            'check_user': lambda: database.check_user(user),
+            'get_hash': lambda: database.get_hash(user),
+            'get_pubkey': lambda: database.get_pubkey(user),
+            'get_pubkeys': lambda: database.get_pubkeys(names),
+            'user_login_logout': login_logout,
+            'add_remove_contact': add_remove_contact,
+            'process_message': lambda: database.process_message(user, contact),
+            'flush_counters': flush_counters,
+            'get_contacts': lambda: database.get_contacts(user),
+            'get_changes': lambda: database.get_changes(user, database.version - 10),
+            'get_changes_full': lambda: database.get_changes(user, 0),
+            'users_list': lambda: database.users_list(),
+            'search_users': lambda: database.search_users(user[:-1]),
+            'active_users_list': lambda: database.active_users_list(),
+            'login_history': lambda: database.login_history(user),
+            'message_history': lambda: database.message_history(),
+        }
+        full_names = {name: f'server_storage.{name}[{size}]' for name in benchmarks}
+        if not any(selected(name) for name in full_names.values()):
+            continue
+        path = os.path.join(temp_dir, f'server_{size}.db3')
+        database = fill_server_storage(path, size)
+        try:
+            for name, func in benchmarks.items():
+                yield full_names[name], func
+        finally:
+            database.close_session()
+            database.engine.dispose()
+            os.remove(path)
+
+
+def fill_client_database(name, size):
+    """ClientDatabase (in the current directory) with size known users, contacts, messages and keys"""
+    ClientDatabase(name).database_engine.dispose()
+    now = str(datetime.datetime.now())
+    connection = sqlite3.connect(f'client_{name}.db3')
+    with connection:
+        connection.executemany('INSERT INTO known_users (id, username) VALUES (?, ?)',
+                               ((index + 1, user_name(index)) for index in range(size)))
+        connection.executemany('INSERT INTO contacts (id, name) VALUES (?, ?)',
+                               ((index + 1, user_name(index)) for index in range(size)))
+        connection.executemany(
+            'INSERT INTO message_history (id, from_user, to_user, message, date) VALUES (?, ?, ?, ?, ?)',
+            ((index + 1, user_name(index % HISTORY_PEERS), 'me', f'Message {index}', now) for index in range(size)))
+        connection.executemany('INSERT INTO public_keys (fingerprint, username, "key") VALUES (?, ?, ?)',
+                               ((key_fingerprint(f'key{index}'), user_name(index), f'key{index}')
+                                for index in range(size)))
+        connection.execute('INSERT INTO lists_version (id, version) VALUES (1, ?)', (size,))
+    connection.close()
+    return ClientDatabase(name)
+
+
+def client_database_benchmarks(temp_dir, sizes, selected):
+    """Yields (name, function), the tables are filled only for the sizes with selected benchmarks"""
+    # ClientDatabase keeps its file in the current directory
+    cwd = os.getcwd()
+    os.chdir(temp_dir)
+    try:
+        for size in sizes:
+            database = users = None
+            user = user_name(size // 2)
+
+            def add_del_contact():
+                database.add_contact('new_contact')
+                database.del_contact('new_contact')
+
+            def apply_changes():
+                for added, removed in ((['new_user'], []), ([], ['new_user'])):
+                    database.apply_changes({
+                        VERSION: size,
+                        FULL: False,
+                        USERS: {ADDED: added, REMOVED: removed},
+                        CONTACTS: {ADDED: added, REMOVED: []},
+                    })
+
+            benchmarks = {
+                'add_del_contact': add_del_contact,
+                'check_user': lambda: database.check_user(user),
+                'check_contact': lambda: database.check_contact(user),
+                'get_contacts': lambda: database.get_contacts(),
+                'get_users': lambda: database.get_users(),
+                'get_history': lambda: database.get_history(user_name(1)),
+                'save_message': lambda: database.save_message(user, 'me', 'Hello'),
+                'get_key': lambda: database.get_key(user),
+                'save_keys': lambda: database.save_keys({user: f'key{size // 2}'}),
+                'get_version': lambda: database.get_version(),
+                'apply_changes': apply_changes,
+                'add_users': lambda: database.add_users(users),
+            }
+            full_names = {name: f'client_database.{name}[{size}]' for name in benchmarks}
+            if not any(selected(name) for name in full_names.values()):
+                continue
+            database = fill_client_database(f'bench_{size}', size)
+            users = database.get_users()
+            try:
+                for name, func in benchmarks.items():
+                    yield full_names[name], func
+            finally:
+                database.session.close()
+                database.database_engine.dispose()
+                os.remove(f'client_bench_{size}.db3')
+    finally:
+        os.chdir(cwd)
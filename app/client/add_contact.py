@@ -1,40 +1,51 @@
 import os
 import sys
 
-from PyQt5.QtWidgets import QDialog, QLabel, QComboBox, QPushButton, QApplication
-from PyQt5.QtCore import Qt
+from PyQt5.QtWidgets import QDialog, QLabel, QComboBox, QLineEdit, QPushButton, QApplication
+from PyQt5.QtCore import Qt, QTimer
 from PyQt5.QtGui import QStandardItemModel, QStandardItem
 
 import logging
 sys.path.append(os.path.join(os.getcwd(), '../../'))
 from logs import client_log_config
+from common.variables import SEARCH_DELAY
 
 client_log = logging.getLogger('client_log')
 
 
 class AddContactDialog(QDialog):
+    """Search of the users on the server as the name is typed, results are loaded page by page"""
+
     def __init__(self, transport, database):
         super().__init__()
         self.transport = transport
         self.database = database
+        # Cursor of the next results page, None if all results are loaded
+        self.cursor = None
+        # Id of the search request whose reply is awaited, replies of the older ones are ignored
+        self.search_id = None
 
-        self.setFixedSize(350, 120)
+        self.setFixedSize(350, 150)
         self.setWindowTitle('Pick contact for adding:')
 
         self.setAttribute(Qt.WA_DeleteOnClose)
         self.setModal(True)
 
-        self.selector_label = QLabel('Pick contact for adding:', self)
+        self.selector_label = QLabel('Type the name and pick contact:', self)
         self.selector_label.setFixedSize(200, 20)
         self.selector_label.move(10, 0)
 
+        self.search = QLineEdit(self)
+        self.search.setFixedSize(200, 20)
+        self.search.move(10, 30)
+
         self.selector = QComboBox(self)
         self.selector.setFixedSize(200, 20)
-        self.selector.move(10, 30)
+        self.selector.move(10, 60)
 
-        self.btn_refresh = QPushButton('Update list', self)
+        self.btn_refresh = QPushButton('More results', self)
         self.btn_refresh.setFixedSize(100, 30)
-        self.btn_refresh.move(60, 60)
+        self.btn_refresh.move(60, 90)
 
         self.btn_ok = QPushButton('Add', self)
         self.btn_ok.setFixedSize(100, 30)
@@ -45,24 +56,47 @@ class AddContactDialog(QDialog):
         self.btn_cancel.move(230, 60)
         self.btn_cancel.clicked.connect(self.close)
 
+        # Search starts when the user stops typing for a moment
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(SEARCH_DELAY)
+        self.search_timer.timeout.connect(self.possible_contacts_update)
+        self.search.textChanged.connect(self.search_timer.start)
+        # The reply comes in the receiver thread, the list is filled in the GUI thread
+        self.transport.users_found.connect(self.users_found)
+
         self.possible_contacts_update()
         self.btn_refresh.clicked.connect(self.update_possible_contacts)
 
     def possible_contacts_update(self):
+        """Search from the first page"""
         self.selector.clear()
-        contacts_list = set(self.database.get_contacts())
-        users_list = set(self.database.get_users())
-        users_list.remove(self.transport.username)
-        self.selector.addItems(users_list - contacts_list)
+        self.cursor = None
+        self.load_page()
 
     def update_possible_contacts(self):
+        """Load the next page of the results"""
+        if self.cursor is not None:
+            self.load_page()
+
+    def load_page(self):
+        """Request the page, the GUI does not wait for the reply"""
+        self.btn_refresh.setEnabled(False)
         try:
-            self.transport.user_list_update()
+            self.search_id = self.transport.search_users(self.search.text(), self.cursor)
         except OSError:
-            pass
-        else:
-            client_log.debug('User list updated from server')
-            self.possible_contacts_update()
+            self.search_id = None
+
+    def users_found(self, request_id, users, cursor):
+        if request_id != self.search_id:
+            return
+        self.search_id = None
+        self.cursor = cursor
+        contacts_list = set(self.database.get_contacts())
+        contacts_list.add(self.transport.username)
+        self.selector.addItems([user for user in users if user not in contacts_list])
+        self.btn_refresh.setEnabled(self.cursor is not None)
+        client_log.debug(f'Found {len(users)} users')
 
 
 if __name__ == '__main__':
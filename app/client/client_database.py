@@ -1,12 +1,18 @@
 from sqlalchemy import create_engine, Table, Column, Integer, String, Text, MetaData, DateTime
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import mapper, sessionmaker
+from sqlalchemy.orm import mapper, sessionmaker, scoped_session
 from common.variables import *
 import datetime
+import hashlib
 
 Base = create_engine
 
 
+def key_fingerprint(key):
+    """SHA-256 of the public key text"""
+    return hashlib.sha256(key.encode('ascii')).hexdigest()
+
+
 class ClientDatabase:
     Base = declarative_base()
 
@@ -43,6 +49,29 @@ class ClientDatabase:
         def __init__(self, contact):
             self.name = contact
 
+    class ListsVersion(Base):
+        """Version of the users and contacts lists received from the server"""
+        __tablename__ = 'lists_version'
+
+        id = Column(Integer, primary_key=True)
+        version = Column(Integer)
+
+        def __init__(self, version):
+            self.version = version
+
+    class PublicKeys(Base):
+        """Cached public keys of the other users"""
+        __tablename__ = 'public_keys'
+
+        fingerprint = Column(String, primary_key=True)
+        username = Column(String, unique=True)
+        key = Column(Text)
+
+        def __init__(self, username, key):
+            self.fingerprint = key_fingerprint(key)
+            self.username = username
+            self.key = key
+
     def __init__(self, name):
         self.database_engine = create_engine(f'sqlite:///client_{name}.db3',
                                              echo=False,
@@ -50,11 +79,12 @@ class ClientDatabase:
                                              connect_args={'check_same_thread': False})
 
         self.Base.metadata.create_all(self.database_engine)
-        Session = sessionmaker(bind=self.database_engine)
-        self.session = Session()
+        # GUI, receiver and crypto threads work with DB, each of them gets its own session
+        self.session = scoped_session(sessionmaker(bind=self.database_engine))
 
-        self.session.query(self.Contacts).delete()
-        self.session.commit()
+    def close_session(self):
+        """Release the session of the current thread, called by threads which stop working with DB"""
+        self.session.remove()
 
     def add_contact(self, contact):
         if not self.session.query(self.Contacts).filter_by(name=contact).count():
@@ -73,6 +103,68 @@ class ClientDatabase:
             self.session.add(user_row)
         self.session.commit()
 
+    def get_version(self):
+        """Version of the lists, 0 if they were never received"""
+        row = self.session.query(self.ListsVersion).first()
+        return row.version if row else 0
+
+    def apply_changes(self, changes):
+        """Apply the lists changes (or full lists) received from the server"""
+        if changes[FULL]:
+            self.session.query(self.KnownUsers).delete()
+            self.session.query(self.Contacts).delete()
+        removed_users = changes[USERS][REMOVED]
+        if removed_users:
+            self.session.query(self.KnownUsers).filter(self.KnownUsers.username.in_(removed_users)).\
+                delete(synchronize_session=False)
+            self.session.query(self.Contacts).filter(self.Contacts.name.in_(removed_users)).\
+                delete(synchronize_session=False)
+            self.session.query(self.PublicKeys).filter(self.PublicKeys.username.in_(removed_users)).\
+                delete(synchronize_session=False)
+        removed_contacts = changes[CONTACTS][REMOVED]
+        if removed_contacts:
+            self.session.query(self.Contacts).filter(self.Contacts.name.in_(removed_contacts)).\
+                delete(synchronize_session=False)
+        added_users = changes[USERS][ADDED]
+        if added_users:
+            known_users = {row[0] for row in self.session.query(self.KnownUsers.username).
+                           filter(self.KnownUsers.username.in_(added_users))}
+            self.session.add_all([self.KnownUsers(user) for user in dict.fromkeys(added_users)
+                                  if user not in known_users])
+        added_contacts = changes[CONTACTS][ADDED]
+        if added_contacts:
+            contacts = {row[0] for row in self.session.query(self.Contacts.name).
+                        filter(self.Contacts.name.in_(added_contacts))}
+            self.session.add_all([self.Contacts(contact) for contact in dict.fromkeys(added_contacts)
+                                  if contact not in contacts])
+
+        row = self.session.query(self.ListsVersion).first()
+        if row:
+            row.version = changes[VERSION]
+        else:
+            self.session.add(self.ListsVersion(changes[VERSION]))
+        self.session.commit()
+
+    def get_key(self, username):
+        """Cached public key of the user as (fingerprint, key) or None"""
+        row = self.session.query(self.PublicKeys.fingerprint, self.PublicKeys.key).filter_by(username=username).first()
+        return tuple(row) if row else None
+
+    def save_keys(self, keys):
+        """Replace the cached keys of the users, keys is a dict username -> key"""
+        if not keys:
+            return
+        self.session.query(self.PublicKeys).filter(self.PublicKeys.username.in_(list(keys))).\
+            delete(synchronize_session=False)
+        # The same key of two users is kept for one of them only
+        fingerprints = {}
+        for username, key in keys.items():
+            fingerprints[key_fingerprint(key)] = username
+        self.session.query(self.PublicKeys).filter(self.PublicKeys.fingerprint.in_(list(fingerprints))).\
+            delete(synchronize_session=False)
+        self.session.add_all([self.PublicKeys(username, keys[username]) for username in fingerprints.values()])
+        self.session.commit()
+
     def save_message(self, from_user, to_user, message):
         message_row = self.MessageHistory(from_user, to_user, message)
         self.session.add(message_row)
@@ -0,0 +1,104 @@
+"""
+End-to-end encryption of the message text.
+The text is encrypted by AES-GCM with the session key of the peer, the session key is encrypted (wrapped)
+by the RSA key of the peer once and is sent with every message, so the receiver unwraps it once too.
+Session keys are replaced after SESSION_KEY_MESSAGES messages, SESSION_KEY_LIFETIME seconds
+or when the peer gets a new RSA key.
+"""
+import binascii
+import os
+import sys
+import time
+from collections import OrderedDict
+
+from Crypto.Cipher import AES, PKCS1_OAEP
+from Crypto.PublicKey import RSA
+from Crypto.Random import get_random_bytes
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+from common.variables import *
+
+# AES-GCM nonce and tag sizes, bytes
+NONCE_SIZE = 12
+TAG_SIZE = 16
+
+
+class SessionKey:
+    """Outgoing session key of one peer"""
+    __slots__ = ('key', 'key_id', 'wrapped', 'fingerprint', 'created', 'messages')
+
+    def __init__(self, key, wrapped, fingerprint):
+        self.key = key
+        self.key_id = binascii.hexlify(get_random_bytes(8)).decode('ascii')
+        # Session key encrypted by the RSA key of the peer, base64
+        self.wrapped = wrapped
+        # Fingerprint of the RSA key the session key is wrapped with
+        self.fingerprint = fingerprint
+        self.created = time.monotonic()
+        self.messages = 0
+
+    def expired(self):
+        return self.messages >= SESSION_KEY_MESSAGES or time.monotonic() - self.created > SESSION_KEY_LIFETIME
+
+
+class MessageCipher:
+    """
+    Encrypts the messages to the peers and decrypts the messages from them.
+    encrypt and decrypt are called by different threads, they do not share data.
+    """
+
+    def __init__(self, keys):
+        # Own private key unwraps the session keys of the incoming messages
+        self.decrypter = PKCS1_OAEP.new(keys)
+        # Parsed RSA keys of the peers: fingerprint -> cipher
+        self.wrappers = {}
+        # Outgoing session keys: peer -> SessionKey
+        self.outgoing = {}
+        # Unwrapped incoming session keys: (peer, key id) -> key, the oldest are dropped
+        self.incoming = OrderedDict()
+
+    @staticmethod
+    def associated_data(sender, recipient, key_id):
+        """Authenticated but not encrypted part: the message can't be moved to another dialog"""
+        return f'{sender}:{recipient}:{key_id}'.encode('utf-8')
+
+    def session_key(self, peer, peer_key):
+        """Current session key of the peer, a new one is made if needed"""
+        fingerprint, pem = peer_key
+        session = self.outgoing.get(peer)
+        if session is None or session.fingerprint != fingerprint or session.expired():
+            wrapper = self.wrappers.get(fingerprint)
+            if wrapper is None:
+                wrapper = self.wrappers[fingerprint] = PKCS1_OAEP.new(RSA.import_key(pem))
+            key = get_random_bytes(SESSION_KEY_SIZE)
+            wrapped = binascii.b2a_base64(wrapper.encrypt(key), newline=False).decode('ascii')
+            session = self.outgoing[peer] = SessionKey(key, wrapped, fingerprint)
+        return session
+
+    def encrypt(self, sender, recipient, peer_key, text):
+        """Encrypted text fields of the message to the recipient, peer_key is (fingerprint, key)"""
+        session = self.session_key(recipient, peer_key)
+        session.messages += 1
+        cipher = AES.new(session.key, AES.MODE_GCM, nonce=get_random_bytes(NONCE_SIZE))
+        cipher.update(self.associated_data(sender, recipient, session.key_id))
+        data, tag = cipher.encrypt_and_digest(text.encode(ENCODING))
+        return {
+            MESSAGE_TEXT: binascii.b2a_base64(cipher.nonce + data + tag, newline=False).decode('ascii'),
+            SESSION_KEY: session.wrapped,
+            KEY_ID: session.key_id
+        }
+
+    def decrypt(self, message):
+        """Text of the received message, ValueError if it can't be decrypted"""
+        sender, recipient, key_id = message[SENDER], message[DESTINATION], message[KEY_ID]
+        key = self.incoming.get((sender, key_id))
+        if key is None:
+            key = self.decrypter.decrypt(binascii.a2b_base64(message[SESSION_KEY]))
+            self.incoming[(sender, key_id)] = key
+            if len(self.incoming) > SESSION_KEYS_CACHE:
+                self.incoming.popitem(last=False)
+        payload = binascii.a2b_base64(message[MESSAGE_TEXT])
+        nonce, data, tag = payload[:NONCE_SIZE], payload[NONCE_SIZE:-TAG_SIZE], payload[-TAG_SIZE:]
+        cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+        cipher.update(self.associated_data(sender, recipient, key_id))
+        return cipher.decrypt_and_verify(data, tag).decode(ENCODING)
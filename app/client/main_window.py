@@ -1,7 +1,5 @@
 import os
 
-from Crypto.Cipher import PKCS1_OAEP
-from Crypto.PublicKey import RSA
 from PyQt5.QtWidgets import QMainWindow, qApp, QMessageBox, QApplication
 from PyQt5.QtGui import QStandardItemModel, QStandardItem, QBrush, QColor
 from PyQt5.QtCore import pyqtSlot, Qt
@@ -28,8 +26,6 @@ class ClientMainWindow(QMainWindow):
         self.database = database
         self.transport = transport
 
-        self.decrypter = PKCS1_OAEP.new(keys)
-
         self.ui = Ui_MainClientWindow()
         self.ui.setupUi(self)
 
@@ -53,7 +49,6 @@ class ClientMainWindow(QMainWindow):
         self.messages = QMessageBox()
         self.current_chat = None
         self.current_chat_key = None
-        self.encryptor = None
         self.ui.list_messages.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
         self.ui.list_messages.setWordWrap(True)
 
@@ -74,7 +69,6 @@ class ClientMainWindow(QMainWindow):
         self.ui.btn_send.setDisabled(True)
         self.ui.text_message.setDisabled(True)
 
-        self.encryptor = None
         self.current_chat = None
         self.current_chat_key = None
 
@@ -114,15 +108,9 @@ class ClientMainWindow(QMainWindow):
 
     def set_active_user(self):
         try:
-            self.current_chat_key = self.transport.key_request(
-                self.current_chat)
-            client_log.debug(f'Received public key for {self.current_chat}')
-            if self.current_chat_key:
-                self.encryptor = PKCS1_OAEP.new(
-                    RSA.import_key(self.current_chat_key))
+            self.set_chat_key(self.transport.get_key(self.current_chat))
         except (OSError, json.JSONDecodeError):
-            self.current_chat_key = None
-            self.encryptor = None
+            self.set_chat_key(None)
             client_log.debug(f'Cannot get key for {self.current_chat}')
 
         if not self.current_chat_key:
@@ -137,6 +125,10 @@ class ClientMainWindow(QMainWindow):
 
         self.history_list_update()
 
+    def set_chat_key(self, key):
+        """Key (fingerprint, key) of the current chat, messages are encrypted by the transport"""
+        self.current_chat_key = key[1] if key else None
+
     def clients_list_update(self):
         contacts_list = self.database.get_contacts()
         self.contacts_model = QStandardItemModel()
@@ -164,9 +156,10 @@ class ClientMainWindow(QMainWindow):
             self.messages.critical(self, 'Server error', err.text)
         except OSError as err:
             if err.errno:
-                self.messages.critical(self, 'Error', 'Connection lost')
-                self.close()
-            self.messages.critical(self, 'Error', 'Connection timeout')
+                # Transport reconnects, the window is closed if it cannot
+                self.messages.critical(self, 'Error', 'Connection lost, reconnecting. Try again later.')
+            else:
+                self.messages.critical(self, 'Error', 'Connection timeout')
         else:
             self.database.add_contact(new_contact)
             new_contact = QStandardItem(new_contact)
@@ -189,9 +182,10 @@ class ClientMainWindow(QMainWindow):
             self.messages.critical(self, 'Server error', err.text)
         except OSError as err:
             if err.errno:
-                self.messages.critical(self, 'Error', 'Connection lost')
-                self.close()
-            self.messages.critical(self, 'Error', 'Connection timeout')
+                # Transport reconnects, the window is closed if it cannot
+                self.messages.critical(self, 'Error', 'Connection lost, reconnecting. Try again later.')
+            else:
+                self.messages.critical(self, 'Error', 'Connection timeout')
         else:
             self.database.del_contact(selected)
             self.clients_list_update()
@@ -208,22 +202,28 @@ class ClientMainWindow(QMainWindow):
         self.ui.text_message.clear()
         if not message_text:
             return
-        try:
-            self.transport.send_message(self.current_chat, message_text)
-        except ServerError as err:
+        # The answer of the server comes by message_sent or send_failed signal
+        self.transport.send_message(self.current_chat, message_text)
+
+    @pyqtSlot(str, str)
+    def message_sent(self, to, text):
+        self.database.save_message(to, 'out', text)
+        client_log.debug(f'Sent message to {to}: {text}')
+        if to == self.current_chat:
+            self.history_list_update()
+
+    @pyqtSlot(str, object)
+    def send_failed(self, to, err):
+        if isinstance(err, ServerError):
             self.messages.critical(self, 'Error', err.text)
-        except OSError as err:
-            if err.errno:
-                self.messages.critical(self, 'Error', 'Connection lost!')
-                self.close()
+        elif isinstance(err, OSError) and err.errno:
+            # Transport reconnects, the window is closed if it cannot
+            self.messages.critical(self, 'Error', 'Connection lost, reconnecting. Try again later.')
+        elif isinstance(err, OSError):
             self.messages.critical(self, 'Error', 'Connection timeout!')
-        except (ConnectionResetError, ConnectionAbortedError):
-            self.messages.critical(self, 'Error', 'Connection lost!')
-            self.close()
         else:
-            self.database.save_message(self.current_chat, 'out', message_text)
-            client_log.debug(f'Sent message to {self.current_chat}: {message_text}')
-            self.history_list_update()
+            client_log.error(f'Cannot send message to {to}: {err}')
+            self.messages.critical(self, 'Error', f'Cannot send message to {to}')
 
     @pyqtSlot(str)
     def message(self, sender):
@@ -265,10 +265,18 @@ class ClientMainWindow(QMainWindow):
             self.current_chat = None
         self.clients_list_update()
 
+    @pyqtSlot(str)
+    def key_changed(self, username):
+        if username == self.current_chat:
+            self.set_chat_key(self.database.get_key(username))
+
     def make_connection(self, trans_obj):
         trans_obj.new_message.connect(self.message)
+        trans_obj.key_changed.connect(self.key_changed)
         trans_obj.connection_lost.connect(self.connection_lost)
         trans_obj.message_205.connect(self.sig_205)
+        trans_obj.message_sent.connect(self.message_sent)
+        trans_obj.send_failed.connect(self.send_failed)
 
 
 if __name__ == '__main__':
@@ -1,30 +1,47 @@
+import errno
 import hashlib
 import hmac
+import itertools
 import json
 import os
+import queue
+import random
 import sys
 import threading
 import socket
 import time
 
 import binascii
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from PyQt5.QtCore import QObject, pyqtSignal
 
-from common.utils import send_json_message, get_message
+from common.utils import send_json_message, get_message, encode_message, FrameDecoder
 from common.variables import *
 from common.errors import ServerError
+from client.crypto import MessageCipher
 
 import logging
 sys.path.append(os.path.join(os.getcwd(), '..'))
 
 client_log = logging.getLogger('client_log')
-socket_lock = threading.Lock()
+
+
+def backoff_delay(attempt):
+    """Pause before the connection attempt: exponential backoff with full jitter"""
+    return random.uniform(0, min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** attempt))
 
 
 class ClientTransport(threading.Thread, QObject):
     new_message = pyqtSignal(str)
     connection_lost = pyqtSignal()
     message_205 = pyqtSignal()
+    key_changed = pyqtSignal(str)
+    # Recipient and text of the message the server accepted
+    message_sent = pyqtSignal(str, str)
+    # Recipient and the error (ServerError or OSError) of the message which was not sent
+    send_failed = pyqtSignal(str, object)
+    # Request id of the users search, the names found and the cursor of the next page
+    users_found = pyqtSignal(int, object, object)
     
     def __init__(self, ip_address, port, database, username, password, keys):
         threading.Thread.__init__(self)
@@ -36,89 +53,178 @@ class ClientTransport(threading.Thread, QObject):
         self.keys = keys
         # Socket to work with server
         self.transport = None
+        # Receive buffer of the socket
+        self.decoder = None
+        # Server address, used to reconnect
+        self.address = (ip_address, port)
+        # Password hash is calculated once, resumption token is received at login
+        self.password_hash = None
+        self.token = None
+        # Requests waiting for the reply: request id -> Future of the reply
+        self.requests = {}
+        self.requests_lock = threading.Lock()
+        self.request_ids = itertools.count(1)
+        # Frames to send, the writer thread of the connection takes them one by one, None stops it
+        self.outgoing = None
+        self.writer = None
+        # False when the connection is lost or closed
+        self.connected = False
+        self.running = False
+        # Interrupts the pause between reconnection attempts
+        self.stop_event = threading.Event()
+        # End-to-end encryption of the messages, outgoing ones are encrypted in the crypto thread
+        self.cipher = MessageCipher(keys)
+        self.crypto = ThreadPoolExecutor(max_workers=1, thread_name_prefix='client_crypto')
 
         self.connection_init(ip_address, port)
+        self.connected = True
+        self.start_writer()
 
         try:
-            self.user_list_update()
-            self.contacts_list_update()
+            self.lists_sync()
+            self.keys_update()
         except OSError as err:
             if err.errno:
                 client_log.critical('Connection lost')
+                self.outgoing.put(None)
                 raise ServerError('Connection with server lost')
             client_log.error('Timeout of connection during user list update')
         except json.JSONDecodeError as err:
             client_log.critical('Connection lost')
+            self.outgoing.put(None)
             raise ServerError('Connection with server lost')
         self.running = True
 
     def connection_init(self, ip, port):
-        self.transport = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.transport.settimeout(5)
-
-        # Try to connect 5 times at least
-        connected = False
-        for i in range(5):
-            client_log.info(f'Connection attempt №{i + 1}')
+        for attempt in range(CONNECT_ATTEMPTS):
+            if attempt:
+                time.sleep(backoff_delay(attempt - 1))
+            client_log.info(f'Connection attempt №{attempt + 1}')
             try:
-                self.transport.connect((ip, port))
-            except (OSError, ConnectionRefusedError):
-                pass
-            else:
-                connected = True
-                break
-            time.sleep(1)
-
-        if not connected:
+                self.connect(ip, port)
+            except OSError:
+                continue
+            break
+        else:
             client_log.critical('Cannot connect to the server')
             raise ServerError('Cannot connect to the server')
 
-        client_log.debug('Starting auth dialog.')
+        self.authorize()
+        client_log.info('Connected to the server')
 
-        password_bytes = self.password.encode('utf-8')
-        salt = self.username.lower().encode('utf-8')
-        password_hash = hashlib.pbkdf2_hmac('sha512', password_bytes, salt, 10000)
-        password_hash_string = binascii.hexlify(password_hash)
+    def connect(self, ip, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(5)
+        try:
+            sock.connect((ip, port))
+        except OSError:
+            sock.close()
+            raise
+        self.transport = sock
+        self.decoder = FrameDecoder()
+
+    def authorize(self):
+        """Resume the session by the token if there is one, otherwise log in with the password"""
+        try:
+            if self.token and self.resume_session():
+                return
+            self.login()
+        except (OSError, json.JSONDecodeError) as err:
+            client_log.debug(f'Connection error.', exc_info=err)
+            raise ServerError('Authorization failed')
 
-        client_log.debug(f'Passwd hash ready: {password_hash_string}')
+    def resume_session(self):
+        """Login by the token in one round trip, returns False if the server does not accept the token"""
+        message = {
+            ACTION: RESUME,
+            TIME: time.time(),
+            USER: {
+                ACCOUNT_NAME: self.username
+            },
+            TOKEN: self.token
+        }
+        send_json_message(self.transport, message)
+        ans = get_message(self.transport, self.decoder)
+        if ans.get(RESPONSE) == 200:
+            self.token = ans.get(TOKEN)
+            client_log.info('Session is resumed')
+            return True
+        client_log.info(f'Session is not resumed: {ans.get(ERROR)}')
+        self.token = None
+        return False
+
+    def login(self):
+        client_log.debug('Starting auth dialog.')
+
+        if self.password_hash is None:
+            password_bytes = self.password.encode('utf-8')
+            salt = self.username.lower().encode('utf-8')
+            password_hash = hashlib.pbkdf2_hmac('sha512', password_bytes, salt, 10000)
+            self.password_hash = binascii.hexlify(password_hash)
+            client_log.debug(f'Passwd hash ready: {self.password_hash}')
 
         # Got pub_key and decode it from bytes
         pubkey = self.keys.publickey().export_key().decode('ascii')
 
         # Authorising on server
-        with socket_lock:
-            presense = {
-                ACTION: PRESENCE,
-                TIME: time.time(),
-                USER: {
-                    ACCOUNT_NAME: self.username,
-                    PUBLIC_KEY: pubkey
-                }
+        presense = {
+            ACTION: PRESENCE,
+            TIME: time.time(),
+            USER: {
+                ACCOUNT_NAME: self.username,
+                PUBLIC_KEY: pubkey
             }
-            client_log.debug(f"Presense message = {presense}")
-
+        }
+        client_log.debug(f"Presense message = {presense}")
+
+        send_json_message(self.transport, presense)
+        ans = get_message(self.transport, self.decoder)
+        client_log.debug(f'Server response = {ans}.')
+
+        if RESPONSE in ans:
+            if ans[RESPONSE] == 400:
+                raise ServerError(ans[ERROR])
+            elif ans[RESPONSE] == 511:
+                ans_data = ans[DATA]
+                hash = hmac.new(self.password_hash, ans_data.encode('utf-8'), 'MD5')
+                digest = hash.digest()
+                my_ans = RESPONSE_511
+                my_ans[DATA] = binascii.b2a_base64(
+                    digest).decode('ascii')
+                send_json_message(self.transport, my_ans)
+                ans = get_message(self.transport, self.decoder)
+                self.process_server_ans(ans)
+                self.token = ans.get(TOKEN)
+
+    def reconnect(self):
+        """
+        Connect again after the connection is lost, with random growing pauses,
+        so the clients of a restarted server do not come all at once. The session is resumed by the token.
+        """
+        self.transport.close()
+        for attempt in range(RECONNECT_ATTEMPTS):
+            if self.stop_event.wait(backoff_delay(attempt)):
+                return False
+            client_log.info(f'Reconnection attempt №{attempt + 1}')
             try:
-                send_json_message(self.transport, presense)
-                ans = get_message(self.transport)
-                client_log.debug(f'Server response = {ans}.')
-
-                if RESPONSE in ans:
-                    if ans[RESPONSE] == 400:
-                        raise ServerError(ans[ERROR])
-                    elif ans[RESPONSE] == 511:
-                        ans_data = ans[DATA]
-                        hash = hmac.new(password_hash_string, ans_data.encode('utf-8'), 'MD5')
-                        digest = hash.digest()
-                        my_ans = RESPONSE_511
-                        my_ans[DATA] = binascii.b2a_base64(
-                            digest).decode('ascii')
-                        send_json_message(self.transport, my_ans)
-                        self.process_server_ans(get_message(self.transport))
-            except (OSError, json.JSONDecodeError) as err:
-                client_log.debug(f'Connection error.', exc_info=err)
-                raise ServerError('Authorization failed')
-
-        client_log.info('Connected to the server')
+                self.connect(*self.address)
+            except OSError:
+                continue
+            try:
+                self.authorize()
+            except ServerError as err:
+                client_log.info(f'Reconnection failed: {err}')
+                self.transport.close()
+                continue
+            with self.requests_lock:
+                self.connected = True
+            self.start_writer()
+            client_log.info('Connection is restored')
+            # Changes which were missed while the client was offline
+            self.lists_request().add_done_callback(self.lists_synced)
+            self.keys_refresh()
+            return True
+        return False
 
     def create_presence(self):
         message = {
@@ -131,6 +237,84 @@ class ClientTransport(threading.Thread, QObject):
         client_log.debug(f'Presence {PRESENCE} created for client {self.username}')
         return message
 
+    def request(self, message):
+        """Send the request, returns the Future of the server reply. Many requests can wait for the replies at once."""
+        future = Future()
+        with self.requests_lock:
+            request_id = future.request_id = next(self.request_ids)
+            self.requests[request_id] = future
+        message[REQUEST_ID] = request_id
+        if not self.connected:
+            with self.requests_lock:
+                self.requests.pop(request_id, None)
+            raise ConnectionResetError(errno.ECONNRESET, 'Connection lost')
+        self.outgoing.put(encode_message(message))
+        return future
+
+    def wait(self, future):
+        """Wait for the reply. Before the receiver thread is started the reply is read here."""
+        if not self.is_alive():
+            while not future.done():
+                self.receive(get_message(self.transport, self.decoder))
+        try:
+            return future.result(REPLY_TIMEOUT)
+        except FutureTimeoutError:
+            with self.requests_lock:
+                self.requests.pop(future.request_id, None)
+            raise TimeoutError('Server does not answer')
+
+    def start_writer(self):
+        """Writer thread of the current connection"""
+        self.outgoing = queue.Queue()
+        self.writer = threading.Thread(target=self.write_loop, args=(self.outgoing, self.transport), daemon=True)
+        self.writer.start()
+
+    def write_loop(self, outgoing, sock):
+        """Writer thread: sends the queued frames, so the senders never wait for the socket"""
+        while True:
+            data = outgoing.get()
+            if data is None:
+                return
+            try:
+                sock.sendall(data)
+            except OSError as err:
+                self.connection_failed(err, sock)
+                return
+
+    def connection_failed(self, err, sock):
+        """Called by the reader or the writer when the socket fails, the reader reconnects then"""
+        with self.requests_lock:
+            if not self.connected or sock is not self.transport:
+                return
+            self.connected = False
+        if self.running:
+            client_log.warning(f'Connection lost: {err}')
+        self.fail_requests(ConnectionResetError(errno.ECONNRESET, f'Connection lost: {err}'))
+        # Wake up the writer if it waits for data and the reader if it waits in recv
+        self.outgoing.put(None)
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def receive(self, message):
+        """Pass the reply to the request waiting for it, other messages are processed as the server pushes"""
+        request_id = message.get(REQUEST_ID)
+        if RESPONSE in message and request_id is not None:
+            with self.requests_lock:
+                future = self.requests.pop(request_id, None)
+            if future is not None:
+                future.set_result(message)
+                return
+        self.process_server_ans(message)
+
+    def fail_requests(self, err):
+        """Connection is lost, nobody will answer the waiting requests"""
+        with self.requests_lock:
+            requests, self.requests = self.requests, {}
+        for future in requests.values():
+            future.set_exception(err)
+
     def process_server_ans(self, message):
         client_log.debug(f'Parse server answer: {message}')
 
@@ -140,12 +324,19 @@ class ClientTransport(threading.Thread, QObject):
             elif message[RESPONSE] == 400:
                 raise ServerError(f'{message[ERROR]}')
             elif message[RESPONSE] == 205:
-                self.user_list_update()
-                self.contacts_list_update()
-                self.message_205.emit()
+                if message.get(VERSION) != self.database.get_version():
+                    # The receiver thread must not wait for the reply, it is the one who reads it
+                    self.lists_request().add_done_callback(self.lists_synced)
+                else:
+                    self.message_205.emit()
             else:
                 client_log.debug(f'Unknown response code {message[RESPONSE]}')
 
+        elif message.get(ACTION) == PUBLIC_KEY_CHANGED and ACCOUNT_NAME in message and PUBLIC_KEY in message:
+            client_log.debug(f'Public key of {message[ACCOUNT_NAME]} is changed')
+            self.database.save_keys({message[ACCOUNT_NAME]: message[PUBLIC_KEY]})
+            self.key_changed.emit(message[ACCOUNT_NAME])
+
         # If there is a message add to DB and send signal about new message
         elif ACTION in message \
                 and message[ACTION] == MESSAGE \
@@ -153,58 +344,121 @@ class ClientTransport(threading.Thread, QObject):
                 and DESTINATION in message \
                 and MESSAGE_TEXT in message \
                 and message[DESTINATION] == self.username:
+            if SESSION_KEY in message and KEY_ID in message:
+                # Receiver thread decrypts, the GUI gets the text from DB
+                try:
+                    text = self.cipher.decrypt(message)
+                except (ValueError, KeyError, TypeError) as err:
+                    client_log.error(f'Cannot decrypt message from {message[SENDER]}: {err}')
+                    return
+            else:
+                # Sent not by this client or changed on the way, the user must see it
+                client_log.warning(f'Message from {message[SENDER]} is not encrypted')
+                text = PLAINTEXT_MARK + message[MESSAGE_TEXT]
             client_log.debug(f'Got message from user {message[SENDER]}:'
-                         f'{message[MESSAGE_TEXT]}')
-            self.database.save_message(message[SENDER], 'in', message[MESSAGE_TEXT])
+                         f'{text}')
+            self.database.save_message(message[SENDER], 'in', text)
             self.new_message.emit(message[SENDER])
 
-    def contacts_list_update(self):
-        client_log.debug(f'Request user\'s contacts list {self.name}')
+    def lists_sync(self):
+        """Get and apply the changes of the users and contacts lists after the version the client has"""
+        self.lists_apply(self.wait(self.lists_request()))
+
+    def lists_request(self):
+        since = self.database.get_version()
+        client_log.debug(f'Request lists changes since version {since} for {self.username}')
         req = {
-            ACTION: GET_CONTACTS,
+            ACTION: SYNC,
             TIME: time.time(),
-            USER: self.username
+            USER: self.username,
+            SINCE: since
         }
-        client_log.debug(f'Request {req} is ready')
-        with socket_lock:
-            send_json_message(self.transport, req)
-            ans = get_message(self.transport)
-        client_log.debug(f'Server answer received {ans}')
+        return self.request(req)
+
+    def lists_apply(self, ans):
         if RESPONSE in ans and ans[RESPONSE] == 202:
-            for contact in ans[LIST_INFO]:
-                self.database.add_contact(contact)
+            self.database.apply_changes(ans[LIST_INFO])
         else:
-            client_log.error('Cannot update user contacts list')
-
-    def user_list_update(self):
-        client_log.debug(f'Request known users list {self.username}')
+            client_log.error('Cannot update users and contacts lists')
+
+    def lists_synced(self, future):
+        """Changes requested after 205 are received"""
+        if future.exception() is None:
+            self.lists_apply(future.result())
+            self.message_205.emit()
+
+    def search_users(self, prefix, cursor=None):
+        """
+        Page of the users whose names start with prefix. Returns the request id at once,
+        users_found is emitted with it when the server answers.
+        """
+        client_log.debug(f'Search users by {prefix}, cursor {cursor}')
         req = {
-            ACTION: USERS_REQUEST,
+            ACTION: USERS_SEARCH,
             TIME: time.time(),
-            ACCOUNT_NAME: self.username
+            ACCOUNT_NAME: self.username,
+            PREFIX: prefix,
+            CURSOR: cursor
         }
-        with socket_lock:
-            send_json_message(self.transport, req)
-            ans = get_message(self.transport)
-        if RESPONSE in ans and ans[RESPONSE] == 202:
-            self.database.add_users(ans[LIST_INFO])
-        else:
-            client_log.error('Cannot update users list')
+        request = self.request(req)
+        timer = self.reply_timer(request)
+        request.add_done_callback(lambda reply: self.users_answered(reply, timer))
+        return request.request_id
+
+    def users_answered(self, future, timer):
+        timer.cancel()
+        if future.exception() is None:
+            ans = future.result()
+            if RESPONSE in ans and ans[RESPONSE] == 202:
+                self.users_found.emit(future.request_id, ans[LIST_INFO], ans.get(CURSOR))
+                return
+        client_log.error('Cannot search users')
+
+    def keys_request(self, users):
+        """Public keys of the users by one request, returns dict username -> key"""
+        return self.keys_answer(self.wait(self.keys_future(users)))
 
-    def key_request(self, user):
-        client_log.debug(f'Request public key for {user}')
+    def keys_future(self, users):
+        client_log.debug(f'Request public keys of {len(users)} users')
         req = {
             ACTION: PUBLIC_KEY_REQUEST,
             TIME: time.time(),
-            ACCOUNT_NAME: user
+            ACCOUNT_NAME: users
         }
-        with socket_lock:
-            send_json_message(self.transport, req)
-            ans = get_message(self.transport)
-        if RESPONSE in ans and ans[RESPONSE] == 511:
-            return ans[DATA]
-        else:
-            client_log.error(f'Cannot get interlocutor key {user}.')
+        return self.request(req)
+
+    @staticmethod
+    def keys_answer(ans):
+        if RESPONSE in ans and ans[RESPONSE] == 202:
+            return ans[LIST_INFO]
+        client_log.error('Cannot get public keys')
+        return {}
+
+    def keys_update(self):
+        """Refresh the cached keys of all contacts, keys changed while the client was offline are replaced"""
+        contacts = self.database.get_contacts()
+        for start in range(0, len(contacts), PUBLIC_KEYS_LIMIT):
+            self.database.save_keys(self.keys_request(contacts[start:start + PUBLIC_KEYS_LIMIT]))
+
+    def keys_refresh(self):
+        """The same as keys_update, but does not wait: the keys are saved when the replies come"""
+        contacts = self.database.get_contacts()
+        for start in range(0, len(contacts), PUBLIC_KEYS_LIMIT):
+            self.keys_future(contacts[start:start + PUBLIC_KEYS_LIMIT]).add_done_callback(self.keys_received)
+
+    def keys_received(self, future):
+        if future.exception() is None:
+            self.database.save_keys(self.keys_answer(future.result()))
+
+    def get_key(self, user):
+        """Public key of the user as (fingerprint, key) from the cache, requested from the server on a miss"""
+        key = self.database.get_key(user)
+        if key is None:
+            self.database.save_keys(self.keys_request([user]))
+            key = self.database.get_key(user)
+            if key is None:
+                client_log.error(f'Cannot get interlocutor key {user}.')
+        return key
 
     def add_contact(self, contact):
         client_log.debug(f'Create contact {contact}')
@@ -214,9 +468,19 @@ class ClientTransport(threading.Thread, QObject):
             USER: self.username,
             ACCOUNT_NAME: contact
         }
-        with socket_lock:
-            send_json_message(self.transport, req)
-            self.process_server_ans(get_message(self.transport))
+        self.process_server_ans(self.wait(self.request(req)))
+
+    def add_contacts(self, contacts):
+        """Add many contacts: all requests are sent at once, so it takes one round trip"""
+        client_log.debug(f'Create {len(contacts)} contacts')
+        futures = [self.request({
+            ACTION: ADD_CONTACT,
+            TIME: time.time(),
+            USER: self.username,
+            ACCOUNT_NAME: contact
+        }) for contact in contacts]
+        for future in futures:
+            self.process_server_ans(self.wait(future))
 
     def remove_contact(self, contact):
         client_log.debug(f'Delete contact {contact}')
@@ -226,62 +490,111 @@ class ClientTransport(threading.Thread, QObject):
             USER: self.username,
             ACCOUNT_NAME: contact
         }
-        with socket_lock:
-            send_json_message(self.transport, req)
-            self.process_server_ans(get_message(self.transport))
+        self.process_server_ans(self.wait(self.request(req)))
 
     def transport_shutdown(self):
         self.running = False
+        self.stop_event.set()
+        self.crypto.submit(self.database.close_session)
+        self.crypto.shutdown(wait=False)
         message = {
             ACTION: EXIT,
             TIME: time.time(),
             ACCOUNT_NAME: self.username
         }
-        with socket_lock:
-            try:
-                send_json_message(self.transport, message)
-            except OSError:
-                pass
+        if self.connected:
+            self.outgoing.put(encode_message(message))
+            self.outgoing.put(None)
+            self.writer.join(REPLY_TIMEOUT)
         client_log.debug('Transport is finishing its work.')
-        time.sleep(0.5)
+        # Wakes up the receiver blocked in recv
+        try:
+            self.transport.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
     def send_message(self, to, message):
+        """
+        Returns at once, the caller (GUI) never waits: the key is got and the text is encrypted in the crypto thread,
+        message_sent or send_failed is emitted when the server answers.
+        """
+        self.crypto.submit(self.encrypted_request, to, message).add_done_callback(
+            lambda future: self.message_requested(future, to, message))
+
+    def encrypted_request(self, to, message):
+        key = self.get_key(to)
+        if key is None:
+            raise ServerError('There is no cipher key for this user')
         message_dict = {
             ACTION: MESSAGE,
             SENDER: self.username,
             DESTINATION: to,
-            TIME: time.time(),
-            MESSAGE_TEXT: message
+            TIME: time.time()
         }
+        message_dict.update(self.cipher.encrypt(self.username, to, key, message))
         client_log.debug(f'Message dict is prepared: {message_dict}')
+        return self.request(message_dict)
+
+    def message_requested(self, future, to, message):
+        """The request is sent by the crypto thread, now its reply is awaited without blocking any thread"""
+        err = future.exception()
+        if err is not None:
+            self.send_failed.emit(to, err)
+            return
+        request = future.result()
+        timer = self.reply_timer(request)
+        request.add_done_callback(lambda reply: self.message_answered(reply, timer, to, message))
+
+    def reply_timer(self, future):
+        """Started timer which fails the request if the server does not answer in time"""
+        timer = threading.Timer(REPLY_TIMEOUT, self.expire_request, (future,))
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def expire_request(self, future):
+        """Nobody waits for the reply in wait(), so the timeout is set by the timer"""
+        with self.requests_lock:
+            if self.requests.pop(future.request_id, None) is None:
+                return
+        future.set_exception(TimeoutError('Server does not answer'))
 
-        # Wait until socket is free
-        with socket_lock:
-            send_json_message(self.transport, message_dict)
-            self.process_server_ans(get_message(self.transport))
-            client_log.info(f'Send message from user {to}')
+    def message_answered(self, future, timer, to, message):
+        timer.cancel()
+        err = future.exception()
+        if err is None:
+            try:
+                self.process_server_ans(future.result())
+            except ServerError as error:
+                err = error
+        if err is not None:
+            self.send_failed.emit(to, err)
+            return
+        client_log.info(f'Send message to user {to}')
+        self.message_sent.emit(to, message)
 
     def run(self):
+        """Receiver thread: waits for the server messages all the time, no polling. Reconnects if the connection is lost."""
         client_log.debug('Start process - Message receiver')
         while self.running:
-            # Wait for a sec and try to get a socket again, need for freeing socket for message sender
-            time.sleep(1)
-            with socket_lock:
-                try:
-                    self.transport.settimeout(0.5)
-                    message = get_message(self.transport)
-                except OSError as err:
-                    if err.errno:
-                        client_log.critical(f'Connection lost')
-                        self.running = False
-                        self.connection_lost.emit()
-                except (ConnectionError, ConnectionAbortedError,
-                        ConnectionResetError, json.JSONDecodeError, TypeError):
-                    client_log.debug(f'Connection lost')
-                    self.running = False
-                    self.connection_lost.emit()
-                else:
-                    client_log.debug(f'Got message from server: {message}')
-                    self.process_server_ans(message)
-                finally:
-                    self.transport.settimeout(5)
+            self.receive_loop(self.transport)
+            if self.running and not self.reconnect():
+                self.running = False
+                client_log.critical('Connection lost')
+                self.connection_lost.emit()
+        self.database.close_session()
+
+    def receive_loop(self, sock):
+        """Process the messages of the connection until it fails or the transport is stopped"""
+        sock.settimeout(None)
+        while self.running:
+            try:
+                message = get_message(sock, self.decoder)
+            except (OSError, json.JSONDecodeError, ValueError) as err:
+                self.connection_failed(err, sock)
+                return
+            client_log.debug(f'Got message from server: {message}')
+            try:
+                self.receive(message)
+            except ServerError as err:
+                client_log.error(f'Server error: {err}')
@@ -1,24 +1,37 @@
+import functools
+import itertools
 import os
 import sys
-import inspect
 
 sys.path.append(os.path.join(os.getcwd(), '../..'))
 import logging
 from logs import client_log_config, server_log_config
+from common.variables import TRACE_SAMPLE_RATE
+
+# Can be changed without editing the code: TRACE_SAMPLE_RATE=0 python run_server.py
+TRACE_SAMPLE_RATE = int(os.environ.get('TRACE_SAMPLE_RATE', TRACE_SAMPLE_RATE))
 
 
 def log(func_to_logging):
-    """Decorator function"""
+    """
+    Decorator function: traces the calls to the debug log.
+    If tracing is off the function is returned as is, so the calls cost nothing.
+    Otherwise the level is checked first, every TRACE_SAMPLE_RATE-th call is traced
+    and the message is formatted by logging only when it is written.
+    """
+    sample_rate = TRACE_SAMPLE_RATE
+    if sample_rate <= 0:
+        return func_to_logging
+    logger = logging.getLogger('server_log' if 'server.py' in sys.argv[0] else 'client_log')
+    calls = itertools.count()
+    name = func_to_logging.__name__
+    module = func_to_logging.__module__
+
+    @functools.wraps(func_to_logging)
     def wrap(*args, **kwargs):
-        logger_name = 'server_log' if 'server.py' in sys.argv[0] else 'client_log'
-        logger = logging.getLogger(logger_name)
         f = func_to_logging(*args, **kwargs)
-
-        logger.debug(
-            f'{func_to_logging.__name__} was called with params {args}, {kwargs} '
-            f'from module {func_to_logging.__module__} '
-            f'from function {inspect.stack()[1][3]}'
-        )
+        if logger.isEnabledFor(logging.DEBUG) and not next(calls) % sample_rate:
+            logger.debug('%s was called with params %s, %s from module %s from function %s',
+                         name, args, kwargs, module, sys._getframe(1).f_code.co_name)
         return f
     return wrap
-
@@ -1,22 +1,92 @@
 import json
 import os
+import struct
 import sys
+import weakref
 
-from common.variables import ENCODING, MAX_PACKAGE_LENGTH
+from common.variables import ENCODING, MAX_PACKAGE_LENGTH, RECV_BUFFER_SIZE
 
 sys.path.append(os.path.join(os.getcwd(), '..'))
 from common.decorators import log
 
+# Every message on the wire is a frame: 4 bytes payload length (big endian) + json payload
+FRAME_HEADER = struct.Struct('!I')
+
+# Receive buffers of the sockets read by get_message without their own decoder
+socket_decoders = weakref.WeakKeyDictionary()
+
+
+class FrameDecoder:
+    """
+    Incremental frames decoder. Keeps the receive buffer of one connection,
+    so it doesn't matter how TCP splits or joins the messages.
+    """
+
+    def __init__(self, max_frame_size=MAX_PACKAGE_LENGTH):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Add received bytes to the buffer"""
+        self.buffer += data
+
+    def next_frame(self):
+        """Cut the first complete frame payload from the buffer, None if there is no complete frame yet"""
+        if len(self.buffer) < FRAME_HEADER.size:
+            return None
+        (frame_size,) = FRAME_HEADER.unpack_from(self.buffer)
+        if frame_size > self.max_frame_size:
+            raise ValueError(f'Frame size {frame_size} exceeds the limit {self.max_frame_size}')
+        frame_end = FRAME_HEADER.size + frame_size
+        if len(self.buffer) < frame_end:
+            return None
+        payload = bytes(self.buffer[FRAME_HEADER.size:frame_end])
+        del self.buffer[:frame_end]
+        return payload
+
+    def next_message(self):
+        """Decode the first complete message from the buffer or return None"""
+        payload = self.next_frame()
+        if payload is None:
+            return None
+        return decode_message(payload)
+
+    def messages(self):
+        """Yield every complete message in the buffer"""
+        message = self.next_message()
+        while message is not None:
+            yield message
+            message = self.next_message()
+
 
 @log
-def get_message(client):
+def get_message(client, decoder=None):
     """
-    Get and decode messages
+    Get and decode messages. Blocks until one complete message is received,
+    the rest of received data stays in the decoder buffer.
     :param client: socket
+    :param decoder: FrameDecoder of this connection
     :return:
     """
+    if decoder is None:
+        decoder = socket_decoders.setdefault(client, FrameDecoder())
 
-    encoded_response = client.recv(MAX_PACKAGE_LENGTH)
+    message = decoder.next_message()
+    while message is None:
+        data = client.recv(RECV_BUFFER_SIZE)
+        if not data:
+            raise ConnectionResetError('Connection closed by remote side')
+        decoder.feed(data)
+        message = decoder.next_message()
+    return message
+
+
+def decode_message(encoded_response):
+    """
+    Decode received bytes to the message dict
+    :param encoded_response: bytes
+    :return: dict
+    """
     if isinstance(encoded_response, bytes):
         json_response = encoded_response.decode(ENCODING)
         response = json.loads(json_response)
@@ -26,17 +96,27 @@ def get_message(client):
     raise ValueError
 
 
-@log
-def send_json_message(sock, message):
+def encode_message(message):
     """
-    Modify dict to json and send it via provided socket
-    :param sock: socket
+    Modify dict to json and pack it to the frame for sending
     :param message: dict
-    :return:
+    :return: bytes
     """
     if not isinstance(message, dict):
         raise TypeError
 
     json_message = json.dumps(message)
-    encoded_message = json_message.encode(ENCODING)
-    sock.send(encoded_message)
+    payload = json_message.encode(ENCODING)
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+@log
+def send_json_message(sock, message):
+    """
+    Modify dict to json and send it via provided blocking socket.
+    Waits until the whole message is sent.
+    :param sock: socket
+    :param message: dict
+    :return:
+    """
+    sock.sendall(encode_message(message))
@@ -5,7 +5,81 @@ DEFAULT_SERVER_ADDRESS = '127.0.0.1'
 DEFAULT_SERVER_PORT = 7777
 # Project encoding
 ENCODING = 'utf-8'
-MAX_PACKAGE_LENGTH = 1024
+# Max size of one message (frame payload), bigger frames break the connection
+MAX_PACKAGE_LENGTH = 1024 * 1024
+# How many bytes are read from socket at once
+RECV_BUFFER_SIZE = 64 * 1024
+# Pending connections queue size of the listening socket
+LISTEN_BACKLOG = 1024
+# How long the server loop waits for socket events before checking the stop flag
+SERVER_POLL_TIMEOUT = 0.5
+# Calls of the @log functions written to the debug log: every N-th call, 0 - no tracing at all
+TRACE_SAMPLE_RATE = 1
+# Log records queue between the application and the file writer thread: its size,
+# number of queued records after which debug records are dropped, records written per one flush
+LOG_QUEUE_SIZE = 10000
+LOG_DEBUG_LIMIT = 8000
+LOG_BATCH_SIZE = 500
+# How long the server waits for the client answer during authorisation
+AUTH_TIMEOUT = 5
+# How long the client waits for the server reply to a request
+REPLY_TIMEOUT = 5
+# Connection attempts of the client: at start and after the connection is lost
+CONNECT_ATTEMPTS = 5
+RECONNECT_ATTEMPTS = 12
+# Pause before the next connection attempt is random up to min(MAX, BASE * 2 ** attempt), seconds
+RECONNECT_BASE_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30
+# How long the session resumption token is valid, seconds
+RESUME_TOKEN_TTL = 24 * 60 * 60
+# End-to-end encryption: AES session key size (bytes), the key of a peer is replaced
+# after SESSION_KEY_MESSAGES messages or SESSION_KEY_LIFETIME seconds
+SESSION_KEY_SIZE = 32
+SESSION_KEY_MESSAGES = 1000
+SESSION_KEY_LIFETIME = 60 * 60
+# Number of the unwrapped session keys of the incoming messages kept by the client
+SESSION_KEYS_CACHE = 1000
+# Client send buffer size (bytes) after which the overflow policy is applied
+OUTBOUND_HIGH_WATERMARK = 256 * 1024
+# Client send buffer size (bytes) after which a paused client is read again
+OUTBOUND_LOW_WATERMARK = 64 * 1024
+# Client send buffer size (bytes) after which the client is disconnected with any policy
+OUTBOUND_HARD_LIMIT = 16 * 1024 * 1024
+# Bus buffer size (bytes) to the other worker of the cluster after which the worker is considered stalled
+# and the link to it is closed
+BUS_HARD_LIMIT = 64 * 1024 * 1024
+# What to do with a client which does not take its data in time:
+# drop - disconnect it, pause - stop reading its requests, spill - keep the data in a temporary file
+OUTBOUND_POLICIES = ('drop', 'pause', 'spill')
+OUTBOUND_POLICY = 'pause'
+# Message counters are written to DB every COUNTERS_FLUSH_INTERVAL seconds or every COUNTERS_FLUSH_MESSAGES messages
+COUNTERS_FLUSH_INTERVAL = 0.5
+COUNTERS_FLUSH_MESSAGES = 1000
+# SQLite settings profiles of the server DB, selected by database_profile of server.ini
+DB_PROFILES = {
+    'safe': {'journal_mode': 'WAL', 'synchronous': 'FULL', 'cache_size': -16000, 'mmap_size': 0},
+    'balanced': {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'cache_size': -64000, 'mmap_size': 256 * 1024 * 1024},
+    'fast': {'journal_mode': 'WAL', 'synchronous': 'OFF', 'cache_size': -256000, 'mmap_size': 1024 * 1024 * 1024},
+}
+DB_PROFILE = 'balanced'
+# How long a DB connection waits for a lock of the other one, ms
+DB_BUSY_TIMEOUT = 5000
+# Number of the users/contacts lists changes kept for delta sync, clients which are behind get full lists
+CHANGE_LOG_SIZE = 100000
+# Latency histograms of the server metrics: significant bits of the recorded values (relative error 2 ** -(bits - 1)),
+# the biggest recorded value (microseconds or bytes) and the quantiles served by the metrics endpoint
+HISTOGRAM_PRECISION_BITS = 7
+HISTOGRAM_MAX_VALUE = 2 ** 36
+METRICS_QUANTILES = (0.5, 0.9, 0.99, 0.999)
+# Every n-th client request is timed for the action metrics, timing every request costs more than its dispatch
+ACTION_TIMING_INTERVAL = 64
+# Users search: default and maximum number of names in one page
+SEARCH_LIMIT = 50
+SEARCH_MAX_LIMIT = 500
+# Pause in typing after which the client searches users, ms
+SEARCH_DELAY = 300
+# Maximum number of the accounts in one public keys request
+PUBLIC_KEYS_LIMIT = 500
 
 # JIM's main keys:
 ACTION = 'action'
@@ -16,11 +90,21 @@ SENDER = 'from'
 DESTINATION = 'to'
 DATA = 'bin'
 PUBLIC_KEY = 'pubkey'
+# Id of the client request, the server puts it into the reply
+REQUEST_ID = 'id'
 
 # JIM's other keys:
 MESSAGE = 'message'
 MESSAGE_TEXT = 'message text'
+# Encrypted message: session key wrapped by the RSA key of the recipient and its id
+SESSION_KEY = 'session_key'
+KEY_ID = 'key_id'
+# Mark of the incoming message which came not encrypted, it is saved to the history with the text
+PLAINTEXT_MARK = '[not encrypted] '
 PRESENCE = 'presence'
+# Login by the resumption token received after the previous login
+RESUME = 'resume'
+TOKEN = 'token'
 RESPONSE = 'response'
 ERROR = 'error'
 RESPONSE_DEFAULT_IP_ADDRESSES = 'response_default_ip_addresses'
@@ -31,6 +115,31 @@ REMOVE_CONTACT = 'remove'
 ADD_CONTACT = 'add'
 USERS_REQUEST = 'get_users'
 PUBLIC_KEY_REQUEST = 'pubkey_need'
+# Server push: the user logged in with a new public key
+PUBLIC_KEY_CHANGED = 'pubkey_changed'
+# Delta sync of users and contacts lists
+SYNC = 'sync'
+SINCE = 'since'
+VERSION = 'version'
+FULL = 'full'
+USERS = 'users'
+CONTACTS = 'contacts'
+ADDED = 'added'
+REMOVED = 'removed'
+# Users search by name prefix with pagination
+USERS_SEARCH = 'search_users'
+PREFIX = 'prefix'
+CURSOR = 'cursor'
+LIMIT = 'limit'
+
+# Multi-process server, messages between workers:
+WORKER = 'worker'
+BUS_USER_ONLINE = 'bus_online'
+BUS_USER_OFFLINE = 'bus_offline'
+BUS_ROUTE = 'bus_route'
+BUS_KEY_CHANGED = 'bus_key_changed'
+# Command of the master process to the workers, DATA is the log level name
+BUS_LOG_LEVEL = 'bus_log_level'
 
 # Dicts - answers:
 # 200
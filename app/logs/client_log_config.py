@@ -1,5 +1,9 @@
 import logging
 import os
+import sys
+
+sys.path.append('../')
+from logs.queue_logging import BatchFileHandler, attach
 
 DIR = f'{os.getcwd()}/logs' if __name__ != '__main__' else f'{os.getcwd()}'
 
@@ -8,11 +12,12 @@ client_log.setLevel(logging.DEBUG)
 
 formatter = logging.Formatter("%(asctime)s %(levelname)-10s  %(module)15s  %(message)s")
 
-file_handler = logging.FileHandler(f'{DIR}/logging/client_log.log', encoding='utf-8')
+file_handler = BatchFileHandler(f'{DIR}/logging/client_log.log', encoding='utf-8')
 file_handler.setLevel(logging.DEBUG)
 file_handler.setFormatter(formatter)
 
-client_log.addHandler(file_handler)
+# The file is written by the listener thread, logging calls only put the records into the queue
+listener = attach(client_log, file_handler)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,151 @@
+"""
+Asynchronous logging: the logger puts the records into a bounded queue,
+the listener thread writes them to the file and flushes it once per batch.
+So the file writes and the log rotation never delay the thread which logs.
+When the queue is filling up the debug records are dropped first.
+"""
+import atexit
+import copy
+import logging
+import os
+import queue
+import sys
+import threading
+from logging import handlers
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+from common.variables import LOG_QUEUE_SIZE, LOG_DEBUG_LIMIT, LOG_BATCH_SIZE
+
+
+class BatchFlushMixin:
+    """The stream is flushed by the listener after a batch of records, not after every record"""
+
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        super().flush()
+
+
+class BatchFileHandler(BatchFlushMixin, logging.FileHandler):
+    pass
+
+
+class BatchTimedRotatingFileHandler(BatchFlushMixin, handlers.TimedRotatingFileHandler):
+    pass
+
+
+class DroppingQueueHandler(handlers.QueueHandler):
+    """
+    Queue handler which never blocks: debug records are dropped when the queue has debug_limit records,
+    the others when it is full.
+    """
+
+    def __init__(self, log_queue, debug_limit=LOG_DEBUG_LIMIT):
+        super().__init__(log_queue)
+        self.debug_limit = debug_limit
+        # Number of the dropped records, the listener reports it
+        self.dropped = 0
+        self.dropped_lock = threading.Lock()
+
+    def emit(self, record):
+        """The drop check goes first, so a dropped record costs nothing. The listener formats the queued ones."""
+        if record.levelno <= logging.DEBUG and self.queue.qsize() >= self.debug_limit:
+            self.drop()
+            return
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except queue.Full:
+            self.drop()
+        except Exception:
+            self.handleError(record)
+
+    def prepare(self, record):
+        """Copy of the record with the copy of its arguments, the message is not formatted here"""
+        record = copy.copy(record)
+        if isinstance(record.args, dict):
+            record.args = dict(record.args)
+        elif record.args:
+            record.args = tuple(record.args)
+        return record
+
+    def drop(self):
+        with self.dropped_lock:
+            self.dropped += 1
+
+    def take_dropped(self):
+        with self.dropped_lock:
+            dropped, self.dropped = self.dropped, 0
+        return dropped
+
+
+class LogListener:
+    """Thread writing the queued records to the handler"""
+
+    def __init__(self, queue_handler, handler, batch_size=LOG_BATCH_SIZE):
+        self.queue_handler = queue_handler
+        self.handler = handler
+        self.batch_size = batch_size
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='log_listener', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Write the queued records and stop the thread"""
+        if self.thread is not None and self.thread.is_alive():
+            self.queue_handler.queue.put(None)
+            self.thread.join()
+        self.thread = None
+
+    def restart_after_fork(self):
+        """Child process gets the queue without the listener thread, it needs its own ones"""
+        self.queue_handler.queue = queue.Queue(self.queue_handler.queue.maxsize)
+        self.queue_handler.dropped_lock = threading.Lock()
+        self.start()
+
+    def run(self):
+        log_queue = self.queue_handler.queue
+        while True:
+            batch = [log_queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(log_queue.get_nowait())
+                except queue.Empty:
+                    break
+            for record in batch:
+                if record is not None:
+                    self.handler.handle(record)
+            dropped = self.queue_handler.take_dropped()
+            if dropped:
+                self.handler.handle(logging.makeLogRecord({
+                    'name': 'queue_logging', 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'module': 'queue_logging', 'msg': f'{dropped} log records were dropped, the log queue is full'
+                }))
+            self.handler.flush_batch()
+            if None in batch:
+                return
+
+
+def attach(logger, handler, queue_size=LOG_QUEUE_SIZE):
+    """Send the records of the logger to the handler through the queue, returns the started listener"""
+    queue_handler = DroppingQueueHandler(queue.Queue(queue_size))
+    logger.addHandler(queue_handler)
+    listener = LogListener(queue_handler, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=listener.restart_after_fork)
+    return listener
+
+
+def set_level(level, names=('server_log', 'client_log')):
+    """Change the level of the loggers while the application works, level is a name like 'INFO' or a number"""
+    if isinstance(level, str):
+        number = logging.getLevelName(level.upper())
+        if not isinstance(number, int):
+            raise ValueError(f'Unknown log level {level}')
+        level = number
+    for name in names:
+        logging.getLogger(name).setLevel(level)
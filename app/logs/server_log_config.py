@@ -3,7 +3,8 @@ import sys
 
 sys.path.append('../')
 import logging
-from logging import handlers
+
+from logs.queue_logging import BatchTimedRotatingFileHandler, attach
 
 DIR = f'{os.getcwd()}/logs' if __name__ != '__main__' else f'{os.getcwd()}'
 
@@ -12,12 +13,13 @@ server_log.setLevel(logging.DEBUG)
 
 formatter = logging.Formatter("%(asctime)s %(levelname)-10s  %(module)15s  %(message)s")
 
-file_handler = logging.handlers.TimedRotatingFileHandler(f'{DIR}/logging/server_log.log',
-                                                         when='D', interval=1,  encoding='utf-8')
+file_handler = BatchTimedRotatingFileHandler(f'{DIR}/logging/server_log.log',
+                                             when='D', interval=1,  encoding='utf-8')
 file_handler.setLevel(logging.DEBUG)
 file_handler.setFormatter(formatter)
 
-server_log.addHandler(file_handler)
+# The file is written by the listener thread, logging calls only put the records into the queue
+listener = attach(server_log, file_handler)
 
 
 if __name__ == '__main__':
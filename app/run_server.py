@@ -7,10 +7,14 @@ from PyQt5.QtCore import Qt
 from PyQt5.QtWidgets import QApplication
 
 from server.core import MessageProcessor
+from server.async_core import AsyncMessageProcessor
+from server.cluster import ServerCluster
 from server.main_window import MainWindow
 from common.variables import *
 from common.decorators import log
 from server.server_database import ServerStorage
+from server.metrics import MetricsServer
+from logs.queue_logging import set_level
 
 
 import logging
@@ -18,11 +22,17 @@ sys.path.append(os.path.join(os.getcwd(), '..'))
 
 server_log = logging.getLogger('server_log')
 
+# Server engines which can be selected with --engine
+SERVER_ENGINES = {
+    'selectors': MessageProcessor,
+    'asyncio': AsyncMessageProcessor,
+}
+
 
 @log
 def get_params(default_address, default_port):
     """Get command params
-    template: server.py -p 8888 -a 127.0.0.1
+    template: server.py -p 8888 -a 127.0.0.1 --engine asyncio --outbound_policy pause --workers 4 --metrics-port 9100
     """
     server_log.debug(
         f'Command line params parser initialization: {sys.argv}')
@@ -30,12 +40,23 @@ def get_params(default_address, default_port):
     parser.add_argument('-p', default=default_port, type=int, nargs='?')
     parser.add_argument('-a', default=default_address, nargs='?')
     parser.add_argument('--no_gui', action='store_true')
+    parser.add_argument('--engine', default='selectors', choices=SERVER_ENGINES.keys())
+    parser.add_argument('--outbound_policy', default=OUTBOUND_POLICY, choices=OUTBOUND_POLICIES)
+    parser.add_argument('--workers', default=1, type=int)
+    # Prometheus metrics on http://127.0.0.1:<port>/metrics, worker N of the cluster uses port + N
+    parser.add_argument('--metrics-port', default=None, type=int)
     namespace = parser.parse_args(sys.argv[1:])
+    if namespace.workers > 1 and namespace.engine != 'selectors':
+        parser.error('--workers needs the selectors engine')
     listen_address = namespace.a
     listen_port = namespace.p
     gui_flag = namespace.no_gui
+    engine = namespace.engine
+    outbound_policy = namespace.outbound_policy
+    workers = namespace.workers
+    metrics_port = namespace.metrics_port
     server_log.debug('Success!')
-    return listen_address, listen_port, gui_flag
+    return listen_address, listen_port, gui_flag, engine, outbound_policy, workers, metrics_port
 
 
 @log
@@ -53,34 +74,73 @@ def config_load():
         config.set('SETTINGS', 'Listen_Address', '')
         config.set('SETTINGS', 'Database_path', '')
         config.set('SETTINGS', 'Database_file', 'server_database.db3')
+        config.set('SETTINGS', 'Database_profile', DB_PROFILE)
         return config
 
 
+def change_log_level(command, cluster=None):
+    """Console command "log DEBUG" changes the server log level without restart, of the cluster workers too"""
+    words = command.split()
+    if len(words) != 2 or words[0] != 'log':
+        return
+    try:
+        set_level(words[1], ('server_log',))
+    except ValueError as err:
+        print(err)
+    else:
+        if cluster is not None:
+            cluster.set_log_level(words[1])
+        server_log.warning(f'Log level is changed to {words[1].upper()}')
+
+
 def main():
     config = config_load()
 
     # Get server params
-    listen_address, listen_port, gui_flag = get_params(
+    listen_address, listen_port, gui_flag, engine, outbound_policy, workers, metrics_port = get_params(
         config['SETTINGS']['listen_address'], config['SETTINGS']['default_port']
     )
+    database_path = os.path.join(
+        config['SETTINGS']['database_path'],
+        config['SETTINGS']['database_file'])
+    database_profile = config['SETTINGS'].get('database_profile', DB_PROFILE)
+
+    # Multi-process server: every worker has its own DB connection, there is no GUI
+    if workers > 1:
+        cluster = ServerCluster(workers, listen_address, listen_port, database_path, outbound_policy, database_profile,
+                                metrics_port)
+        cluster.start()
+        try:
+            while True:
+                command = input('Type "exit" to stop the server, "log <level>" to change the log level.')
+                if command == 'exit':
+                    break
+                change_log_level(command, cluster)
+        except (KeyboardInterrupt, EOFError):
+            # Workers ignore SIGINT, they are stopped by the master
+            pass
+        finally:
+            cluster.stop()
+        return
 
     # Init DB
-    database = ServerStorage(
-        os.path.join(
-            config['SETTINGS']['database_path'],
-            config['SETTINGS']['database_file']))
+    database = ServerStorage(database_path, profile=database_profile)
 
-    server = MessageProcessor(listen_address, listen_port, database)
+    server = SERVER_ENGINES[engine](listen_address, listen_port, database, outbound_policy)
     server.daemon = True
     server.start()
 
+    if metrics_port is not None:
+        MetricsServer(server, metrics_port).start()
+
     if gui_flag:
         while True:
-            command = input('Type "exit" to stop the server.')
+            command = input('Type "exit" to stop the server, "log <level>" to change the log level.')
             if command == 'exit':
                 server.running = False
                 server.join()
                 break
+            change_log_level(command)
     else:
         server_app = QApplication(sys.argv)
         server_app.setAttribute(Qt.AA_DisableWindowContextHelpButton)
@@ -89,8 +149,9 @@ def main():
         # Run GUI
         server_app.exec_()
 
-        # Stop server by window closing
+        # Stop server by window closing, wait for it to write the message counters
         server.running = False
+        server.join()
 
     # ======================================================================
 
@@ -0,0 +1,274 @@
+import asyncio
+import hmac
+import os
+import binascii
+import sys
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from common.variables import *
+from common.utils import encode_message, FrameDecoder
+from server.core import MessageProcessor, raise_open_files_limit
+from server.tokens import make_token, check_token
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+server_log = logging.getLogger('server_log')
+
+
+class StreamClient:
+    """Socket-like wrapper of the asyncio stream.
+    Lets the protocol code of MessageProcessor work with the connection from any thread."""
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.loop = server.loop
+        self.reader = reader
+        self.writer = writer
+        self.decoder = FrameDecoder()
+        # Set after successful authorisation
+        self.username = None
+        self.peername = writer.get_extra_info('peername')
+        # Id of the request which is served now, the reply carries it
+        self.request_id = None
+
+    def send(self, data):
+        self.loop.call_soon_threadsafe(self.write, data)
+        return len(data)
+
+    def write(self, data):
+        if self.writer.is_closing():
+            return
+        self.writer.write(data)
+        self.server.metrics.bytes_out += len(data)
+        self.server.check_outbound(self)
+
+    def queue_size(self):
+        return self.writer.transport.get_write_buffer_size()
+
+    def getpeername(self):
+        return self.peername
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.writer.close)
+
+    def __repr__(self):
+        return f'<StreamClient {self.peername}>'
+
+
+class AsyncMessageProcessor(MessageProcessor):
+    """Server engine on asyncio streams: one coroutine per connection.
+    All database work (and the protocol handlers touching the database) runs in a single executor thread,
+    so the event loop never waits for SQLite.
+    Client requests are not read while the client send buffer is above the high watermark (drain),
+    so the spill policy works as pause here."""
+
+    def __init__(self, listen_address, listen_port, database, outbound_policy=OUTBOUND_POLICY):
+        super().__init__(listen_address, listen_port, database, outbound_policy)
+        if self.outbound_policy == 'spill':
+            server_log.warning('Spill outbound policy is not supported by asyncio engine, pause is used')
+            self.outbound_policy = 'pause'
+        self.loop = None
+        self.executor = None
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        print(f'Server started on port {self.port}')
+        print(f'Server accepts connections from address {self.address}')
+        raise_open_files_limit()
+        self.loop = asyncio.get_running_loop()
+        # Session of ServerStorage is not thread safe, so only one DB thread
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='server_db')
+
+        server = await asyncio.start_server(
+            self.handle_client, self.address or None, int(self.port),
+            backlog=LISTEN_BACKLOG, reuse_address=True)
+
+        async with server:
+            while self.running:
+                await asyncio.sleep(SERVER_POLL_TIMEOUT)
+                await self.db_call(self.database.flush_counters_if_due)
+
+        # Server is stopped - cancel all connection coroutines
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.executor.submit(self.database.flush_counters)
+        self.executor.submit(self.database.close_session)
+        self.executor.shutdown(wait=True)
+
+    async def db_call(self, func, *args):
+        """Run the database call in the DB thread"""
+        return await self.loop.run_in_executor(self.executor, self.timed_storage_call, func, *args)
+
+    def storage_call(self, client, callback, func, *args):
+        """Protocol handlers already run in the DB thread, so the call is made at once"""
+        callback(self.timed_storage_call(func, *args))
+
+    def storage_submit(self, func, *args):
+        self.timed_storage_call(func, *args)
+
+    def call_soon(self, func, *args):
+        self.loop.call_soon_threadsafe(func, *args)
+
+    async def handle_client(self, reader, writer):
+        client = StreamClient(self, reader, writer)
+        writer.transport.set_write_buffer_limits(high=self.high_watermark, low=self.low_watermark)
+        server_log.info(f'Client with address {client.peername} connected')
+        self.metrics.connections += 1
+        # The stream wrapper is the connection object of this engine
+        self.connections[client] = client
+        # Authorisation must be finished before the deadline
+        deadline = self.loop.time() + AUTH_TIMEOUT
+        try:
+            while self.running:
+                if client.username is None:
+                    message = await asyncio.wait_for(self.read_message(client), deadline - self.loop.time())
+                    await self.process_handshake(message, client, deadline)
+                else:
+                    message = await self.read_message(client)
+                    client.request_id = message.get(REQUEST_ID)
+                    # Protocol handlers touch the database, so they run in the DB thread
+                    await self.loop.run_in_executor(self.executor, self.process_client_message, message, client)
+                if client not in self.connections:
+                    break
+                await writer.drain()
+        except (OSError, ValueError, asyncio.TimeoutError):
+            server_log.info(f'Client {client.peername} was disconnected from the server')
+        except asyncio.CancelledError:
+            pass
+        finally:
+            if client in self.connections:
+                self.remove_client(client)
+            # After the writes queued by client.send, so the last answer (an error) is delivered
+            self.loop.call_soon(writer.close)
+
+    async def read_message(self, client):
+        """Wait for the next complete message, already buffered messages are returned at once"""
+        message = client.decoder.next_message()
+        while message is None:
+            data = await client.reader.read(RECV_BUFFER_SIZE)
+            if not data:
+                raise ConnectionResetError('Connection closed by client')
+            self.metrics.bytes_in += len(data)
+            client.decoder.feed(data)
+            message = client.decoder.next_message()
+        return message
+
+    async def process_handshake(self, message, client, deadline):
+        if ACTION in message and message[ACTION] == PRESENCE and TIME in message and USER in message:
+            await self.authorize_client(message, client, deadline)
+        elif ACTION in message and message[ACTION] == RESUME and USER in message and TOKEN in message:
+            await self.resume_client(message, client)
+        else:
+            response = RESPONSE_400
+            response[ERROR] = 'Authorisation required'
+            self.try_send_msg_or_close(client, response)
+
+    async def authorize_client(self, message, client, deadline):
+        """Challenge-response authorisation. Waiting for the client answer does not block other clients."""
+        if not self.check_presence(message, client):
+            return
+        username = message[USER][ACCOUNT_NAME]
+        server_log.debug(f'Start auth process for {message[USER]}')
+        if self.is_online(username):
+            response = RESPONSE_400
+            response[ERROR] = 'User with such name already exists.'
+            server_log.error('User with such name already exists.')
+            self.try_send_msg_or_close(client, response)
+            return
+        if not await self.db_call(self.database.check_user, username):
+            response = RESPONSE_400
+            response[ERROR] = 'There is no user with such name.'
+            server_log.error('There is no user with such name.')
+            self.try_send_msg_or_close(client, response)
+            return
+
+        server_log.debug('Correct username, starting passwd check.')
+        message_auth = dict(RESPONSE_511)
+        random_str = binascii.hexlify(os.urandom(64))
+        message_auth[DATA] = random_str.decode('ascii')
+        password_hash = await self.db_call(self.database.get_hash, username)
+        digest = hmac.new(password_hash, random_str, 'MD5').digest()
+        self.try_send_msg_or_close(client, message_auth)
+
+        ans = await asyncio.wait_for(self.read_message(client), deadline - self.loop.time())
+        if RESPONSE in ans and ans[RESPONSE] == 511 and DATA in ans and \
+                hmac.compare_digest(digest, binascii.a2b_base64(ans[DATA])) and not self.is_online(username):
+            await self.login_client(client, username, message[USER][PUBLIC_KEY], make_token(password_hash, username))
+        else:
+            response = RESPONSE_400
+            response[ERROR] = 'Wrong password'
+            self.try_send_msg_or_close(client, response)
+            self.remove_client(client)
+
+    async def resume_client(self, message, client):
+        """Login by the resumption token in one round trip: no challenge and no public key upload"""
+        username = message[USER].get(ACCOUNT_NAME) if isinstance(message[USER], dict) else None
+        if not isinstance(username, str):
+            username = None
+        user = await self.db_call(self.database.get_user, username)
+        if user is None or not check_token(user.password_hash, username, message[TOKEN]):
+            # The client can still log in with the password on this connection
+            response = RESPONSE_400
+            response[ERROR] = 'Session expired'
+            self.try_send_msg_or_close(client, response)
+        elif self.is_online(username):
+            response = RESPONSE_400
+            response[ERROR] = 'User with such name already exists.'
+            self.try_send_msg_or_close(client, response)
+        else:
+            server_log.debug(f'Session of {username} is resumed')
+            await self.login_client(client, username, user.pub_key, make_token(user.password_hash, username))
+
+    async def login_client(self, client, username, pubkey, token):
+        self.names[username] = client
+        client.username = username
+        self.metrics.logins += 1
+        response = dict(RESPONSE_200)
+        response[TOKEN] = token
+        self.try_send_msg_or_close(client, response)
+        client_ip, client_port = client.getpeername()[:2]
+        if await self.db_call(self.database.user_login, username, client_ip, client_port, pubkey):
+            owners = await self.db_call(self.database.contact_owners, username)
+            self.public_key_changed(username, pubkey, owners)
+
+    def remove_client(self, client):
+        """Can be called from the loop, the DB thread or the GUI thread"""
+        if self.connections.pop(client, None) is not None:
+            if client.username is not None and self.names.get(client.username) is client:
+                del self.names[client.username]
+                self.executor.submit(self.database.user_logout, client.username)
+        client.close()
+
+    def check_outbound(self, client):
+        """Called in the loop after each write to the client"""
+        queue_size = client.queue_size()
+        self.metrics.queue_depth.record(queue_size)
+        if queue_size <= self.high_watermark:
+            return
+        if self.outbound_policy == 'drop' or queue_size > self.hard_limit:
+            server_log.warning(f'Client {client} send queue overflow ({queue_size} bytes), disconnecting')
+            self.remove_client(client)
+
+    def queue_depth(self, username):
+        client = self.names.get(username)
+        if client is None:
+            return 0
+        return client.queue_size()
+
+    def try_send_msg_or_close(self, client, response):
+        if client in self.connections:
+            client.send(encode_message(response))
+
+    def process_message(self, message):
+        if message[DESTINATION] in self.names:
+            self.try_send_msg_or_close(self.names[message[DESTINATION]], message)
+            self.metrics.messages_routed += 1
+            server_log.info(f'Send message to {message[DESTINATION]} from {message[SENDER]}.')
+        else:
+            server_log.error(f'Client {message[DESTINATION]} is not registered at the server. '
+                             f'The message cannot be send.')
@@ -0,0 +1,295 @@
+import functools
+import multiprocessing
+import os
+import selectors
+import signal
+import socket
+import sys
+import logging
+
+from common.variables import *
+from common.utils import encode_message, FrameDecoder
+from logs.queue_logging import set_level
+from server.core import MessageProcessor
+from server.metrics import MetricsServer
+from server.outbound import OutboundBuffer
+from server.server_database import ServerStorage
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+server_log = logging.getLogger('server_log')
+
+
+class ShardedMessageProcessor(MessageProcessor):
+    """
+    One worker of the multi-process server.
+    All workers listen to the same port (SO_REUSEPORT), the kernel spreads new connections between them.
+    Workers are connected with each other by socket pairs (the bus). Every worker keeps a copy of
+    the user -> worker directory, updated by online/offline notifications, and forwards messages
+    to recipients of other workers. Messages to one worker are collected during the loop iteration
+    and sent with one system call. The master process sends its commands by the control socket.
+    """
+
+    def __init__(self, listen_address, listen_port, database, outbound_policy, worker_index, links, control=None):
+        super().__init__(listen_address, listen_port, database, outbound_policy)
+        self.worker_index = worker_index
+        # Bus sockets: worker index -> socket, None for this worker
+        self.links = links
+        self.links_incoming = dict()
+        self.links_outgoing = dict()
+        self.bus_limit = BUS_HARD_LIMIT
+        # Users of the other workers: username -> worker index
+        self.directory = dict()
+        # Socket to the master process, framed like the bus
+        self.control = control
+        self.control_decoder = FrameDecoder()
+
+    def set_socket_options(self, transport):
+        super().set_socket_options(transport)
+        transport.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+    def init_socket(self):
+        super().init_socket()
+        for index, link in enumerate(self.links):
+            if link is None:
+                continue
+            link.setblocking(False)
+            self.links_incoming[index] = FrameDecoder()
+            self.links_outgoing[index] = OutboundBuffer(self.hard_limit)
+            self.selector.register(link, selectors.EVENT_READ, functools.partial(self.link_event, index))
+        if self.control is not None:
+            self.control.setblocking(False)
+            self.selector.register(self.control, selectors.EVENT_READ, self.control_event)
+
+    def is_online(self, username):
+        return username in self.names or username in self.directory
+
+    def send_to_worker(self, index, message):
+        """Put the message to the bus buffer, it is sent after the loop iteration"""
+        buffer = self.links_outgoing.get(index)
+        if buffer is None:
+            return
+        buffer.append(encode_message(message))
+        if len(buffer) > self.bus_limit:
+            self.close_link(index, f'does not take its data ({len(buffer)} bytes in bus buffer)')
+
+    def broadcast(self, message):
+        for index in list(self.links_outgoing):
+            self.send_to_worker(index, message)
+
+    def after_select(self):
+        super().after_select()
+        for index, buffer in list(self.links_outgoing.items()):
+            if buffer:
+                self.flush_link(index)
+
+    def flush_link(self, index):
+        link = self.links[index]
+        buffer = self.links_outgoing[index]
+        try:
+            buffer.send(link)
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as err:
+            self.close_link(index, err)
+            return
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if buffer else selectors.EVENT_READ
+        if self.selector.get_key(link).events != events:
+            self.selector.modify(link, events, self.selector.get_key(link).data)
+
+    def link_event(self, index, link, mask):
+        if mask & selectors.EVENT_WRITE:
+            self.flush_link(index)
+        if not mask & selectors.EVENT_READ or index not in self.links_outgoing:
+            return
+        try:
+            data = link.recv(RECV_BUFFER_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as err:
+            self.close_link(index, err)
+            return
+        if not data:
+            self.close_link(index, 'closed the bus')
+            return
+        decoder = self.links_incoming[index]
+        decoder.feed(data)
+        for message in decoder.messages():
+            self.process_bus_message(message)
+
+    def control_event(self, control, mask):
+        try:
+            data = control.recv(RECV_BUFFER_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            # Nobody would stop this worker
+            server_log.critical(f'Master process is gone, worker {self.worker_index} stops')
+            self.selector.unregister(control)
+            control.close()
+            self.control = None
+            self.running = False
+            return
+        self.control_decoder.feed(data)
+        for message in self.control_decoder.messages():
+            if message[ACTION] == BUS_LOG_LEVEL:
+                try:
+                    set_level(message[DATA], ('server_log',))
+                except ValueError as err:
+                    server_log.error(err)
+
+    def close_link(self, index, reason):
+        """The other worker is gone or stalled: its users are offline for this worker from now on"""
+        server_log.critical(f'Worker {index} {reason}, link to it is closed')
+        link = self.links[index]
+        self.selector.unregister(link)
+        link.close()
+        self.links[index] = None
+        self.links_outgoing.pop(index).close()
+        del self.links_incoming[index]
+        self.directory = {name: worker for name, worker in self.directory.items() if worker != index}
+
+    def process_bus_message(self, message):
+        if message[ACTION] == BUS_USER_ONLINE:
+            self.directory[message[ACCOUNT_NAME]] = message[WORKER]
+            # Public key could be changed by the login at the other worker
+            self.database.invalidate_user(message[ACCOUNT_NAME])
+        elif message[ACTION] == BUS_USER_OFFLINE:
+            if self.directory.get(message[ACCOUNT_NAME]) == message[WORKER]:
+                del self.directory[message[ACCOUNT_NAME]]
+        elif message[ACTION] == BUS_ROUTE:
+            super().process_message(message[MESSAGE])
+        elif message[ACTION] == BUS_KEY_CHANGED:
+            self.database.invalidate_user(message[ACCOUNT_NAME])
+            super().public_key_changed(message[ACCOUNT_NAME], message[PUBLIC_KEY], message[LIST_INFO])
+
+    def process_message(self, message):
+        if message[DESTINATION] not in self.names and message[DESTINATION] in self.directory:
+            self.send_to_worker(self.directory[message[DESTINATION]], {ACTION: BUS_ROUTE, MESSAGE: message})
+            server_log.info(f'Route message to {message[DESTINATION]} from {message[SENDER]} '
+                            f'to worker {self.directory[message[DESTINATION]]}.')
+        else:
+            super().process_message(message)
+
+    def login_user(self, username, client, pubkey):
+        super().login_user(username, client, pubkey)
+        self.broadcast({ACTION: BUS_USER_ONLINE, ACCOUNT_NAME: username, WORKER: self.worker_index})
+
+    def public_key_changed(self, username, pubkey, owners):
+        super().public_key_changed(username, pubkey, owners)
+        # Only the owners who are online at the other workers
+        for index in list(self.links_outgoing):
+            names = [name for name in owners if self.directory.get(name) == index]
+            if names:
+                self.send_to_worker(index, {ACTION: BUS_KEY_CHANGED, ACCOUNT_NAME: username, PUBLIC_KEY: pubkey,
+                                            LIST_INFO: names})
+
+    def remove_client(self, client):
+        conn = self.connections.get(client)
+        username = conn.username if conn is not None and self.names.get(conn.username) is client else None
+        super().remove_client(client)
+        if username is not None:
+            self.broadcast({ACTION: BUS_USER_OFFLINE, ACCOUNT_NAME: username, WORKER: self.worker_index})
+
+
+def run_worker(worker_index, links, controls, listen_address, listen_port, database_path, outbound_policy,
+               database_profile, metrics_port):
+    """Worker process entry point"""
+    # Close the bus sockets of the other workers
+    for index, row in enumerate(links):
+        if index == worker_index:
+            continue
+        for link in row:
+            if link is not None:
+                link.close()
+    # and the control sockets except its own end, so the worker sees when the master is gone
+    for index, (master_end, worker_end) in enumerate(controls):
+        master_end.close()
+        if index != worker_index:
+            worker_end.close()
+
+    database = ServerStorage(database_path, profile=database_profile)
+    server = ShardedMessageProcessor(
+        listen_address, listen_port, database, outbound_policy, worker_index, links[worker_index],
+        controls[worker_index][1])
+
+    def stop(signum, frame):
+        server.running = False
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    server_log.info(f'Worker {worker_index} started, pid {os.getpid()}')
+    if metrics_port is not None:
+        MetricsServer(server, metrics_port + worker_index).start()
+    server.run()
+
+
+class ServerCluster:
+    """Starts and stops the worker processes of the multi-process server"""
+
+    def __init__(self, workers_count, listen_address, listen_port, database_path, outbound_policy=OUTBOUND_POLICY,
+                 database_profile=DB_PROFILE, metrics_port=None):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise RuntimeError('Multi-process server needs SO_REUSEPORT support')
+        self.workers_count = workers_count
+        self.listen_address = listen_address
+        self.listen_port = listen_port
+        self.database_path = database_path
+        self.outbound_policy = outbound_policy
+        self.database_profile = database_profile
+        # Worker N serves its metrics on metrics_port + N
+        self.metrics_port = metrics_port
+        self.processes = []
+        # Master ends of the control sockets of the workers
+        self.controls = []
+
+    def start(self):
+        # Create DB tables once, before workers connect to it
+        ServerStorage(self.database_path, profile=self.database_profile).engine.dispose()
+
+        # Bus: a socket pair for every two workers, links[i][j] is the end of worker i to worker j
+        links = [[None] * self.workers_count for _ in range(self.workers_count)]
+        for i in range(self.workers_count):
+            for j in range(i + 1, self.workers_count):
+                links[i][j], links[j][i] = socket.socketpair()
+        # Control: (master end, worker end) for every worker
+        controls = [socket.socketpair() for _ in range(self.workers_count)]
+
+        # Workers get the sockets by inheritance, so fork is needed
+        context = multiprocessing.get_context('fork')
+        for index in range(self.workers_count):
+            process = context.Process(
+                target=run_worker, name=f'server_worker_{index}',
+                args=(index, links, controls, self.listen_address, self.listen_port, self.database_path, self.outbound_policy,
+                      self.database_profile, self.metrics_port))
+            process.start()
+            self.processes.append(process)
+
+        for row in links:
+            for link in row:
+                if link is not None:
+                    link.close()
+        for master_end, worker_end in controls:
+            worker_end.close()
+        self.controls = [master_end for master_end, worker_end in controls]
+
+    def set_log_level(self, level):
+        """Change the log level of the workers, the level of the master is changed by the caller"""
+        data = encode_message({ACTION: BUS_LOG_LEVEL, DATA: level})
+        for index, control in enumerate(self.controls):
+            try:
+                control.sendall(data)
+            except OSError as err:
+                server_log.error(f'Log level is not sent to worker {index}: {err}')
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        for control in self.controls:
+            control.close()
+        self.controls = []
@@ -0,0 +1,51 @@
+from collections import deque
+
+from common.utils import FrameDecoder
+
+# Authorisation states of the connection
+WAIT_PRESENCE = 'wait_presence'
+WAIT_DIGEST = 'wait_digest'
+AUTHORISED = 'authorised'
+
+
+class Connection:
+    """Everything the server knows about one client connection"""
+    __slots__ = (
+        'sock', 'address', 'username', 'decoder', 'outbound', 'paused', 'pending', 'deferred', 'request_id',
+        'auth_state', 'auth_deadline', 'auth_username', 'auth_pubkey', 'auth_digest', 'auth_token',
+        'messages_in', 'messages_out', 'bytes_in', 'bytes_out',
+    )
+
+    def __init__(self, sock, address, outbound):
+        self.sock = sock
+        self.address = address
+        # Set after successful authorisation
+        self.username = None
+        # Receive and send buffers
+        self.decoder = FrameDecoder()
+        self.outbound = outbound
+        # Requests of the client are not read until it takes its data
+        self.paused = False
+        # Number of not finished DB calls and the requests waiting for them, so the replies keep the order
+        self.pending = 0
+        self.deferred = deque()
+        # Id of the request which is served now, the reply carries it
+        self.request_id = None
+
+        # Authorisation: state, time limit and data of the challenge
+        self.auth_state = WAIT_PRESENCE
+        self.auth_deadline = None
+        self.auth_username = None
+        self.auth_pubkey = None
+        self.auth_digest = None
+        # Resumption token which is sent with the login answer
+        self.auth_token = None
+
+        # Counters
+        self.messages_in = 0
+        self.messages_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def __repr__(self):
+        return f'<Connection {self.username or "-"} {self.address}>'
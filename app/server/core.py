@@ -1,16 +1,24 @@
 import hmac
 import os
 import binascii
-import select
+import selectors
 import sys
 import threading
+import time
 import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR
+from socket import socket, socketpair, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR
 
 from common.descriptors import Port
 from common.variables import *
-from common.utils import get_message, send_json_message
+from common.utils import encode_message
+from server.connection import Connection, WAIT_DIGEST, AUTHORISED
+from server.dispatcher import ActionDispatcher
+from server.metrics import ServerMetrics
+from server.outbound import OutboundBuffer
+from server.tokens import make_token, check_token
 
 sys.path.append(os.path.join(os.getcwd(), '..'))
 
@@ -20,183 +28,566 @@ server_log = logging.getLogger('server_log')
 class MessageProcessor(threading.Thread):
     port = Port()
 
-    def __init__(self, listen_address, listen_port, database):
+    def __init__(self, listen_address, listen_port, database, outbound_policy=OUTBOUND_POLICY):
         # Connection params
         self.address = listen_address
         self.port = listen_port
         self.database = database
 
-        self.receiver_sockets = None
-        self.listener_sockets = None
-        self.error_sockets = None
+        # Send buffers limits
+        if outbound_policy not in OUTBOUND_POLICIES:
+            raise ValueError(f'Unknown outbound policy {outbound_policy}')
+        self.outbound_policy = outbound_policy
+        self.high_watermark = OUTBOUND_HIGH_WATERMARK
+        self.low_watermark = OUTBOUND_LOW_WATERMARK
+        self.hard_limit = OUTBOUND_HARD_LIMIT
+
+        # Sockets events selector (epoll on Linux, kqueue on BSD/macOS)
+        self.selector = None
         # Server start/stop flag
         self.running = True
-        # List of connected clients
-        self.clients = []
-        # List of messages to send
-        self.messages = []
-        # Names/addresses relation dictionary
+        # Connected clients: socket -> Connection
+        self.connections = dict()
+        # Names/addresses relation dictionary: username -> socket (Connection.username is the reverse index)
         self.names = dict()
+        # (deadline, Connection) of the handshakes in the order of start, so the expired ones are at the left
+        self.handshake_deadlines = deque()
+        # Client requests handlers: action -> (validator, handler)
+        self.dispatcher = ActionDispatcher(self.names)
+        self.register_actions()
+        # DB thread: ServerStorage calls run there, the results come back to the loop through the wakeup socket
+        self.executor = None
+        self.completions = deque()
+        # Calls posted to the network loop by the other threads (GUI): (function, args)
+        self.loop_calls = deque()
+        # Message counters flush is queued in the DB thread
+        self.counters_flushing = False
+        self.wakeup_reader = None
+        self.wakeup_writer = None
+        # Counters and latency histograms, served by MetricsServer
+        self.metrics = ServerMetrics()
+        # Client requests left before the next timed one
+        self.timing_countdown = ACTION_TIMING_INTERVAL
 
         super().__init__()
 
     def init_socket(self):
         print(f'Server started on port {self.port}')
         print(f'Server accepts connections from address {self.address}')
+        raise_open_files_limit()
         # Socket initialization
         transport = socket(AF_INET, SOCK_STREAM)
-        transport.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        self.set_socket_options(transport)
         transport.bind((self.address, int(self.port)))
-        transport.settimeout(0.5)
+        transport.setblocking(False)
 
         self.sock = transport
-        self.sock.listen()
+        self.sock.listen(LISTEN_BACKLOG)
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+
+        self.wakeup_reader, self.wakeup_writer = socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ, self.process_completions)
+
+    def set_socket_options(self, transport):
+        transport.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
 
     def run(self):
+        # Session of ServerStorage is per thread, one DB thread keeps the calls in order
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='server_db')
         self.init_socket()
 
         while self.running:
+            # Timeout is needed only to check the stop flag, events are processed as soon as they come
+            self.poll(SERVER_POLL_TIMEOUT)
+
+        self.shutdown()
+
+    def poll(self, timeout):
+        """One iteration of the server loop: wait for the socket events and process them"""
+        try:
+            events = self.selector.select(timeout)
+        except OSError as err:
+            server_log.error(f'Something went wrong withing socket work: {err}')
+            return
+
+        for key, mask in events:
+            if key.fileobj is self.sock:
+                self.accept_clients()
+                continue
+            # Service sockets are registered with their own event handler
+            if key.data is not None:
+                key.data(key.fileobj, mask)
+                continue
+            client = key.fileobj
+            if mask & selectors.EVENT_WRITE:
+                self.flush_client(client)
+            if mask & selectors.EVENT_READ and client in self.connections:
+                self.read_client(client)
+        self.after_select()
+
+    def shutdown(self):
+        """Close the sockets and wait for the DB thread, called when the loop is stopped"""
+        self.selector.close()
+        self.sock.close()
+        self.executor.submit(self.database.flush_counters)
+        self.executor.submit(self.database.close_session)
+        self.executor.shutdown(wait=True)
+        self.wakeup_reader.close()
+        self.wakeup_writer.close()
+
+    def after_select(self):
+        """Called once per loop iteration after all events are processed"""
+        self.expire_handshakes()
+        if not self.counters_flushing and self.database.counters_due():
+            # Counters stay due until the DB thread writes them, so only one flush is queued at a time
+            self.counters_flushing = True
+            self.storage_submit(self.database.flush_counters).add_done_callback(
+                lambda future: self.call_soon(self.counters_flushed))
+
+    def counters_flushed(self):
+        self.counters_flushing = False
+
+    def expire_handshakes(self):
+        """Disconnect clients which did not finish authorisation in time"""
+        now = time.monotonic()
+        while self.handshake_deadlines and self.handshake_deadlines[0][0] <= now:
+            deadline, conn = self.handshake_deadlines.popleft()
+            if conn.auth_state != AUTHORISED and conn.sock in self.connections:
+                server_log.info(f'Client {conn} did not authorise in time, disconnecting')
+                self.remove_client(conn.sock)
+
+    def accept_clients(self):
+        """Accept all connections waiting in the listen queue"""
+        while True:
             try:
                 client, client_address = self.sock.accept()
-            except OSError:
-                pass
-            else:
-                server_log.info(f'Client with address {client_address} connected')
-                self.clients.append(client)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as err:
+                server_log.error(f'Cannot accept connection: {err}')
+                return
+            server_log.info(f'Client with address {client_address} connected')
+            self.metrics.connections += 1
+            client.setblocking(False)
+            conn = Connection(
+                client, client_address,
+                OutboundBuffer(self.high_watermark, spill=self.outbound_policy == 'spill'))
+            self.connections[client] = conn
+            self.selector.register(client, selectors.EVENT_READ)
+            conn.auth_deadline = time.monotonic() + AUTH_TIMEOUT
+            self.handshake_deadlines.append((conn.auth_deadline, conn))
+
+    def read_client(self, client):
+        """Receive data from the client and process every complete message, if error disconnect user"""
+        try:
+            data = client.recv(RECV_BUFFER_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = None
+        conn = self.connections[client]
+        if not data:
+            server_log.info(f'Client {conn} was disconnected from the server')
+            self.remove_client(client)
+            return
+
+        conn.bytes_in += len(data)
+        self.metrics.bytes_in += len(data)
+        conn.decoder.feed(data)
+        try:
+            for message in conn.decoder.messages():
+                conn.messages_in += 1
+                if conn.pending:
+                    conn.deferred.append(message)
+                else:
+                    self.handle_message(conn, message)
+                if client not in self.connections:
+                    return
+        except ValueError as err:
+            server_log.error(f'Incorrect data from client {client}: {err}')
+            self.remove_client(client)
+            return
+        if conn.deferred:
+            self.update_events(conn)
+
+    def handle_message(self, conn, message):
+        if conn.auth_state == AUTHORISED:
+            conn.request_id = message.get(REQUEST_ID)
+            self.process_client_message(message, conn.sock)
+        else:
+            self.process_handshake_message(message, conn.sock)
+
+    def storage_submit(self, func, *args):
+        """Run the ServerStorage call in the DB thread, the loop does not wait for the result. Returns the Future."""
+        return self.executor.submit(self.timed_storage_call, func, *args)
+
+    def storage_call(self, client, callback, func, *args):
+        """
+        Run the ServerStorage call in the DB thread and then callback(result) in the network loop.
+        Requests of the client which come meanwhile wait for it, so the replies keep the order of the requests.
+        """
+        self.connections[client].pending += 1
+        future = self.executor.submit(self.timed_storage_call, func, *args)
+        future.add_done_callback(lambda future: self.complete(client, callback, future))
+
+    def timed_storage_call(self, func, *args):
+        """Called in the DB thread: make the call and record its time"""
+        start = time.perf_counter_ns()
+        try:
+            return func(*args)
+        finally:
+            self.metrics.db_time.record((time.perf_counter_ns() - start) // 1000)
+
+    def complete(self, client, callback, future):
+        """Called in the DB thread: pass the finished call to the network loop"""
+        self.completions.append((client, callback, future))
+        self.wakeup()
+
+    def call_soon(self, func, *args):
+        """Run func(*args) in the network loop. Other threads must not touch the clients and their buffers."""
+        self.loop_calls.append((func, args))
+        self.wakeup()
+
+    def wakeup(self):
+        try:
+            self.wakeup_writer.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            # The loop is woken up already
+            pass
 
-            # Check for waiting users
+    def process_completions(self, sock, mask):
+        """Run the callbacks of the finished DB calls and the calls posted by the other threads"""
+        try:
+            sock.recv(RECV_BUFFER_SIZE)
+        except (BlockingIOError, InterruptedError):
+            pass
+        while self.loop_calls:
+            func, args = self.loop_calls.popleft()
             try:
-                if self.clients:
-                    self.receiver_sockets, self.listener_sockets, self.error_sockets = select.select(
-                        self.clients, self.clients, [], 0)
-            except OSError as err:
-                server_log.error(f'Something went wrong withing socket work: {err}')
+                func(*args)
+            except Exception as err:
+                server_log.error(f'Error in the call {func}: {err}', exc_info=err)
+        while self.completions:
+            client, callback, future = self.completions.popleft()
+            conn = self.connections.get(client)
+            if conn is None:
+                continue
+            conn.pending -= 1
+            try:
+                result = future.result()
+            except Exception as err:
+                server_log.error(f'Database error while serving {conn}: {err}')
+                response = RESPONSE_400
+                response[ERROR] = 'Server error'
+                self.reply(client, response)
+            else:
+                # One bad callback must not stop the loop of all the clients
+                try:
+                    callback(result)
+                except Exception as err:
+                    server_log.error(f'Error while serving {conn}: {err}', exc_info=err)
+                    response = RESPONSE_400
+                    response[ERROR] = 'Server error'
+                    self.reply(client, response)
+            if client in self.connections and not conn.pending:
+                self.process_deferred(conn)
+
+    def process_deferred(self, conn):
+        """Process the requests which were waiting for the DB calls"""
+        while conn.deferred and not conn.pending:
+            self.handle_message(conn, conn.deferred.popleft())
+            if conn.sock not in self.connections:
+                return
+        self.update_events(conn)
 
-            # Receive messages, if error disconnect user
-            if self.receiver_sockets:
-                for client_with_message in self.receiver_sockets:
-                    try:
-                        self.process_client_message(get_message(client_with_message), client_with_message)
-                    except OSError:
-                        server_log.info(f'Client {client_with_message.getpeername()} was disconnected from the server')
-                        self.remove_client(client_with_message)
+    def flush_client(self, client):
+        """Send as much pending data as the client socket accepts"""
+        conn = self.connections.get(client)
+        if conn is None:
+            return
+        try:
+            sent = conn.outbound.send(client)
+            conn.bytes_out += sent
+            self.metrics.bytes_out += sent
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            self.remove_client(client)
+            return
+
+        if conn.paused and len(conn.outbound) <= self.low_watermark:
+            server_log.info(f'Client {conn} took its data, reading it again')
+            conn.paused = False
+        self.update_events(conn)
+
+    def update_events(self, conn):
+        """Read events are watched while the client is not paused,
+        write events - only while there is something to send"""
+        events = 0
+        if not conn.paused and not conn.deferred:
+            events |= selectors.EVENT_READ
+        if conn.outbound:
+            events |= selectors.EVENT_WRITE
+        if self.selector.get_key(conn.sock).events != events:
+            self.selector.modify(conn.sock, events)
+
+    def check_outbound(self, conn):
+        """Apply the overflow policy to the client which does not take its data"""
+        queue_size = len(conn.outbound)
+        if queue_size <= self.high_watermark:
+            return
+        if self.outbound_policy == 'drop' or queue_size > self.hard_limit:
+            server_log.warning(f'Client {conn} send queue overflow ({queue_size} bytes), disconnecting')
+            self.remove_client(conn.sock)
+        elif self.outbound_policy == 'pause' and not conn.paused:
+            server_log.warning(f'Client {conn} is slow ({queue_size} bytes in send queue), pause reading it')
+            conn.paused = True
+            self.update_events(conn)
+
+    def queue_depth(self, username):
+        """Size of the not sent data of the user"""
+        conn = self.connections.get(self.names.get(username))
+        if conn is not None:
+            return len(conn.outbound)
+        return 0
+
+    def queue_depths(self):
+        """Send queue sizes of all logged in users, the slowest first"""
+        depths = [(username, self.queue_depth(username)) for username in list(self.names)]
+        return sorted(depths, key=lambda item: item[1], reverse=True)
 
     def remove_client(self, client):
-        for name in self.names:
-            if self.names[name] == client:
-                self.database.user_logout(name)
-                del self.names[name]
-                break
-        self.clients.remove(client)
+        conn = self.connections.pop(client, None)
+        if conn is not None:
+            if conn.username is not None and self.names.get(conn.username) is client:
+                del self.names[conn.username]
+                self.storage_submit(self.database.user_logout, conn.username)
+            conn.outbound.close()
+            self.selector.unregister(client)
         client.close()
 
     def try_send_msg_or_close(self, client, response):
-        try:
-            send_json_message(client, response)
-        except OSError:
-            self.remove_client(client)
+        """Put the message into the client send buffer and try to send it at once"""
+        conn = self.connections.get(client)
+        if conn is None:
+            return
+        conn.outbound.append(encode_message(response))
+        conn.messages_out += 1
+        self.metrics.queue_depth.record(len(conn.outbound))
+        self.flush_client(client)
+        if client in self.connections:
+            self.check_outbound(conn)
+
+    def reply(self, client, response):
+        """Answer the request of the client which is served now, the answer carries the id of the request"""
+        conn = self.connections.get(client)
+        if conn is not None and conn.request_id is not None:
+            response = dict(response)
+            response[REQUEST_ID] = conn.request_id
+        self.try_send_msg_or_close(client, response)
+
+    def is_online(self, username):
+        """Check if the user is connected to the server"""
+        return username in self.names
 
     def process_message(self, message):
         """Process the message to the client. Got message dict, registered users, and sockets."""
 
-        if message[DESTINATION] in self.names and self.names[message[DESTINATION]] in self.listener_sockets:
-            try:
-                send_json_message(self.names[message[DESTINATION]], message)
-                server_log.info(f'Send message to {message[DESTINATION]} from {message[SENDER]}.')
-            except OSError:
-                self.remove_client(message[DESTINATION])
-
-        elif message[DESTINATION] in self.names and self.names[message[DESTINATION]] not in self.listener_sockets:
-            server_log.error(f'Connection with client {message[DESTINATION]} was lost. Delivery is impossible.')
-            self.remove_client(self.names[message[DESTINATION]])
+        if message[DESTINATION] in self.names:
+            self.try_send_msg_or_close(self.names[message[DESTINATION]], message)
+            self.metrics.messages_routed += 1
+            server_log.info(f'Send message to {message[DESTINATION]} from {message[SENDER]}.')
         else:
             server_log.error(f'Client {message[DESTINATION]} is not registered at the server. '
                 f'The message cannot be send.')
 
     # todo implement decorator @login required later
+    def register_actions(self):
+        """Fill the dispatch table with the handlers of the client requests"""
+        self.dispatcher.register(PRESENCE, self.action_presence, (TIME, USER))
+        self.dispatcher.register(MESSAGE, self.action_message, (DESTINATION, TIME, MESSAGE_TEXT), owner=SENDER,
+                                 strings=(DESTINATION,))
+        self.dispatcher.register(EXIT, self.action_exit, owner=ACCOUNT_NAME)
+        self.dispatcher.register(GET_CONTACTS, self.action_get_contacts, owner=USER)
+        self.dispatcher.register(ADD_CONTACT, self.action_add_contact, (ACCOUNT_NAME,), owner=USER,
+                                 strings=(ACCOUNT_NAME,))
+        self.dispatcher.register(REMOVE_CONTACT, self.action_remove_contact, (ACCOUNT_NAME,), owner=USER,
+                                 strings=(ACCOUNT_NAME,))
+        self.dispatcher.register(USERS_REQUEST, self.action_users_request, owner=ACCOUNT_NAME)
+        self.dispatcher.register(PUBLIC_KEY_REQUEST, self.action_public_key_request, (ACCOUNT_NAME,))
+        self.dispatcher.register(SYNC, self.action_sync, (SINCE,), owner=USER)
+        self.dispatcher.register(USERS_SEARCH, self.action_users_search, (PREFIX,), owner=ACCOUNT_NAME)
+
     def process_client_message(self, message, client):
-        """Get messages from clients, check them and send response"""
-        # global new_connection
+        """
+        Get messages from clients, check them and send response.
+        The caller sets the request id of the connection. Only every ACTION_TIMING_INTERVAL-th request is timed,
+        the clock and the histogram would cost more than the dispatch of the request.
+        """
+        self.timing_countdown -= 1
+        if self.timing_countdown:
+            handled = self.dispatcher.dispatch(message, client)
+        else:
+            self.timing_countdown = ACTION_TIMING_INTERVAL
+            start = time.perf_counter_ns()
+            handled = self.dispatcher.dispatch(message, client)
+            if handled:
+                self.metrics.action_time(message[ACTION], (time.perf_counter_ns() - start) // 1000)
+        if not handled:
+            response = RESPONSE_400
+            response[ERROR] = 'Bad request'
+            self.reply(client, response)
+
+    def action_presence(self, message, client):
+        # Authorisation is done before, see process_handshake_message
+        response = RESPONSE_400
+        response[ERROR] = 'Already authorised'
+        self.reply(client, response)
+
+    def action_message(self, message, client):
+        """If the command is message send this message"""
+        if self.is_online(message[DESTINATION]):
+            self.storage_submit(self.database.process_message, message[SENDER], message[DESTINATION])
+            self.process_message(message)
+            response = RESPONSE_200
+            self.reply(client, response)
+        else:
+            response = RESPONSE_400
+            response[ERROR] = 'User did not registered on server'
+            self.reply(client, response)
 
-        if ACTION in message and message[ACTION] == PRESENCE and TIME in message and USER in message:
-            # Check if such user exists. If not - register, else send answer
-            self.authorize_user(message, client)
-        # If the command is message send this message
-        elif ACTION in message and message[ACTION] == MESSAGE and \
-                DESTINATION in message and TIME in message and \
-                SENDER in message and MESSAGE_TEXT in message and \
-                self.names[message[SENDER]] == client:
-            if message[DESTINATION] in self.names:
-                self.database.process_message(message[SENDER], message[DESTINATION])
-                self.process_message(message)
-                response = RESPONSE_200
-                self.try_send_msg_or_close(client, response)
-            else:
-                response = RESPONSE_400
-                response[ERROR] = 'User did not registered on server'
-                try:
-                    send_json_message(client, response)
-                except OSError:
-                    pass
-            return
+    def action_exit(self, message, client):
+        """Client leave the chat"""
+        self.remove_client(client)
 
-        # Client leave the chat
-        elif ACTION in message and message[ACTION] == EXIT and ACCOUNT_NAME in message and\
-                self.names[message[ACCOUNT_NAME]] == client:
-            self.remove_client(client)
-        
-        # Request for contacts list
-        elif ACTION in message and message[ACTION] == GET_CONTACTS and USER in message and \
-                self.names[message[USER]] == client:
+    def action_get_contacts(self, message, client):
+        """Request for contacts list"""
+        def reply(contacts):
             response = RESPONSE_202
-            response[LIST_INFO] = self.database.get_contacts(message[USER])
-            self.try_send_msg_or_close(client, response)
+            response[LIST_INFO] = contacts
+            self.reply(client, response)
 
-        # Request for Add contact
-        elif ACTION in message and message[ACTION] == ADD_CONTACT and ACCOUNT_NAME in message and USER in message \
-                and self.names[message[USER]] == client:
-            self.database.add_contact(message[USER], message[ACCOUNT_NAME])
-            response = RESPONSE_200
-            self.try_send_msg_or_close(client, response)
+        self.storage_call(client, reply, self.database.get_contacts, message[USER])
 
-        # Request for Remove contact
-        elif ACTION in message and message[ACTION] == REMOVE_CONTACT and ACCOUNT_NAME in message and USER in message \
-                and self.names[message[USER]] == client:
-            self.database.remove_contact(message[USER], message[ACCOUNT_NAME])
-            response = RESPONSE_200
-            self.try_send_msg_or_close(client, response)
+    def action_add_contact(self, message, client):
+        """Request for Add contact"""
+        self.storage_call(client, lambda result: self.reply(client, RESPONSE_200),
+                          self.database.add_contact, message[USER], message[ACCOUNT_NAME])
 
-        # Request for Registered users
-        elif ACTION in message and message[ACTION] == USERS_REQUEST and ACCOUNT_NAME in message \
-                and self.names[message[ACCOUNT_NAME]] == client:
-            response = RESPONSE_202
-            response[LIST_INFO] = [user[0] for user in self.database.users_list()]
-            self.try_send_msg_or_close(client, response)
+    def action_remove_contact(self, message, client):
+        """Request for Remove contact"""
+        self.storage_call(client, lambda result: self.reply(client, RESPONSE_200),
+                          self.database.remove_contact, message[USER], message[ACCOUNT_NAME])
 
-        # If it's a public key request
-        elif ACTION in message and message[ACTION] == PUBLIC_KEY_REQUEST and ACCOUNT_NAME in message:
-            response = RESPONSE_511
-            response[DATA] = self.database.get_pubkey(message[ACCOUNT_NAME])
+    def action_users_request(self, message, client):
+        """Request for Registered users"""
+        def reply(users):
+            response = RESPONSE_202
+            response[LIST_INFO] = [user[0] for user in users]
+            self.reply(client, response)
+
+        self.storage_call(client, reply, self.database.users_list)
+
+    def action_users_search(self, message, client):
+        """Page of the users found by the name prefix"""
+        def reply(result):
+            response = dict(RESPONSE_202)
+            response[LIST_INFO], response[CURSOR] = result
+            self.reply(client, response)
+
+        prefix = message[PREFIX] if isinstance(message[PREFIX], str) else ''
+        cursor = message.get(CURSOR) if isinstance(message.get(CURSOR), str) else None
+        limit = message.get(LIMIT) if isinstance(message.get(LIMIT), int) else SEARCH_LIMIT
+        limit = max(1, min(limit, SEARCH_MAX_LIMIT))
+        self.storage_call(client, reply, self.database.search_users, prefix, cursor, limit)
+
+    def action_public_key_request(self, message, client):
+        """If it's a public key request, ACCOUNT_NAME is a name or a list of names"""
+        if isinstance(message[ACCOUNT_NAME], list):
+            self.public_keys_request(message[ACCOUNT_NAME], client)
+            return
 
-            if response[DATA]:
-                self.try_send_msg_or_close(client, response)
+        def reply(pubkey):
+            if pubkey:
+                response = RESPONSE_511
+                response[DATA] = pubkey
             else:
                 response = RESPONSE_400
                 response[ERROR] = 'There is not pub key for this user'
-                self.try_send_msg_or_close(client, response)
-        else:
+            self.reply(client, response)
+
+        self.storage_call(client, reply, self.database.get_pubkey, message[ACCOUNT_NAME])
+
+    def public_keys_request(self, usernames, client):
+        """Bulk public keys request, the answer has the dict username -> key of the users who have a key"""
+        def reply(keys):
+            response = dict(RESPONSE_202)
+            response[LIST_INFO] = keys
+            self.reply(client, response)
+
+        if len(usernames) > PUBLIC_KEYS_LIMIT or not all(isinstance(name, str) for name in usernames):
             response = RESPONSE_400
             response[ERROR] = 'Bad request'
+            self.reply(client, response)
+            return
+        self.storage_call(client, reply, self.database.get_pubkeys, usernames)
+
+    def action_sync(self, message, client):
+        """Changes of the users and contacts lists since the version the client has"""
+        def reply(changes):
+            response = RESPONSE_202
+            response[LIST_INFO] = changes
+            self.reply(client, response)
+
+        since = message[SINCE] if isinstance(message[SINCE], int) else 0
+        self.storage_call(client, reply, self.database.get_changes, message[USER], since)
+
+    def process_handshake_message(self, message, client):
+        """Messages of not authorised clients: PRESENCE and then the answer for the challenge"""
+        if self.connections[client].auth_state == WAIT_DIGEST:
+            self.check_auth_answer(message, client)
+        elif ACTION in message and message[ACTION] == PRESENCE and TIME in message and USER in message:
+            self.authorize_user(message, client)
+        elif ACTION in message and message[ACTION] == RESUME and USER in message and TOKEN in message:
+            self.resume_user(message, client)
+        else:
+            response = RESPONSE_400
+            response[ERROR] = 'Authorisation required'
             self.try_send_msg_or_close(client, response)
 
+    def check_presence(self, message, client):
+        """PRESENCE must have the name and the public key of the user, otherwise the client is dropped"""
+        user = message[USER]
+        if isinstance(user, dict) and isinstance(user.get(ACCOUNT_NAME), str) and \
+                isinstance(user.get(PUBLIC_KEY), str):
+            return True
+        server_log.error(f'Incorrect presence message from {client}: {user}')
+        response = RESPONSE_400
+        response[ERROR] = 'Bad request'
+        self.try_send_msg_or_close(client, response)
+        self.remove_client(client)
+        return False
+
     def authorize_user(self, message, client):
+        """Start authorisation: send the challenge, the answer comes with the next message of the client"""
+        if not self.check_presence(message, client):
+            return
         server_log.debug(f'Start auth process for {message[USER]}')
-        if message[USER][ACCOUNT_NAME] in self.names.keys():
+        if self.is_online(message[USER][ACCOUNT_NAME]):
             response = RESPONSE_400
             response[ERROR] = 'User with such name already exists.'
             server_log.error('User with such name already exists.')
             self.try_send_msg_or_close(client, response)
-        elif not self.database.check_user(message[USER][ACCOUNT_NAME]):
+        else:
+            self.storage_call(client, lambda user: self.send_challenge(message, client, user),
+                              self.database.get_user, message[USER][ACCOUNT_NAME])
+
+    def send_challenge(self, message, client, user):
+        if user is None:
             response = RESPONSE_400
             response[ERROR] = 'There is no user with such name.'
             server_log.error('There is no user with such name.')
@@ -206,45 +597,126 @@ class MessageProcessor(threading.Thread):
             message_auth = RESPONSE_511
             random_str = binascii.hexlify(os.urandom(64))
             message_auth[DATA] = random_str.decode('ascii')
-            hash = hmac.new(self.database.get_hash(message[USER][ACCOUNT_NAME]), random_str, 'MD5')
-            digest = hash.digest()
+            hash = hmac.new(user.password_hash, random_str, 'MD5')
             server_log.debug(f'Auth message: {message_auth}')
-            try:
-                send_json_message(client, message_auth)
-                ans = get_message(client)
-            except OSError as err:
-                server_log.debug('Error in auth, data:', exc_info=err)
-                client.close()
-                return
+            conn = self.connections[client]
+            conn.auth_state = WAIT_DIGEST
+            conn.auth_username = message[USER][ACCOUNT_NAME]
+            conn.auth_pubkey = message[USER][PUBLIC_KEY]
+            conn.auth_digest = hash.digest()
+            conn.auth_token = make_token(user.password_hash, conn.auth_username)
+            self.try_send_msg_or_close(client, message_auth)
+
+    def resume_user(self, message, client):
+        """Login by the resumption token in one round trip: no challenge and no public key upload"""
+        username = message[USER].get(ACCOUNT_NAME) if isinstance(message[USER], dict) else None
+        if not isinstance(username, str):
+            username = None
+        if self.is_online(username):
+            response = RESPONSE_400
+            response[ERROR] = 'User with such name already exists.'
+            self.try_send_msg_or_close(client, response)
+        else:
+            self.storage_call(client, lambda user: self.check_resume_token(message[TOKEN], client, username, user),
+                              self.database.get_user, username)
 
+    def check_resume_token(self, token, client, username, user):
+        if user is None or not check_token(user.password_hash, username, token):
+            # The client can still log in with the password on this connection
+            response = RESPONSE_400
+            response[ERROR] = 'Session expired'
+            self.try_send_msg_or_close(client, response)
+        elif self.is_online(username):
+            response = RESPONSE_400
+            response[ERROR] = 'User with such name already exists.'
+            self.try_send_msg_or_close(client, response)
+        else:
+            server_log.debug(f'Session of {username} is resumed')
+            self.connections[client].auth_token = make_token(user.password_hash, username)
+            self.login_user(username, client, user.pub_key)
+
+    def check_auth_answer(self, ans, client):
+        """Finish authorisation: compare the client digest with the expected one"""
+        conn = self.connections[client]
+        try:
             client_digest = binascii.a2b_base64(ans[DATA])
-            if RESPONSE in ans and ans[RESPONSE] == 511 and \
-                    hmac.compare_digest(digest, client_digest):
-                self.names[message[USER][ACCOUNT_NAME]] = client
-                client_ip, client_port = client.getpeername()
-                try:
-                    send_json_message(client, RESPONSE_200)
-                except OSError:
-                    self.remove_client(message[USER][ACCOUNT_NAME])
-
-                self.database.user_login(
-                    message[USER][ACCOUNT_NAME],
-                    client_ip,
-                    client_port,
-                    message[USER][PUBLIC_KEY])
-            else:
+        except (KeyError, TypeError, binascii.Error):
+            client_digest = b''
+        if RESPONSE in ans and ans[RESPONSE] == 511 and \
+                hmac.compare_digest(conn.auth_digest, client_digest):
+            if self.is_online(conn.auth_username):
                 response = RESPONSE_400
-                response[ERROR] = 'Wrong password'
-                try:
-                    send_json_message(client, response)
-                except OSError:
-                    pass
-                self.clients.remove(client)
-                client.close()
+                response[ERROR] = 'User with such name already exists.'
+                self.try_send_msg_or_close(client, response)
+                self.remove_client(client)
+                return
+            self.login_user(conn.auth_username, client, conn.auth_pubkey)
+        else:
+            response = RESPONSE_400
+            response[ERROR] = 'Wrong password'
+            self.try_send_msg_or_close(client, response)
+            self.remove_client(client)
+
+    def login_user(self, username, client, pubkey):
+        conn = self.connections[client]
+        conn.auth_state = AUTHORISED
+        conn.auth_digest = None
+        conn.username = username
+        self.names[username] = client
+        self.metrics.logins += 1
+        client_ip, client_port = conn.address
+        response = dict(RESPONSE_200)
+        response[TOKEN], conn.auth_token = conn.auth_token, None
+        self.try_send_msg_or_close(client, response)
+
+        def logged_in(key_changed):
+            if key_changed:
+                self.storage_call(client, lambda owners: self.public_key_changed(username, pubkey, owners),
+                                  self.database.contact_owners, username)
+
+        self.storage_call(client, logged_in, self.database.user_login, username, client_ip, client_port, pubkey)
+
+    def public_key_changed(self, username, pubkey, owners):
+        """Tell the online users who have the user in contacts its new key, so they replace the cached one"""
+        server_log.info(f'Public key of {username} is changed')
+        message = {
+            ACTION: PUBLIC_KEY_CHANGED,
+            ACCOUNT_NAME: username,
+            PUBLIC_KEY: pubkey
+        }
+        for name in owners:
+            if name in self.names and name != username:
+                self.try_send_msg_or_close(self.names[name], message)
 
     def service_update_lists(self):
-        for client in self.names:
-            try:
-                send_json_message(self.names[client], RESPONSE_205)
-            except OSError:
-                self.remove_client(self.names[client])
+        """Called by the GUI thread when the users list is changed"""
+        self.call_soon(self.update_lists)
+
+    def service_remove_user(self, username):
+        """Called by the GUI thread when the user is removed"""
+        self.call_soon(self.disconnect_user, username)
+
+    def disconnect_user(self, username):
+        if username in self.names:
+            self.remove_client(self.names[username])
+
+    def update_lists(self):
+        """Tell the clients the lists are changed, they ask only for the changes after their version"""
+        response = RESPONSE_205
+        response[VERSION] = self.database.version
+        for client in list(self.names.values()):
+            self.try_send_msg_or_close(client, response)
+
+
+def raise_open_files_limit():
+    """Allow the process to keep as many client sockets as the hard limit permits"""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            server_log.warning(f'Cannot raise open files limit {soft}')
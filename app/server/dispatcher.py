@@ -0,0 +1,63 @@
+import logging
+
+from common.variables import ACTION
+
+server_log = logging.getLogger('server_log')
+
+
+def make_validator(required, owner, names, strings=()):
+    """
+    Check of the request: all required fields are present, the fields of strings are str and,
+    if owner is set, the user in the owner field is logged in on this connection.
+    """
+    required = tuple(dict.fromkeys(required))
+    strings = tuple(strings)
+
+    def validator(message, client):
+        for field in required:
+            if field not in message:
+                return False
+        for field in strings:
+            if not isinstance(message[field], str):
+                return False
+        if owner is None:
+            return True
+        # A list or a dict from the client is not a name and cannot be looked up
+        username = message.get(owner)
+        return isinstance(username, str) and names.get(username) is client
+
+    return validator
+
+
+class ActionDispatcher:
+    """
+    Table of the JIM actions: action -> (validator, handler).
+    Dispatch is one dictionary lookup and one check, new actions are added by register().
+    """
+
+    def __init__(self, names):
+        # Logged in users: username -> socket, used by the owner checks
+        self.names = names
+        self.actions = dict()
+
+    def register(self, action, handler, required=(), owner=None, strings=()):
+        """
+        Add the handler of the action. handler(message, client) is called for valid requests.
+        required - fields the request must have, owner - field with the name of the requesting user,
+        strings - required fields which must be strings (names used as keys by the handler).
+        """
+        self.actions[action] = (make_validator(required, owner, self.names, strings), handler)
+
+    def unregister(self, action):
+        self.actions.pop(action, None)
+
+    def dispatch(self, message, client):
+        """Call the handler of the request, returns False if the request is unknown or not valid"""
+        try:
+            entry = self.actions.get(message.get(ACTION))
+        except TypeError:
+            return False
+        if entry is not None and entry[0](message, client):
+            entry[1](message, client)
+            return True
+        return False
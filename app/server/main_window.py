@@ -85,9 +85,12 @@ class MainWindow(QMainWindow):
         list_users = self.database.active_users_list()
         list = QStandardItemModel()
         list.setHorizontalHeaderLabels(
-            ['User name', 'IP Address', 'Port', 'Connection time'])
+            ['User name', 'IP Address', 'Port', 'Connection time', 'Send queue'])
         for row in list_users:
             user, ip, port, time = row
+            # Not sent bytes, big value means the client is too slow
+            queue = QStandardItem(str(self.server_thread.queue_depth(user)))
+            queue.setEditable(False)
             user = QStandardItem(user)
             user.setEditable(False)
             ip = QStandardItem(ip)
@@ -96,7 +99,7 @@ class MainWindow(QMainWindow):
             port.setEditable(False)
             time = QStandardItem(str(time.replace(microsecond=0)))
             time.setEditable(False)
-            list.appendRow([user, ip, port, time])
+            list.appendRow([user, ip, port, time, queue])
         self.active_clients_table.setModel(list)
         self.active_clients_table.resizeColumnsToContents()
         self.active_clients_table.resizeRowsToContents()
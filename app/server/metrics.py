@@ -0,0 +1,163 @@
+"""
+Server metrics: counters and latency histograms served in Prometheus text format.
+Every counter and histogram is changed by one thread only (the network loop or the DB thread),
+so they are plain numbers without locks, the metrics thread only reads them.
+"""
+import logging
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from common.variables import HISTOGRAM_PRECISION_BITS, HISTOGRAM_MAX_VALUE, METRICS_QUANTILES, ENCODING
+
+server_log = logging.getLogger('server_log')
+
+
+class Histogram:
+    """
+    HDR-style histogram of integer values: values below 2 ** precision_bits have their own buckets,
+    bigger ones are rounded down to precision_bits significant bits, so the relative error is constant.
+    Recording is an index computation and a list item increment.
+    """
+
+    def __init__(self, precision_bits=HISTOGRAM_PRECISION_BITS, max_value=HISTOGRAM_MAX_VALUE):
+        self.precision_bits = precision_bits
+        self.max_value = max_value
+        self.counts = [0] * (self.index(max_value) + 1)
+        self.count = 0
+        self.total = 0
+
+    def index(self, value):
+        shift = value.bit_length() - self.precision_bits
+        if shift <= 0:
+            return value
+        return (shift << (self.precision_bits - 1)) + (value >> shift)
+
+    def bucket_limit(self, index):
+        """Biggest value of the bucket"""
+        half = 1 << (self.precision_bits - 1)
+        if index < 2 * half:
+            return index
+        shift = index // half - 1
+        return ((index - shift * half + 1) << shift) - 1
+
+    def record(self, value):
+        if value > self.max_value:
+            value = self.max_value
+        self.counts[self.index(value)] += 1
+        self.count += 1
+        self.total += value
+
+    def quantile(self, q):
+        """Value which q of the recorded values do not exceed, with the precision of the bucket"""
+        count = self.count
+        if not count:
+            return 0
+        rank = max(1, round(q * count))
+        seen = 0
+        for index, bucket in enumerate(self.counts):
+            seen += bucket
+            if seen >= rank:
+                return self.bucket_limit(index)
+        return self.max_value
+
+
+class ServerMetrics:
+    """Counters and histograms of one server, times are recorded in microseconds"""
+
+    def __init__(self):
+        # Accepted connections and successful logins
+        self.connections = 0
+        self.logins = 0
+        # Messages passed to their recipients
+        self.messages_routed = 0
+        # Traffic of the client connections, bytes
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # Request handling time: action -> Histogram
+        self.actions = dict()
+        # ServerStorage calls time
+        self.db_time = Histogram()
+        # Client send buffer size after a message is put into it, bytes
+        self.queue_depth = Histogram()
+
+    def action_time(self, action, time_us):
+        histogram = self.actions.get(action)
+        if histogram is None:
+            histogram = self.actions[action] = Histogram()
+        histogram.record(time_us)
+
+    def render(self, server):
+        """Metrics of the server in Prometheus text exposition format"""
+        lines = []
+        add_metric(lines, 'messenger_connections_total', 'counter', 'Accepted connections', self.connections)
+        add_metric(lines, 'messenger_logins_total', 'counter', 'Successful logins', self.logins)
+        add_metric(lines, 'messenger_messages_routed_total', 'counter', 'Messages sent to the recipients',
+                   self.messages_routed)
+        add_metric(lines, 'messenger_received_bytes_total', 'counter', 'Bytes received from the clients',
+                   self.bytes_in)
+        add_metric(lines, 'messenger_sent_bytes_total', 'counter', 'Bytes sent to the clients', self.bytes_out)
+        add_metric(lines, 'messenger_connections_open', 'gauge', 'Open client connections', len(server.connections))
+        add_metric(lines, 'messenger_users_online', 'gauge', 'Logged in users', len(server.names))
+        add_metric(lines, 'messenger_outbound_queued_bytes', 'gauge', 'Not sent data of the logged in users',
+                   sum(depth for username, depth in server.queue_depths()))
+
+        lines.append('# HELP messenger_action_seconds Request handling time of the sampled requests')
+        lines.append('# TYPE messenger_action_seconds summary')
+        for action, histogram in sorted(dict(self.actions).items()):
+            add_summary(lines, 'messenger_action_seconds', histogram, 1e-6, f'action="{action}"')
+        lines.append('# HELP messenger_db_call_seconds Database call time')
+        lines.append('# TYPE messenger_db_call_seconds summary')
+        add_summary(lines, 'messenger_db_call_seconds', self.db_time, 1e-6)
+        lines.append('# HELP messenger_outbound_queue_bytes Client send buffer size after a message is queued')
+        lines.append('# TYPE messenger_outbound_queue_bytes summary')
+        add_summary(lines, 'messenger_outbound_queue_bytes', self.queue_depth, 1)
+        return '\n'.join(lines) + '\n'
+
+
+def add_metric(lines, name, metric_type, description, value):
+    lines.append(f'# HELP {name} {description}')
+    lines.append(f'# TYPE {name} {metric_type}')
+    lines.append(f'{name} {value}')
+
+
+def add_summary(lines, name, histogram, scale, labels=''):
+    """Quantiles, sum and count of the histogram, values are multiplied by scale"""
+    separator = ',' if labels else ''
+    for q in METRICS_QUANTILES:
+        lines.append(f'{name}{{{labels}{separator}quantile="{q}"}} {histogram.quantile(q) * scale:g}')
+    labels = f'{{{labels}}}' if labels else ''
+    lines.append(f'{name}_sum{labels} {histogram.total * scale:g}')
+    lines.append(f'{name}_count{labels} {histogram.count}')
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.processor.metrics.render(self.server.processor).encode(ENCODING)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        server_log.debug(f'Metrics request from {self.address_string()}: {format % args}')
+
+
+class MetricsServer(threading.Thread):
+    """HTTP listener of /metrics, it only reads the metrics of the server"""
+
+    def __init__(self, processor, port, address='127.0.0.1'):
+        super().__init__(name='metrics', daemon=True)
+        self.httpd = HTTPServer((address, port), MetricsHandler)
+        self.httpd.processor = processor
+
+    def run(self):
+        server_log.info(f'Metrics are served on port {self.httpd.server_address[1]}')
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
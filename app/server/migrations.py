@@ -0,0 +1,115 @@
+"""
+Server DB schema upgrades.
+Schema version is kept in PRAGMA user_version, databases created before versioning have 0 and schema 1.
+
+Upgrade an existing database in place: python -m server.migrations server_database.db3
+"""
+import argparse
+import os
+import sqlite3
+import sys
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+# Schema version of the ServerStorage models
+SCHEMA_VERSION = 3
+
+
+def migrate_v2(connection):
+    """users_contacts.contact becomes integer with unique (user, contact), user columns are indexed"""
+    connection.execute('''
+        CREATE TABLE users_contacts_v2 (
+            id INTEGER NOT NULL,
+            user INTEGER,
+            contact INTEGER,
+            PRIMARY KEY (id),
+            CONSTRAINT uq_users_contacts_user_contact UNIQUE (user, contact),
+            FOREIGN KEY(user) REFERENCES user (id),
+            FOREIGN KEY(contact) REFERENCES user (id)
+        )''')
+    # Duplicates of the old table are dropped, the first row is kept
+    connection.execute('''
+        INSERT OR IGNORE INTO users_contacts_v2 (id, user, contact)
+        SELECT id, user, CAST(contact AS INTEGER) FROM users_contacts ORDER BY id''')
+    connection.execute('DROP TABLE users_contacts')
+    connection.execute('ALTER TABLE users_contacts_v2 RENAME TO users_contacts')
+    connection.execute('CREATE INDEX ix_users_contacts_contact ON users_contacts (contact)')
+    connection.execute('CREATE INDEX ix_user_history_user ON user_history (user)')
+    connection.execute('CREATE INDEX ix_login_history_user ON login_history (user)')
+    connection.execute('CREATE INDEX ix_active_user_user ON active_user (user)')
+
+
+def migrate_v3(connection):
+    """Change log of the users and contacts lists for delta sync"""
+    connection.execute('''
+        CREATE TABLE change_log (
+            id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+            owner INTEGER,
+            name VARCHAR,
+            added BOOLEAN
+        )''')
+
+
+# Version -> function upgrading the schema from the previous version
+MIGRATIONS = {
+    2: migrate_v2,
+    3: migrate_v3,
+}
+
+
+def get_version(connection):
+    version = connection.execute('PRAGMA user_version').fetchone()[0]
+    if version == 0:
+        tables = connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'user'")
+        # Not versioned database of the first schema or a new one
+        return 1 if tables.fetchone() else 0
+    return version
+
+
+def upgrade(path):
+    """
+    Bring the database schema to SCHEMA_VERSION, returns the version the database had.
+    Every step runs in its own transaction, a new database is only marked with the current version,
+    its tables are created by ServerStorage.
+    """
+    connection = sqlite3.connect(path, isolation_level=None)
+    try:
+        connection.execute('BEGIN IMMEDIATE')
+        start_version = version = get_version(connection)
+        if version > SCHEMA_VERSION:
+            raise RuntimeError(f'Database schema version {version} is newer than supported {SCHEMA_VERSION}')
+        if version == 0:
+            version = SCHEMA_VERSION
+            connection.execute(f'PRAGMA user_version = {version}')
+        connection.execute('COMMIT')
+
+        while version < SCHEMA_VERSION:
+            connection.execute('BEGIN IMMEDIATE')
+            MIGRATIONS[version + 1](connection)
+            version += 1
+            connection.execute(f'PRAGMA user_version = {version}')
+            connection.execute('COMMIT')
+        return start_version
+    except BaseException:
+        if connection.in_transaction:
+            connection.execute('ROLLBACK')
+        raise
+    finally:
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Upgrade the server database schema')
+    parser.add_argument('path', help='database file, e.g. server_database.db3')
+    namespace = parser.parse_args(sys.argv[1:])
+    if not os.path.exists(namespace.path):
+        parser.error(f'{namespace.path} does not exist')
+    old_version = upgrade(namespace.path)
+    if old_version == SCHEMA_VERSION:
+        print(f'Database schema is up to date (version {SCHEMA_VERSION})')
+    else:
+        print(f'Database schema upgraded from version {old_version} to {SCHEMA_VERSION}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+import tempfile
+
+
+class OutboundBuffer:
+    """
+    Send buffer of one client.
+    Data is kept in memory, with spill enabled everything above memory_limit goes to a temporary file
+    and is read back as the client takes the data.
+    """
+
+    def __init__(self, memory_limit, spill=False, spill_dir=None):
+        self.memory_limit = memory_limit
+        self.spill = spill
+        self.spill_dir = spill_dir
+        self.memory = bytearray()
+        self.spill_file = None
+        # Position of the first not sent byte in the spill file and amount of not sent bytes there
+        self.spill_position = 0
+        self.spilled = 0
+
+    def __len__(self):
+        return len(self.memory) + self.spilled
+
+    def __bool__(self):
+        return bool(self.memory) or bool(self.spilled)
+
+    def append(self, data):
+        """Add data to the end of the buffer"""
+        if self.spill and (self.spilled or len(self.memory) + len(data) > self.memory_limit):
+            if self.spill_file is None:
+                self.spill_file = tempfile.TemporaryFile(dir=self.spill_dir)
+            self.spill_file.seek(0, 2)
+            self.spill_file.write(data)
+            self.spilled += len(data)
+        else:
+            self.memory += data
+
+    def send(self, sock):
+        """Send as much data as the socket accepts, returns the number of sent bytes"""
+        if not self.memory and self.spilled:
+            self.load_spilled()
+        sent = sock.send(self.memory)
+        del self.memory[:sent]
+        return sent
+
+    def load_spilled(self):
+        """Move the next part of the spilled data back to memory"""
+        self.spill_file.seek(self.spill_position)
+        chunk = self.spill_file.read(self.memory_limit)
+        self.memory += chunk
+        self.spill_position += len(chunk)
+        self.spilled -= len(chunk)
+        if not self.spilled:
+            self.spill_file.seek(0)
+            self.spill_file.truncate()
+            self.spill_position = 0
+
+    def close(self):
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+        self.memory.clear()
+        self.spilled = 0
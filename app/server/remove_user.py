@@ -42,10 +42,7 @@ class DelUserDialog(QDialog):
 
     def remove_user(self):
         self.database.remove_user(self.selector.currentText())
-        if self.selector.currentText() in self.server.names:
-            sock = self.server.names[self.selector.currentText()]
-            del self.server.names[self.selector.currentText()]
-            self.server.remove_client(sock)
+        self.server.service_remove_user(self.selector.currentText())
         self.server.service_update_lists()
         self.close()
 
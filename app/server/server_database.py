@@ -1,9 +1,24 @@
 import datetime
+import logging
+import threading
+import time
+from collections import namedtuple
 from pprint import pprint
 
-from sqlalchemy import create_engine, Column, Integer, String, Text, ForeignKey, DateTime
+from sqlalchemy import create_engine, event, func, or_, Column, Integer, String, Text, Boolean, ForeignKey, \
+    DateTime, UniqueConstraint, update, bindparam
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool
+
+from server.migrations import upgrade
+from common.variables import COUNTERS_FLUSH_INTERVAL, COUNTERS_FLUSH_MESSAGES, DB_PROFILES, DB_PROFILE, \
+    DB_BUSY_TIMEOUT, CHANGE_LOG_SIZE, VERSION, FULL, USERS, CONTACTS, ADDED, REMOVED, SEARCH_LIMIT
+
+server_log = logging.getLogger('server_log')
+
+# Cached user data: user table id, password hash, public key, user_history row id
+UserEntry = namedtuple('UserEntry', ('id', 'password_hash', 'pub_key', 'history_id'))
 
 
 class ServerStorage:
@@ -28,7 +43,7 @@ class ServerStorage:
         __tablename__ = 'login_history'
 
         id = Column(Integer, primary_key=True)
-        user = Column(Integer, ForeignKey('user.id'))
+        user = Column(Integer, ForeignKey('user.id'), index=True)
         ip = Column(String)
         port = Column(Integer)
         last_login = Column(DateTime)
@@ -43,7 +58,7 @@ class ServerStorage:
         __tablename__ = 'active_user'
 
         id = Column(Integer, primary_key=True)
-        user = Column(Integer, ForeignKey('user.id'))
+        user = Column(Integer, ForeignKey('user.id'), index=True)
         ip = Column(String)
         port = Column(Integer)
         last_login = Column(DateTime)
@@ -56,10 +71,12 @@ class ServerStorage:
 
     class UsersContacts(Base):
         __tablename__ = 'users_contacts'
+        # Unique index of (user, contact) also serves the contacts list of the user
+        __table_args__ = (UniqueConstraint('user', 'contact', name='uq_users_contacts_user_contact'),)
 
         id = Column(Integer, primary_key=True)
         user = Column(Integer, ForeignKey('user.id'))
-        contact = Column(String, ForeignKey('user.id'))
+        contact = Column(Integer, ForeignKey('user.id'), index=True)
 
         def __init__(self, user, contact):
             self.user = user
@@ -69,7 +86,7 @@ class ServerStorage:
         __tablename__ = 'user_history'
 
         id = Column(Integer, primary_key=True)
-        user = Column(Integer, ForeignKey('user.id'))
+        user = Column(Integer, ForeignKey('user.id'), index=True)
         sent = Column(Integer)
         accepted = Column(Integer)
 
@@ -78,27 +95,122 @@ class ServerStorage:
             self.sent = 0
             self.accepted = 0
 
-    def __init__(self, path):
+    class ChangeLog(Base):
+        """Changes of the users and contacts lists, row id is the version of the lists"""
+        __tablename__ = 'change_log'
+        __table_args__ = {'sqlite_autoincrement': True}
+
+        id = Column(Integer, primary_key=True)
+        # Owner of the changed contacts list, None for the users list
+        owner = Column(Integer)
+        name = Column(String)
+        added = Column(Boolean)
+
+        def __init__(self, owner, name, added):
+            self.owner = owner
+            self.name = name
+            self.added = added
+
+    def __init__(self, path, flush_interval=COUNTERS_FLUSH_INTERVAL, flush_messages=COUNTERS_FLUSH_MESSAGES,
+                 profile=DB_PROFILE):
+        if profile not in DB_PROFILES:
+            raise ValueError(f'Unknown database profile {profile}')
+        self.pragmas = DB_PROFILES[profile]
+        # Old databases are upgraded before use, see server/migrations.py
+        if path != ':memory:':
+            upgrade(path)
+        # Connections are kept open, so the page cache and the memory map are not lost between sessions
+        pool_args = {} if path == ':memory:' else {'poolclass': QueuePool}
         self.engine = create_engine(f'sqlite:///{path}', echo=False, pool_recycle=7200,
-                                    connect_args={'check_same_thread': False})
+                                    connect_args={'check_same_thread': False, 'timeout': DB_BUSY_TIMEOUT / 1000},
+                                    **pool_args)
+        event.listen(self.engine, 'connect', self.set_pragmas)
 
         self.Base.metadata.create_all(self.engine)
-        Session = sessionmaker(bind=self.engine)
-        self.session = Session()
+        # Every thread (network, DB executor, GUI) works with its own session and connection.
+        # In WAL mode readers do not wait for the writer and the writer does not wait for readers.
+        self.session = scoped_session(sessionmaker(bind=self.engine))
 
         self.session.query(self.ActiveUser).delete()
         self.session.commit()
 
+        # User directory cache: username -> UserEntry
+        self.users = dict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.load_users()
+
+        # Not yet written message counters: user_history row id -> [sent, accepted]
+        self.counters = dict()
+        self.counters_messages = 0
+        self.counters_lock = threading.Lock()
+        # Held while the counters are written, so the readers see them either in the dict or in DB
+        self.flush_lock = threading.Lock()
+        self.flush_interval = flush_interval
+        self.flush_messages = flush_messages
+        self.last_flush = time.monotonic()
+
+        # Current version of the users and contacts lists
+        self.version = self.session.query(func.max(self.ChangeLog.id)).scalar() or 0
+
+    def set_pragmas(self, dbapi_connection, connection_record):
+        """Apply the settings profile to the new SQLite connection"""
+        cursor = dbapi_connection.cursor()
+        for pragma, value in self.pragmas.items():
+            cursor.execute(f'PRAGMA {pragma} = {value}')
+        cursor.execute(f'PRAGMA busy_timeout = {DB_BUSY_TIMEOUT}')
+        cursor.close()
+
+    def close_session(self):
+        """Release the session of the current thread, called by threads which stop working with DB"""
+        self.session.remove()
+
+    def load_users(self):
+        """Fill the user directory cache with all users"""
+        query = self.session.query(
+            self.User.username,
+            self.User.id,
+            self.User.password_hash,
+            self.User.pub_key,
+            self.UserHistory.id
+        ).outerjoin(self.UserHistory, self.UserHistory.user == self.User.id)
+        self.users = {row[0]: UserEntry(*row[1:]) for row in query.all()}
+
+    def get_user(self, username):
+        """Cached user data or None if there is no such user"""
+        entry = self.users.get(username)
+        if entry is not None:
+            self.cache_hits += 1
+            return entry
+        self.cache_misses += 1
+        row = self.session.query(
+            self.User.id,
+            self.User.password_hash,
+            self.User.pub_key,
+            self.UserHistory.id
+        ).outerjoin(self.UserHistory, self.UserHistory.user == self.User.id).\
+            filter(self.User.username == username).first()
+        if row is None:
+            return None
+        entry = self.users[username] = UserEntry(*row)
+        return entry
+
+    def invalidate_user(self, username):
+        """Drop the cached user data, it is read from DB on next use"""
+        self.users.pop(username, None)
+
     def user_login(self, username, ip, port, key):
-        """Calls during user login, log to db information about it"""
-        users = self.session.query(self.User).filter_by(username=username)
-        if users.count():
-            user = users.first()
-            user.last_login = datetime.datetime.now()
-            if user.pub_key != key:
-                user.pub_key = key
-        else:
+        """
+        Calls during user login, log to db information about it.
+        Returns True if the login replaced the public key the user had before.
+        """
+        user = self.session.query(self.User).filter_by(username=username).first()
+        if user is None:
             raise ValueError('User does not exists')
+        user.last_login = datetime.datetime.now()
+        key_changed = user.pub_key is not None and user.pub_key != key
+        if user.pub_key != key:
+            user.pub_key = key
 
         new_active_user = self.ActiveUser(user.id, ip, port, datetime.datetime.now())
         self.session.add(new_active_user)
@@ -107,6 +219,10 @@ class ServerStorage:
         self.session.add(history)
 
         self.session.commit()
+        entry = self.users.get(username)
+        if entry is not None and entry.pub_key != key:
+            self.users[username] = entry._replace(pub_key=key)
+        return key_changed
 
     def add_user(self, username, password_hash):
         """Create a new user to DB"""
@@ -116,11 +232,19 @@ class ServerStorage:
 
         history_row = self.UserHistory(user_row.id)
         self.session.add(history_row)
+        self.log_change(None, username, True)
         self.session.commit()
+        self.users[username] = UserEntry(user_row.id, password_hash, None, history_row.id)
 
     def remove_user(self, username):
         """Remove user from DB"""
         user = self.session.query(self.User).filter_by(username=username).first()
+        if user is None:
+            return
+        history_row = self.session.query(self.UserHistory.id).filter_by(user=user.id).first()
+        if history_row is not None:
+            with self.counters_lock:
+                self.counters.pop(history_row[0], None)
         self.session.query(self.ActiveUser).filter_by(user=user.id).delete()
         self.session.query(self.LoginHistory).filter_by(user=user.id).delete()
         self.session.query(self.UsersContacts).filter_by(user=user.id).delete()
@@ -129,46 +253,103 @@ class ServerStorage:
             contact=user.id).delete()
         self.session.query(self.UserHistory).filter_by(user=user.id).delete()
         self.session.query(self.User).filter_by(username=username).delete()
+        self.log_change(None, username, False)
         self.session.commit()
+        # Not before the commit: the DB thread could read the user back into the cache meanwhile
+        self.invalidate_user(username)
 
     def get_hash(self, username):
         """Get user pass hash."""
-        user = self.session.query(self.User).filter_by(username=username).first()
-        return user.password_hash
+        return self.get_user(username).password_hash
 
     def get_pubkey(self, username):
         """Get user public key."""
-        user = self.session.query(self.User).filter_by(username=username).first()
-        return user.pub_key
+        return self.get_user(username).pub_key
+
+    def get_pubkeys(self, usernames):
+        """Public keys of the users: username -> key, unknown users and users without a key are skipped"""
+        keys = {}
+        for username in usernames:
+            entry = self.get_user(username)
+            if entry is not None and entry.pub_key:
+                keys[username] = entry.pub_key
+        return keys
 
     def check_user(self, username):
         """Check if user exists."""
-        if self.session.query(self.User).filter_by(username=username).count():
-            return True
-        else:
-            return False
+        return self.get_user(username) is not None
 
     def user_logout(self, username):
         """Log user logout to DB"""
-        user = self.session.query(self.User).filter_by(username=username).first()
+        user = self.get_user(username)
+        if user is None:
+            # The user is removed while online
+            return
         self.session.query(self.ActiveUser).filter_by(user=user.id).delete()
         self.session.commit()
 
     # Process users messages and log it to DB
     def process_message(self, sender, recipient):
-        sender = self.session.query(self.User).filter_by(username=sender).first().id
-        recipient = self.session.query(self.User).filter_by(username=recipient).first().id
-
-        sender_row = self.session.query(self.UserHistory).filter_by(user=sender).first()
-        sender_row.sent += 1
-        recipient_row = self.session.query(self.UserHistory).filter_by(user=recipient).first()
-        recipient_row.accepted += 1
-
-        self.session.commit()
+        """Count the message. Counters are written by flush_counters, not at once."""
+        sender_entry = self.get_user(sender)
+        recipient_entry = self.get_user(recipient)
+        if sender_entry is None or recipient_entry is None:
+            # The call is not awaited by anybody, so the error would be lost
+            server_log.warning(f'Message from {sender} to {recipient} is not counted, the user is removed')
+            return
+        sender = sender_entry.history_id
+        recipient = recipient_entry.history_id
+
+        with self.counters_lock:
+            self.counters.setdefault(sender, [0, 0])[0] += 1
+            self.counters.setdefault(recipient, [0, 0])[1] += 1
+            self.counters_messages += 1
+        if self.counters_messages >= self.flush_messages:
+            self.flush_counters()
+
+    def counters_due(self):
+        """It's time to write the collected message counters"""
+        return bool(self.counters) and time.monotonic() - self.last_flush >= self.flush_interval
+
+    def flush_counters_if_due(self):
+        """Periodic call of the server loop"""
+        if self.counters_due():
+            self.flush_counters()
+
+    def flush_counters(self):
+        """Write the collected message counters in one transaction, they are kept if the write fails"""
+        with self.flush_lock:
+            with self.counters_lock:
+                counters = self.counters
+                self.counters = dict()
+                self.counters_messages = 0
+                self.last_flush = time.monotonic()
+            if not counters:
+                return
+            statement = update(self.UserHistory).\
+                where(self.UserHistory.id == bindparam('history_id')).\
+                values(sent=self.UserHistory.sent + bindparam('sent_delta'),
+                       accepted=self.UserHistory.accepted + bindparam('accepted_delta'))
+            try:
+                self.session.execute(statement, [
+                    {'history_id': history_id, 'sent_delta': sent, 'accepted_delta': accepted}
+                    for history_id, (sent, accepted) in counters.items()
+                ])
+                self.session.commit()
+            except Exception as err:
+                server_log.error(f'Cannot write message counters: {err}')
+                self.session.rollback()
+                with self.counters_lock:
+                    for history_id, (sent, accepted) in counters.items():
+                        counter = self.counters.setdefault(history_id, [0, 0])
+                        counter[0] += sent
+                        counter[1] += accepted
+                raise
 
     def add_contact(self, user, contact):
-        user = self.session.query(self.User).filter_by(username=user).first()
-        contact = self.session.query(self.User).filter_by(username=contact).first()
+        contact_name = contact
+        user = self.get_user(user)
+        contact = self.get_user(contact)
 
         if not contact or self.session.query(self.UsersContacts).\
                 filter_by(user=user.id, contact=contact.id).count():
@@ -176,26 +357,98 @@ class ServerStorage:
 
         contact_row = self.UsersContacts(user.id, contact.id)
         self.session.add(contact_row)
+        self.log_change(user.id, contact_name, True)
         self.session.commit()
 
     def remove_contact(self, user, contact):
-        user = self.session.query(self.User).filter_by(username=user).first()
-        contact = self.session.query(self.User).filter_by(username=contact).first()
+        contact_name = contact
+        user = self.get_user(user)
+        contact = self.get_user(contact)
 
         if not contact:
             return
 
-        print(self.session.query(self.UsersContacts).filter(
+        if self.session.query(self.UsersContacts).filter(
             self.UsersContacts.user == user.id,
             self.UsersContacts.contact == contact.id
-        ).delete())
+        ).delete():
+            self.log_change(user.id, contact_name, False)
         self.session.commit()
 
+    def log_change(self, owner, name, added):
+        """Record the change of the lists, it is committed with the change itself"""
+        row = self.ChangeLog(owner, name, added)
+        self.session.add(row)
+        self.session.flush()
+        self.version = row.id
+        # Old changes are dropped from time to time, clients which need them get full lists
+        if row.id % 1000 == 0:
+            self.session.query(self.ChangeLog).filter(self.ChangeLog.id <= row.id - CHANGE_LOG_SIZE).delete()
+
+    def get_changes(self, username, since):
+        """
+        Changes of the users list and the user contacts list after the version since.
+        Full lists are returned if the changes are not known any more (or since is 0).
+        """
+        user = self.get_user(username)
+        version, first = self.session.query(func.max(self.ChangeLog.id), func.min(self.ChangeLog.id)).one()
+        version = version or 0
+        if since <= 0 or since > version or (first is not None and since < first - 1):
+            return {
+                VERSION: version,
+                FULL: True,
+                USERS: {ADDED: [row[0] for row in self.users_list()], REMOVED: []},
+                CONTACTS: {ADDED: self.get_contacts(username), REMOVED: []},
+            }
+
+        # Only the last change of every name matters
+        users = dict()
+        contacts = dict()
+        query = self.session.query(self.ChangeLog.owner, self.ChangeLog.name, self.ChangeLog.added).\
+            filter(self.ChangeLog.id > since, self.ChangeLog.id <= version).\
+            filter(or_(self.ChangeLog.owner.is_(None), self.ChangeLog.owner == user.id)).\
+            order_by(self.ChangeLog.id)
+        for owner, name, added in query.all():
+            if owner is None:
+                users[name] = added
+            else:
+                contacts[name] = added
+        # Removed users are removed from the contacts by the client
+        for name, added in users.items():
+            if not added:
+                contacts.pop(name, None)
+        return {
+            VERSION: version,
+            FULL: False,
+            USERS: {ADDED: [name for name, added in users.items() if added],
+                    REMOVED: [name for name, added in users.items() if not added]},
+            CONTACTS: {ADDED: [name for name, added in contacts.items() if added],
+                       REMOVED: [name for name, added in contacts.items() if not added]},
+        }
+
     def users_list(self):
         """Returns all users which are ever were logged in"""
         query = self.session.query(self.User.username, self.User.last_login)
         return query.all()
 
+    def search_users(self, prefix, cursor=None, limit=SEARCH_LIMIT):
+        """
+        Page of the usernames starting with prefix, in name order, after the cursor name.
+        Returns the names and the cursor of the next page (None if it is the last one).
+        The range condition is served by the unique index of username.
+        """
+        query = self.session.query(self.User.username)
+        if prefix:
+            # All names with the prefix are between prefix and prefix with the last char incremented
+            query = query.filter(self.User.username >= prefix,
+                                 self.User.username < prefix[:-1] + chr(ord(prefix[-1]) + 1))
+        if cursor:
+            query = query.filter(self.User.username > cursor)
+        names = [row[0] for row in query.order_by(self.User.username).limit(limit + 1)]
+        if len(names) > limit:
+            return names[:limit], names[limit - 1]
+        return names, None
+
     def active_users_list(self):
         """Returns active users list"""
         query = self.session.query(
@@ -220,7 +473,7 @@ class ServerStorage:
         return query.all()
 
     def get_contacts(self, username):
-        user = self.session.query(self.User).filter_by(username=username).one()
+        user = self.get_user(username)
 
         query = self.session.query(self.UsersContacts, self.User.username).\
             filter_by(user=user.id).\
@@ -228,14 +481,35 @@ class ServerStorage:
 
         return [contact[1] for contact in query.all()]
 
+    def contact_owners(self, username):
+        """Users who have the user in their contacts lists"""
+        user = self.get_user(username)
+        if user is None:
+            return []
+        query = self.session.query(self.User.username).\
+            join(self.UsersContacts, self.UsersContacts.user == self.User.id).\
+            filter(self.UsersContacts.contact == user.id)
+        return [row[0] for row in query.all()]
+
     def message_history(self):
+        """Message counters of all users, not yet written ones included"""
         query = self.session.query(
             self.User.username,
             self.User.last_login,
             self.UserHistory.sent,
-            self.UserHistory.accepted
+            self.UserHistory.accepted,
+            self.UserHistory.id
         ).join(self.User)
-        return query.all()
+        # Not in the middle of a flush: its counters are neither in the dict nor in DB then
+        with self.flush_lock:
+            rows = query.all()
+            with self.counters_lock:
+                counters = {history_id: tuple(counter) for history_id, counter in self.counters.items()}
+        history = []
+        for username, last_login, sent, accepted, history_id in rows:
+            sent_delta, accepted_delta = counters.get(history_id, (0, 0))
+            history.append((username, last_login, sent + sent_delta, accepted + accepted_delta))
+        return history
 
 
 if __name__ == '__main__':
@@ -0,0 +1,33 @@
+"""
+Session resumption tokens.
+The token is issued after a successful login and lets the client log in again after a reconnect
+with one request, without the challenge. It is signed by the password hash of the user,
+so it is valid after a server restart and is revoked by a password change.
+"""
+import hmac
+import time
+
+from common.variables import RESUME_TOKEN_TTL
+
+
+def sign(password_hash, username, expires):
+    return hmac.new(password_hash, f'{username}:{expires}'.encode('utf-8'), 'sha256').hexdigest()
+
+
+def make_token(password_hash, username):
+    """New token of the user, valid for RESUME_TOKEN_TTL seconds"""
+    expires = int(time.time()) + RESUME_TOKEN_TTL
+    return f'{expires}:{sign(password_hash, username, expires)}'
+
+
+def check_token(password_hash, username, token):
+    """True if the token was issued to the user and is not expired"""
+    try:
+        expires, signature = token.split(':')
+        expires = int(expires)
+        # The signature comes from the client, compare_digest takes only ASCII strings
+        signature = signature.encode('ascii')
+    except (AttributeError, ValueError):
+        return False
+    return expires > time.time() and \
+        hmac.compare_digest(signature, sign(password_hash, username, expires).encode('ascii'))
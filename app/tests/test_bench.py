@@ -0,0 +1,55 @@
+import unittest
+import os
+import random
+import sys
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+from bench.micro import mann_whitney, compare, median
+
+
+def result(samples, reference=1000):
+    return {'number': 1, 'samples': samples, 'reference': reference}
+
+
+class TestBenchCompare(unittest.TestCase):
+    def test_mann_whitney(self):
+        before = [100 + random.random() for _ in range(20)]
+        after = [120 + random.random() for _ in range(20)]
+        self.assertLess(mann_whitney(before, after), 0.001)
+        self.assertGreater(mann_whitney(after, before), 0.999)
+        self.assertGreater(mann_whitney(before, before), 0.3)
+
+    def test_median(self):
+        self.assertEqual(median([3, 1, 2]), 2)
+        self.assertEqual(median([4, 1, 2, 3]), 2.5)
+
+    def test_regression(self):
+        baseline = {'test': result([100, 101, 99, 100, 102, 98, 100, 101, 99, 100])}
+        rows, regressions = compare(baseline, {'test': result([130, 131, 129, 130, 132, 128, 130, 131, 129, 130])})
+        self.assertEqual(regressions, 1)
+        self.assertEqual(rows[0][4], 'REGRESSION')
+
+    def test_noise_and_small_changes(self):
+        baseline = {'test': result([100, 120, 90, 105, 95])}
+        rows, regressions = compare(baseline, {'test': result([110, 95, 125, 100, 104])})
+        self.assertEqual(regressions, 0)
+        baseline = {'test': result([100] * 10)}
+        rows, regressions = compare(baseline, {'test': result([105] * 10)})
+        self.assertEqual(regressions, 0)
+
+    def test_machine_speed(self):
+        """Everything is 1.5 times slower on the busy machine, the reference loop too"""
+        baseline = {'test': result([100, 101, 99, 100, 102])}
+        rows, regressions = compare(baseline, {'test': result([150, 151, 149, 150, 153], reference=1500)})
+        self.assertEqual(regressions, 0)
+
+    def test_faster_and_new(self):
+        baseline = {'test': result([100, 101, 99, 100, 102])}
+        rows, regressions = compare(baseline, {'test': result([50, 51, 49, 50, 52]), 'other': result([10])})
+        self.assertEqual(rows[0][4], 'faster')
+        self.assertEqual(rows[1][4], 'new')
+        self.assertEqual(regressions, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+import os
+import sys
+import tempfile
+import threading
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+from client.client_database import ClientDatabase
+
+# Enough for any DB call of the tests, seconds
+DB_TIMEOUT = 2
+
+
+class TestClientDatabase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        # DB file is created in the current directory
+        os.chdir(self.directory.name)
+        self.database = ClientDatabase('test1')
+
+    def tearDown(self) -> None:
+        self.database.close_session()
+        self.database.database_engine.dispose()
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def in_thread(self, func, *args):
+        """Call in the other thread, as the receiver and crypto threads do, returns the result"""
+        results = []
+
+        def call():
+            results.append(func(*args))
+            self.database.close_session()
+
+        thread = threading.Thread(target=call)
+        thread.start()
+        thread.join(DB_TIMEOUT)
+        return results[0]
+
+    def test_session_per_thread(self):
+        self.assertIsNot(self.in_thread(self.database.session), self.database.session())
+
+    def test_threads(self):
+        """Data written by one thread is read by the others"""
+        self.database.save_keys({'test2': 'key2'})
+        self.assertEqual(self.in_thread(self.database.get_key, 'test2')[1], 'key2')
+        self.in_thread(self.database.save_message, 'test2', 'in', 'Hi')
+        self.assertEqual([row[2] for row in self.database.get_history('test2')], ['Hi'])
+
+    def test_concurrent_writes(self):
+        threads = [threading.Thread(target=lambda index=index: [
+            self.database.save_message(f'test{index}', 'in', str(number)) for number in range(20)])
+            for index in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(DB_TIMEOUT)
+        self.assertEqual(len(self.database.get_history()), 60)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+import unittest
+import logging
+import os
+import sys
+from socket import socketpair
+from unittest import mock
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+from common.variables import *
+from common.utils import encode_message, get_message
+from server.cluster import ShardedMessageProcessor, ServerCluster
+from tests.test_core import ServerTestCase, free_port
+
+
+class TestCluster(ServerTestCase):
+    """Two workers joined by the bus, each listens to its own port, so the test chooses the worker of the client"""
+
+    def make_server(self):
+        link0, link1 = socketpair()
+        # Master end of the control socket of worker 0
+        self.control, worker_control = socketpair()
+        self.addCleanup(self.control.close)
+        self.addCleanup(worker_control.close)
+        self.workers = [
+            self.start_server(ShardedMessageProcessor(
+                '127.0.0.1', free_port(), self.database, OUTBOUND_POLICY, index, links, control))
+            for index, links, control in ((0, [None, link0], worker_control), (1, [link1, None], None))
+        ]
+        return self.workers[0]
+
+    def login_both(self):
+        first = self.login('test1', b'hash1', server=self.workers[0])
+        second = self.login('test2', b'hash2', server=self.workers[1])
+        self.poll_until(lambda: 'test2' in self.workers[0].directory and 'test1' in self.workers[1].directory)
+        return first, second
+
+    def kill_worker(self, index):
+        """The worker process is gone: its bus sockets are closed by the OS"""
+        worker = self.workers[index]
+        for link in worker.links:
+            if link is not None:
+                worker.selector.unregister(link)
+                link.close()
+        self.servers.remove(worker)
+        worker.shutdown()
+
+    def test_directory(self):
+        self.login_both()
+        self.assertEqual(self.workers[0].directory, {'test2': 1})
+        self.assertEqual(self.workers[1].directory, {'test1': 0})
+        self.assertTrue(self.workers[0].is_online('test2'))
+
+    def test_routing(self):
+        (first, first_sock), (second, second_sock) = self.login_both()
+        self.send(first, {ACTION: MESSAGE, SENDER: 'test1', DESTINATION: 'test2', TIME: 1.1, MESSAGE_TEXT: 'Hi'})
+        self.assertEqual(self.receive(first)[RESPONSE], 200)
+        message = self.receive(second)
+        self.assertEqual((message[SENDER], message[MESSAGE_TEXT]), ('test1', 'Hi'))
+        self.assertEqual(self.workers[1].metrics.messages_routed, 1)
+
+    def test_key_changed(self):
+        """Key change reaches the owner of the contact at the other worker"""
+        self.database.add_contact('test2', 'test1')
+        (first, first_sock), (second, second_sock) = self.login_both()
+        self.workers[0].public_key_changed('test1', 'key2', ['test2'])
+        message = self.receive(second)
+        self.assertEqual((message[ACTION], message[ACCOUNT_NAME], message[PUBLIC_KEY]),
+                         (PUBLIC_KEY_CHANGED, 'test1', 'key2'))
+
+    def test_user_offline(self):
+        (first, first_sock), (second, second_sock) = self.login_both()
+        second.close()
+        self.clients.remove(second)
+        self.poll_until(lambda: 'test2' not in self.workers[0].directory)
+        self.send(first, {ACTION: MESSAGE, SENDER: 'test1', DESTINATION: 'test2', TIME: 1.1, MESSAGE_TEXT: 'Hi'})
+        self.assertEqual(self.receive(first)[RESPONSE], 400)
+
+    def test_worker_gone(self):
+        (first, first_sock), (second, second_sock) = self.login_both()
+        self.kill_worker(1)
+        self.poll_until(lambda: not self.workers[0].links_outgoing)
+        self.assertEqual(self.workers[0].directory, {})
+        # Listening socket, wakeup pipe, control socket and the client
+        self.assertEqual(len(self.workers[0].selector.get_map()), 4)
+        # The worker goes on with its own clients
+        self.workers[0].broadcast({ACTION: BUS_USER_ONLINE, ACCOUNT_NAME: 'test1', WORKER: 0})
+        self.send(first, {ACTION: GET_CONTACTS, TIME: 1.1, USER: 'test1'})
+        self.assertEqual(self.receive(first)[RESPONSE], 202)
+
+    def test_broken_pipe(self):
+        """Data for the dead worker is sent before its end of the link is read"""
+        self.login_both()
+        self.kill_worker(1)
+        self.workers[0].send_to_worker(1, {ACTION: BUS_USER_OFFLINE, ACCOUNT_NAME: 'test1', WORKER: 0})
+        self.workers[0].after_select()
+        self.assertEqual(self.workers[0].links_outgoing, {})
+        self.assertEqual(self.workers[0].directory, {})
+
+    def test_bus_limit(self):
+        """Link to the worker which does not read the bus is closed, the worker sees it closed too"""
+        self.login_both()
+        self.workers[0].bus_limit = 1000
+        self.workers[0].send_to_worker(1, {ACTION: BUS_ROUTE, MESSAGE: {MESSAGE_TEXT: 'x' * 1000}})
+        self.assertEqual(self.workers[0].links_outgoing, {})
+        self.assertEqual(self.workers[0].directory, {})
+        self.poll_until(lambda: not self.workers[1].links_outgoing)
+        self.assertEqual(self.workers[1].directory, {})
+
+    def test_log_level(self):
+        logger = logging.getLogger('server_log')
+        self.addCleanup(logger.setLevel, logger.level)
+        self.control.sendall(encode_message({ACTION: BUS_LOG_LEVEL, DATA: 'critical'}))
+        self.poll_until(lambda: logger.level == logging.CRITICAL)
+        self.control.sendall(encode_message({ACTION: BUS_LOG_LEVEL, DATA: 'verbose'}))
+        self.control.sendall(encode_message({ACTION: BUS_LOG_LEVEL, DATA: 'debug'}))
+        self.poll_until(lambda: logger.level == logging.DEBUG)
+
+    def test_master_gone(self):
+        """Worker stops when the master process is gone, nobody would stop it"""
+        self.control.close()
+        self.poll_until(lambda: not self.workers[0].running)
+        self.assertTrue(self.workers[1].running)
+
+
+class TestServerCluster(unittest.TestCase):
+    def test_set_log_level(self):
+        cluster = ServerCluster(2, '127.0.0.1', DEFAULT_SERVER_PORT, ':memory:')
+        first, first_worker = socketpair()
+        second, second_worker = socketpair()
+        cluster.controls = [first, second]
+        second_worker.close()
+        with self.assertLogs('server_log', 'ERROR'):
+            cluster.set_log_level('DEBUG')
+        self.assertEqual(get_message(first_worker), {ACTION: BUS_LOG_LEVEL, DATA: 'DEBUG'})
+        cluster.stop()
+        self.assertEqual(first.fileno(), -1)
+        first_worker.close()
+
+    def test_console_command(self):
+        from run_server import change_log_level
+        logger = logging.getLogger('server_log')
+        self.addCleanup(logger.setLevel, logger.level)
+        cluster = mock.Mock()
+        with mock.patch('builtins.print'):
+            change_log_level('log verbose', cluster)
+        cluster.set_log_level.assert_not_called()
+        with self.assertLogs('server_log', 'WARNING'):
+            change_log_level('log warning', cluster)
+        cluster.set_log_level.assert_called_once_with('warning')
+
+
+class TestParams(unittest.TestCase):
+    def test_asyncio_workers(self):
+        from run_server import get_params
+        argv = ['run_server.py', '--engine', 'asyncio', '--workers', '2']
+        with mock.patch.object(sys, 'argv', argv), mock.patch('sys.stderr'), self.assertRaises(SystemExit):
+            get_params('', DEFAULT_SERVER_PORT)
+        with mock.patch.object(sys, 'argv', ['run_server.py', '--workers', '2']):
+            self.assertEqual(get_params('', DEFAULT_SERVER_PORT)[3:6], ('selectors', OUTBOUND_POLICY, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,590 @@
+import unittest
+import binascii
+import contextlib
+import hmac
+import io
+import os
+import selectors
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+from socket import socket, create_connection
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+from common.variables import *
+from common.utils import encode_message, FrameDecoder
+from server.async_core import AsyncMessageProcessor
+from server.connection import WAIT_PRESENCE, WAIT_DIGEST, AUTHORISED
+from server.core import MessageProcessor
+from server.server_database import ServerStorage
+from server.tokens import make_token
+
+# Enough for any step of the tests, seconds
+TEST_TIMEOUT = 2
+
+
+def free_port():
+    with socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class ServerTestCase(unittest.TestCase):
+    """The server loop is driven by the test: every poll() is one iteration of run()"""
+
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.database = ServerStorage(os.path.join(self.temp_dir.name, 'server.db3'))
+        self.database.add_user('test1', b'hash1')
+        self.database.add_user('test2', b'hash2')
+        self.servers = []
+        self.server = self.make_server()
+        self.clients = []
+        # Receive buffers of the client sockets
+        self.decoders = dict()
+
+    def make_server(self):
+        return self.start_server(MessageProcessor('127.0.0.1', free_port(), self.database))
+
+    def start_server(self, server):
+        """What run() does before the loop"""
+        server.executor = ThreadPoolExecutor(max_workers=1)
+        with contextlib.redirect_stdout(io.StringIO()):
+            server.init_socket()
+        self.servers.append(server)
+        return server
+
+    def tearDown(self) -> None:
+        for client in self.clients:
+            client.close()
+        for server in self.servers:
+            server.shutdown()
+        self.database.engine.dispose()
+        self.temp_dir.cleanup()
+
+    def poll(self):
+        for server in self.servers:
+            server.poll(0.01 / len(self.servers))
+
+    def poll_until(self, condition):
+        deadline = time.monotonic() + TEST_TIMEOUT
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, 'Server did not get there in time')
+            self.poll()
+
+    def connect(self, server=None):
+        """Client socket and its connection at the server"""
+        server = server or self.server
+        client = create_connection(('127.0.0.1', server.port))
+        client.setblocking(False)
+        self.decoders[client] = FrameDecoder()
+        self.clients.append(client)
+        self.poll_until(lambda: self.server_socket(server, client) is not None)
+        return client, self.server_socket(server, client)
+
+    def server_socket(self, server, client):
+        for sock in server.connections:
+            if sock.getpeername() == client.getsockname():
+                return sock
+
+    def send(self, client, message):
+        client.sendall(encode_message(message))
+
+    def receive(self, client):
+        """Next message to the client, the server loop runs meanwhile"""
+        decoder = self.decoders[client]
+        message = decoder.next_message()
+        deadline = time.monotonic() + TEST_TIMEOUT
+        while message is None:
+            try:
+                data = client.recv(RECV_BUFFER_SIZE)
+            except BlockingIOError:
+                self.assertLess(time.monotonic(), deadline, 'No message from server')
+                self.poll()
+                continue
+            if not data:
+                raise ConnectionResetError('Connection closed by server')
+            decoder.feed(data)
+            message = decoder.next_message()
+        return message
+
+    def presence(self, username, pubkey='key'):
+        return {ACTION: PRESENCE, TIME: time.time(), USER: {ACCOUNT_NAME: username, PUBLIC_KEY: pubkey}}
+
+    def digest(self, challenge, password_hash):
+        digest = hmac.new(password_hash, challenge[DATA].encode('ascii'), 'MD5').digest()
+        return {RESPONSE: 511, DATA: binascii.b2a_base64(digest).decode('ascii')}
+
+    def login(self, username, password_hash, pubkey='key', server=None):
+        """Logged in client, the login DB calls are finished"""
+        server = server or self.server
+        client, sock = self.connect(server)
+        self.send(client, self.presence(username, pubkey))
+        self.send(client, self.digest(self.receive(client), password_hash))
+        self.assertEqual(self.receive(client)[RESPONSE], 200)
+        self.poll_until(lambda: not server.connections[sock].pending)
+        return client, sock
+
+
+class TestLoop(ServerTestCase):
+    def test_accept(self):
+        first, first_sock = self.connect()
+        second, second_sock = self.connect()
+        self.assertIsNot(first_sock, second_sock)
+        self.assertEqual(self.server.metrics.connections, 2)
+        self.assertEqual(self.server.names, {})
+
+    def test_read(self):
+        """Messages which come in one recv and a message split between two are all processed"""
+        client, sock = self.login('test1', b'hash1')
+        frame = encode_message({ACTION: GET_CONTACTS, TIME: 1.1, USER: 'test1', REQUEST_ID: 1})
+        client.sendall(frame * 2 + frame[:5])
+        client.sendall(frame[5:])
+        self.assertEqual([self.receive(client)[REQUEST_ID] for _ in range(3)], [1, 1, 1])
+
+    def test_flush(self):
+        """Data the socket does not take at once is sent when the client reads"""
+        client, sock = self.login('test1', b'hash1')
+        conn = self.server.connections[sock]
+        message = {ACTION: MESSAGE, SENDER: 'test2', DESTINATION: 'test1', TIME: 1.1, MESSAGE_TEXT: 'x' * 10000}
+        sent = 0
+        while not conn.outbound:
+            self.server.try_send_msg_or_close(sock, message)
+            sent += 1
+        self.assertEqual(self.server.selector.get_key(sock).events, selectors.EVENT_READ | selectors.EVENT_WRITE)
+        for _ in range(sent):
+            self.assertEqual(self.receive(client)[MESSAGE_TEXT], message[MESSAGE_TEXT])
+        self.assertFalse(conn.outbound)
+        self.assertEqual(self.server.selector.get_key(sock).events, selectors.EVENT_READ)
+
+    def test_bad_field_types(self):
+        """Lists and dicts in the name fields are answered with 400, the loop goes on"""
+        client, sock = self.login('test1', b'hash1')
+        for message in ({ACTION: GET_CONTACTS, TIME: 1.1, USER: ['test1']},
+                        {ACTION: MESSAGE, SENDER: 'test1', DESTINATION: {'test2': 1}, TIME: 1.1, MESSAGE_TEXT: 'Hi'},
+                        {ACTION: ADD_CONTACT, TIME: 1.1, USER: 'test1', ACCOUNT_NAME: ['test2']}):
+            self.send(client, message)
+            self.assertEqual(self.receive(client)[ERROR], 'Bad request')
+        self.send(client, {ACTION: GET_CONTACTS, TIME: 1.1, USER: 'test1'})
+        self.assertEqual(self.receive(client)[RESPONSE], 202)
+
+    def test_timing_sampled(self):
+        client, sock = self.login('test1', b'hash1')
+        for _ in range(ACTION_TIMING_INTERVAL * 2):
+            self.send(client, {ACTION: GET_CONTACTS, TIME: 1.1, USER: 'test1', REQUEST_ID: 7})
+            self.assertEqual(self.receive(client)[REQUEST_ID], 7)
+        self.assertEqual(self.server.metrics.actions[GET_CONTACTS].count, 2)
+
+    def test_disconnect(self):
+        client, sock = self.login('test1', b'hash1')
+        client.close()
+        self.clients.remove(client)
+        self.poll_until(lambda: not self.server.connections)
+        self.assertEqual(self.server.names, {})
+        # Only the listening socket and the wakeup socket are left
+        self.assertEqual(len(self.server.selector.get_map()), 2)
+        self.assertEqual(sock.fileno(), -1)
+        self.server.executor.submit(lambda: None).result(TEST_TIMEOUT)
+        self.assertEqual(self.database.active_users_list(), [])
+
+    def test_service_calls(self):
+        """Calls of the GUI thread are made by the loop"""
+        client, sock = self.login('test1', b'hash1')
+        other, other_sock = self.login('test2', b'hash2')
+        threads = []
+        for func in (self.server.service_update_lists, lambda: self.server.service_remove_user('test2')):
+            threads.append(threading.Thread(target=func))
+            threads[-1].start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.server.loop_calls), 2)
+        self.assertEqual(self.receive(client)[RESPONSE], 205)
+        self.poll_until(lambda: 'test2' not in self.server.names)
+        self.assertEqual(list(self.server.names), ['test1'])
+
+
+class TestHandshake(ServerTestCase):
+    def assert_dropped(self, client, sock):
+        self.poll_until(lambda: sock not in self.server.connections)
+        self.assertEqual(self.server.names, {})
+
+    def test_states(self):
+        client, sock = self.connect()
+        conn = self.server.connections[sock]
+        self.assertEqual(conn.auth_state, WAIT_PRESENCE)
+        self.send(client, self.presence('test1'))
+        challenge = self.receive(client)
+        self.assertEqual(challenge[RESPONSE], 511)
+        self.assertEqual((conn.auth_state, conn.auth_username, conn.auth_pubkey), (WAIT_DIGEST, 'test1', 'key'))
+        self.assertEqual(self.server.names, {})
+
+        self.send(client, self.digest(challenge, b'hash1'))
+        answer = self.receive(client)
+        self.assertEqual(answer[RESPONSE], 200)
+        self.assertIn(TOKEN, answer)
+        self.assertEqual((conn.auth_state, conn.username, conn.auth_digest), (AUTHORISED, 'test1', None))
+        self.assertIs(self.server.names['test1'], sock)
+
+    def test_overlapping_handshakes(self):
+        """The second client logs in while the first one thinks over its answer"""
+        first, first_sock = self.connect()
+        self.send(first, self.presence('test1'))
+        challenge = self.receive(first)
+        self.login('test2', b'hash2')
+        self.send(first, self.digest(challenge, b'hash1'))
+        self.assertEqual(self.receive(first)[RESPONSE], 200)
+        self.assertEqual(set(self.server.names), {'test1', 'test2'})
+
+    def test_wrong_password(self):
+        client, sock = self.connect()
+        self.send(client, self.presence('test1'))
+        self.send(client, self.digest(self.receive(client), b'hash2'))
+        self.assertEqual(self.receive(client)[ERROR], 'Wrong password')
+        self.assert_dropped(client, sock)
+
+    def test_unknown_user(self):
+        client, sock = self.connect()
+        self.send(client, self.presence('test3'))
+        self.assertEqual(self.receive(client)[RESPONSE], 400)
+        self.assertEqual(self.server.connections[sock].auth_state, WAIT_PRESENCE)
+
+    def test_requests_before_login(self):
+        client, sock = self.connect()
+        self.send(client, {ACTION: GET_CONTACTS, TIME: 1.1, USER: 'test1'})
+        self.assertEqual(self.receive(client)[ERROR], 'Authorisation required')
+        self.assertEqual(self.server.connections[sock].auth_state, WAIT_PRESENCE)
+
+    def test_malformed_presence(self):
+        for user in ({ACCOUNT_NAME: 'test1'}, {PUBLIC_KEY: 'key'}, 'test1', {ACCOUNT_NAME: ['test1'], PUBLIC_KEY: 'key'}):
+            client, sock = self.connect()
+            self.send(client, {ACTION: PRESENCE, TIME: 1.1, USER: user})
+            self.assertEqual(self.receive(client)[RESPONSE], 400)
+            self.assert_dropped(client, sock)
+
+    def test_deadline(self):
+        with mock.patch('server.core.AUTH_TIMEOUT', 0.1):
+            silent, silent_sock = self.connect()
+            thinking, thinking_sock = self.connect()
+            self.send(thinking, self.presence('test1'))
+            self.receive(thinking)
+            client, sock = self.login('test2', b'hash2')
+        self.assertEqual(len(self.server.handshake_deadlines), 3)
+        time.sleep(0.1)
+        self.poll_until(lambda: not self.server.handshake_deadlines)
+        self.assertEqual(list(self.server.connections), [sock])
+        self.assertEqual(list(self.server.names), ['test2'])
+
+
+class TestRegistry(ServerTestCase):
+    def assert_consistent(self):
+        """names is the reverse of Connection.username of the logged in clients"""
+        for username, sock in self.server.names.items():
+            self.assertIn(sock, self.server.connections)
+            self.assertEqual(self.server.connections[sock].username, username)
+        for sock, conn in self.server.connections.items():
+            if conn.auth_state == AUTHORISED:
+                self.assertIs(self.server.names[conn.username], sock)
+
+    def disconnect(self, client, sock):
+        client.close()
+        self.clients.remove(client)
+        self.poll_until(lambda: sock not in self.server.connections)
+
+    def test_login(self):
+        client, sock = self.login('test1', b'hash1')
+        other, other_sock = self.login('test2', b'hash2')
+        self.assertEqual(self.server.names, {'test1': sock, 'test2': other_sock})
+        self.assert_consistent()
+
+    def test_second_login_refused(self):
+        client, sock = self.login('test1', b'hash1')
+        second, second_sock = self.connect()
+        self.send(second, self.presence('test1'))
+        self.assertEqual(self.receive(second)[ERROR], 'User with such name already exists.')
+        self.assertEqual(self.server.names, {'test1': sock})
+        self.assertIsNone(self.server.connections[second_sock].username)
+        self.assert_consistent()
+
+    def test_login_again(self):
+        client, sock = self.login('test1', b'hash1')
+        self.disconnect(client, sock)
+        self.assertEqual(self.server.names, {})
+        client, new_sock = self.login('test1', b'hash1')
+        self.assertEqual(self.server.names, {'test1': new_sock})
+        self.assertEqual(list(self.server.connections), [new_sock])
+        self.assert_consistent()
+
+    def test_exit(self):
+        client, sock = self.login('test1', b'hash1')
+        other, other_sock = self.login('test2', b'hash2')
+        self.send(client, {ACTION: EXIT, TIME: 1.1, ACCOUNT_NAME: 'test1'})
+        self.poll_until(lambda: sock not in self.server.connections)
+        self.assertEqual(self.server.names, {'test2': other_sock})
+        self.assert_consistent()
+
+    def test_key_changed(self):
+        """New key is pushed only to the online users who have the user in contacts"""
+        self.database.add_user('test3', b'hash3')
+        self.database.add_contact('test2', 'test1')
+        client, sock = self.login('test1', b'hash1')
+        self.disconnect(client, sock)
+        owner, owner_sock = self.login('test2', b'hash2')
+        other, other_sock = self.login('test3', b'hash3')
+        self.login('test1', b'hash1', pubkey='key2')
+        message = self.receive(owner)
+        self.assertEqual((message[ACTION], message[ACCOUNT_NAME], message[PUBLIC_KEY]),
+                         (PUBLIC_KEY_CHANGED, 'test1', 'key2'))
+        # Nothing came to the other user before the answer to its request
+        self.send(other, {ACTION: GET_CONTACTS, TIME: 1.1, USER: 'test3'})
+        self.assertEqual(self.receive(other)[RESPONSE], 202)
+
+    def test_remove_old_connection(self):
+        """Removing a connection does not remove the name which belongs to the other connection now"""
+        client, sock = self.login('test1', b'hash1')
+        old, old_sock = self.connect()
+        self.server.connections[old_sock].username = 'test1'
+        self.server.remove_client(old_sock)
+        self.assertEqual(self.server.names, {'test1': sock})
+        self.assert_consistent()
+
+
+class TestStorageCalls(ServerTestCase):
+    def block(self, method):
+        """The DB thread waits in the ServerStorage method until the returned event is set"""
+        release = threading.Event()
+        func = getattr(self.database, method)
+
+        def blocked(*args):
+            release.wait(TEST_TIMEOUT)
+            return func(*args)
+
+        setattr(self.database, method, blocked)
+        self.addCleanup(release.set)
+        return release
+
+    def test_result(self):
+        client, sock = self.login('test1', b'hash1')
+        conn = self.server.connections[sock]
+        results = []
+        self.server.storage_call(sock, results.append, self.database.check_user, 'test2')
+        self.assertEqual(conn.pending, 1)
+        self.poll_until(lambda: results)
+        self.assertEqual((results, conn.pending), ([True], 0))
+
+    def test_error(self):
+        client, sock = self.login('test1', b'hash1')
+        results = []
+        self.server.storage_call(sock, results.append, self.database.get_hash, 'test3')
+        self.assertEqual(self.receive(client)[ERROR], 'Server error')
+        self.assertEqual(results, [])
+        self.assertEqual(self.server.connections[sock].pending, 0)
+
+    def test_client_gone(self):
+        """Result of the call is dropped if the client disconnects meanwhile"""
+        client, sock = self.login('test1', b'hash1')
+        release = self.block('check_user')
+        results = []
+        self.server.storage_call(sock, results.append, self.database.check_user, 'test2')
+        self.server.remove_client(sock)
+        release.set()
+        self.server.executor.submit(lambda: None).result(TEST_TIMEOUT)
+        self.poll_until(lambda: not self.server.completions)
+        self.assertEqual(results, [])
+
+    def test_reply_order(self):
+        """Requests which come while the DB call is made wait for it, so the replies keep the order"""
+        client, sock = self.login('test1', b'hash1')
+        self.login('test2', b'hash2')
+        conn = self.server.connections[sock]
+        release = self.block('get_contacts')
+        self.send(client, {ACTION: GET_CONTACTS, TIME: 1.1, USER: 'test1', REQUEST_ID: 1})
+        self.send(client, {ACTION: MESSAGE, SENDER: 'test1', DESTINATION: 'test2', TIME: 1.1, MESSAGE_TEXT: 'Hi',
+                           REQUEST_ID: 2})
+        self.send(client, {ACTION: ADD_CONTACT, TIME: 1.1, USER: 'test1', ACCOUNT_NAME: 'test2', REQUEST_ID: 3})
+        self.poll_until(lambda: len(conn.deferred) == 2)
+        # Nothing more is read from the client until the deferred requests are served
+        self.assertEqual(self.server.selector.get_key(sock).events, 0)
+        release.set()
+        self.assertEqual([self.receive(client)[REQUEST_ID] for _ in range(3)], [1, 2, 3])
+        self.assertEqual(self.server.selector.get_key(sock).events, selectors.EVENT_READ)
+
+    def test_counters_flush_queued_once(self):
+        """Counters stay due until the DB thread writes them, the loop must not queue a flush every iteration"""
+        flushes = []
+        due = [True]
+        self.database.counters_due = lambda: due[0]
+        release = self.block('flush_counters')
+        self.database.flush_counters = lambda flush=self.database.flush_counters: flushes.append(flush())
+        for _ in range(5):
+            self.server.after_select()
+        self.assertTrue(self.server.counters_flushing)
+        release.set()
+        due[0] = False
+        self.poll_until(lambda: not self.server.counters_flushing)
+        self.assertEqual(len(flushes), 1)
+        due[0] = True
+        self.server.after_select()
+        self.assertTrue(self.server.counters_flushing)
+
+    def test_callback_error(self):
+        """Error in the callback is answered with 400, the loop goes on"""
+        client, sock = self.login('test1', b'hash1')
+
+        def callback(result):
+            raise TypeError('Bad callback')
+
+        self.server.storage_call(sock, callback, self.database.check_user, 'test2')
+        self.assertEqual(self.receive(client)[ERROR], 'Server error')
+        self.send(client, {ACTION: GET_CONTACTS, TIME: 1.1, USER: 'test1'})
+        self.assertEqual(self.receive(client)[RESPONSE], 202)
+
+
+class TestResume(ServerTestCase):
+    def resume(self, token, user=None):
+        client, sock = self.connect()
+        self.send(client, {ACTION: RESUME, TIME: 1.1, USER: user or {ACCOUNT_NAME: 'test1'}, TOKEN: token})
+        return client, sock, self.receive(client)
+
+    def test_valid(self):
+        client, sock = self.login('test1', b'hash1')
+        client.close()
+        self.clients.remove(client)
+        self.poll_until(lambda: not self.server.names)
+        client, sock, answer = self.resume(make_token(b'hash1', 'test1'))
+        self.assertEqual(answer[RESPONSE], 200)
+        self.assertIn(TOKEN, answer)
+        self.assertEqual(self.server.names, {'test1': sock})
+        self.assertEqual(self.server.connections[sock].auth_state, AUTHORISED)
+
+    def test_expired(self):
+        """Expired token is refused, the client can log in with the password on the same connection"""
+        with mock.patch('time.time', return_value=time.time() - RESUME_TOKEN_TTL - 1):
+            token = make_token(b'hash1', 'test1')
+        client, sock, answer = self.resume(token)
+        self.assertEqual((answer[RESPONSE], answer[ERROR]), (400, 'Session expired'))
+        self.assertEqual(self.server.names, {})
+        self.send(client, self.presence('test1'))
+        self.assertEqual(self.receive(client)[RESPONSE], 511)
+
+    def test_malformed(self):
+        """Tokens and names of any type are refused and do not stop the server"""
+        for token in ('99999999999:\u00e9', None, 12, ['1', '2'], 'abc', '1:2:3'):
+            client, sock, answer = self.resume(token)
+            self.assertEqual((answer[RESPONSE], answer[ERROR]), (400, 'Session expired'))
+        client, sock, answer = self.resume(make_token(b'hash1', 'test1'), {ACCOUNT_NAME: ['test1']})
+        self.assertEqual(answer[ERROR], 'Session expired')
+        self.login('test2', b'hash2')
+
+
+class TestAsyncHandshake(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.database = ServerStorage(os.path.join(self.temp_dir.name, 'server.db3'))
+        self.server = AsyncMessageProcessor('127.0.0.1', free_port(), self.database)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.server.start()
+            deadline = time.monotonic() + TEST_TIMEOUT
+            while True:
+                try:
+                    self.client = create_connection(('127.0.0.1', self.server.port))
+                    break
+                except ConnectionRefusedError:
+                    self.assertLess(time.monotonic(), deadline)
+                    time.sleep(0.01)
+        self.client.settimeout(TEST_TIMEOUT)
+
+    def tearDown(self) -> None:
+        self.client.close()
+        self.server.running = False
+        self.server.join()
+        self.database.engine.dispose()
+        self.temp_dir.cleanup()
+
+    def test_malformed_presence(self):
+        self.client.sendall(encode_message({ACTION: PRESENCE, TIME: 1.1, USER: {ACCOUNT_NAME: 'test1'}}))
+        decoder = FrameDecoder()
+        message = None
+        while message is None:
+            data = self.client.recv(RECV_BUFFER_SIZE)
+            self.assertTrue(data)
+            decoder.feed(data)
+            message = decoder.next_message()
+        self.assertEqual(message[RESPONSE], 400)
+        self.assertEqual(self.client.recv(RECV_BUFFER_SIZE), b'')
+
+
+class TestOutboundPolicy(ServerTestCase):
+    """The client does not read, so the server send buffer grows"""
+
+    def slow_client(self, policy):
+        self.server.outbound_policy = policy
+        self.server.high_watermark = 64 * 1024
+        self.server.low_watermark = 16 * 1024
+        self.server.hard_limit = 256 * 1024
+        client, sock = self.login('test1', b'hash1')
+        return client, sock, self.server.connections[sock]
+
+    def message(self, number):
+        return {ACTION: MESSAGE, SENDER: 'test2', DESTINATION: 'test1', TIME: 1.1, MESSAGE_TEXT: f'{number:01000}'}
+
+    def fill(self, sock, condition, start=0):
+        """Send messages to the client until the condition is true, returns the number of the next message"""
+        number = start
+        while sock in self.server.connections and not condition():
+            self.server.try_send_msg_or_close(sock, self.message(number))
+            number += 1
+        return number
+
+    def receive_all(self, client, count):
+        for number in range(count):
+            self.assertEqual(self.receive(client)[MESSAGE_TEXT], self.message(number)[MESSAGE_TEXT])
+
+    def test_pause_and_resume(self):
+        client, sock, conn = self.slow_client('pause')
+        sent = self.fill(sock, lambda: conn.paused)
+        self.assertGreater(len(conn.outbound), self.server.high_watermark)
+        self.assertEqual(self.server.selector.get_key(sock).events, selectors.EVENT_WRITE)
+
+        # Requests of the paused client wait
+        self.send(client, {ACTION: GET_CONTACTS, TIME: 1.1, USER: 'test1'})
+        for _ in range(5):
+            self.poll()
+        self.assertEqual(conn.messages_in, 2)
+
+        # The client takes its data: it is read again after the buffer is below the low watermark
+        self.receive_all(client, sent)
+        self.assertFalse(conn.paused)
+        self.assertEqual(self.receive(client)[RESPONSE], 202)
+        self.assertEqual(self.server.selector.get_key(sock).events, selectors.EVENT_READ)
+
+    def test_drop(self):
+        client, sock, conn = self.slow_client('drop')
+        self.fill(sock, lambda: False)
+        self.assertNotIn(sock, self.server.connections)
+        self.assertNotIn('test1', self.server.names)
+
+    def test_hard_limit(self):
+        """Messages to the paused client are still queued, up to the hard limit"""
+        client, sock, conn = self.slow_client('pause')
+        self.fill(sock, lambda: conn.paused)
+        # The client is disconnected as soon as the buffer is above the limit, so the condition is never true
+        self.fill(sock, lambda: len(conn.outbound) > self.server.hard_limit)
+        self.assertNotIn(sock, self.server.connections)
+        self.assertFalse(conn.outbound)
+
+    def test_spill(self):
+        client, sock, conn = self.slow_client('spill')
+        sent = self.fill(sock, lambda: len(conn.outbound) > self.server.hard_limit / 2)
+        self.assertIn(sock, self.server.connections)
+        self.assertFalse(conn.paused)
+        self.assertGreater(conn.outbound.spilled, 0)
+        self.assertLessEqual(len(conn.outbound.memory), self.server.high_watermark)
+        self.receive_all(client, sent)
+        self.assertFalse(conn.outbound)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+import os
+import sys
+
+from Crypto.PublicKey import RSA
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+from client.crypto import MessageCipher
+from client.client_database import key_fingerprint
+from common.variables import SENDER, DESTINATION, MESSAGE_TEXT, SESSION_KEY, KEY_ID, SESSION_KEY_MESSAGES
+
+
+class TestMessageCipher(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.alice_keys = RSA.generate(1024)
+        cls.bob_keys = RSA.generate(1024)
+
+    def setUp(self) -> None:
+        self.alice = MessageCipher(self.alice_keys)
+        self.bob = MessageCipher(self.bob_keys)
+        pem = self.bob_keys.publickey().export_key().decode('ascii')
+        self.bob_key = (key_fingerprint(pem), pem)
+
+    def message(self, text):
+        message = {SENDER: 'alice', DESTINATION: 'bob'}
+        message.update(self.alice.encrypt('alice', 'bob', self.bob_key, text))
+        return message
+
+    def test_round_trip(self):
+        text = 'Hi! ' * 1000
+        message = self.message(text)
+        self.assertNotIn('Hi!', message[MESSAGE_TEXT])
+        self.assertEqual(self.bob.decrypt(message), text)
+
+    def test_session_key_cached(self):
+        first, second = self.message('one'), self.message('two')
+        self.assertEqual(first[KEY_ID], second[KEY_ID])
+        self.assertEqual(first[SESSION_KEY], second[SESSION_KEY])
+        self.assertEqual([self.bob.decrypt(first), self.bob.decrypt(second)], ['one', 'two'])
+        self.assertEqual(len(self.bob.incoming), 1)
+
+    def test_rotation(self):
+        first = self.message('one')
+        self.alice.outgoing['bob'].messages = SESSION_KEY_MESSAGES
+        second = self.message('two')
+        self.assertNotEqual(first[KEY_ID], second[KEY_ID])
+        self.assertEqual(self.bob.decrypt(second), 'two')
+
+    def test_tampered(self):
+        message = self.message('one')
+        message[DESTINATION] = 'carol'
+        self.assertRaises(ValueError, self.bob.decrypt, message)
+
+    def test_wrong_recipient(self):
+        message = self.message('one')
+        self.assertRaises(ValueError, self.alice.decrypt, message)
+
+
+if __name__ == '__main__':
+    unittest.main()
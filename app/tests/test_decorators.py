@@ -0,0 +1,40 @@
+import unittest
+import os
+import sys
+import logging
+from unittest import mock
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+from common import decorators
+
+
+def add(a, b):
+    return a + b
+
+
+class TestLog(unittest.TestCase):
+    def test_disabled(self):
+        with mock.patch.object(decorators, 'TRACE_SAMPLE_RATE', 0):
+            self.assertIs(decorators.log(add), add)
+
+    def test_sampling(self):
+        with mock.patch.object(decorators, 'TRACE_SAMPLE_RATE', 2):
+            traced = decorators.log(add)
+        logger = logging.getLogger('client_log')
+        with mock.patch.object(logger, 'debug') as debug:
+            for i in range(4):
+                self.assertEqual(traced(i, 1), i + 1)
+        self.assertEqual(debug.call_count, 2)
+        self.assertEqual(debug.call_args[0][1:], ('add', (2, 1), {}, __name__, 'test_sampling'))
+
+    def test_level_checked_first(self):
+        traced = decorators.log(add)
+        logger = logging.getLogger('client_log')
+        with mock.patch.object(logger, 'isEnabledFor', return_value=False), \
+                mock.patch.object(logger, 'debug') as debug:
+            traced(1, 2)
+        debug.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
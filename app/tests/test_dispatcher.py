@@ -0,0 +1,63 @@
+import unittest
+import os
+import sys
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+from common.variables import TIME, ACTION, MESSAGE, SENDER, DESTINATION, MESSAGE_TEXT, PUBLIC_KEY_REQUEST, \
+    ACCOUNT_NAME
+from server.dispatcher import ActionDispatcher
+
+
+class TestActionDispatcher(unittest.TestCase):
+    def setUp(self) -> None:
+        self.client = object()
+        self.names = {'Test': self.client}
+        self.calls = []
+        self.dispatcher = ActionDispatcher(self.names)
+        self.dispatcher.register(MESSAGE, lambda message, client: self.calls.append(message),
+                                 (DESTINATION, TIME, MESSAGE_TEXT), owner=SENDER, strings=(DESTINATION,))
+        self.dispatcher.register(PUBLIC_KEY_REQUEST, lambda message, client: self.calls.append(message),
+                                 (ACCOUNT_NAME,))
+        self.message = {ACTION: MESSAGE, SENDER: 'Test', DESTINATION: 'Guest', TIME: 1.1, MESSAGE_TEXT: 'Hi'}
+
+    def test_dispatch_ok(self):
+        self.assertTrue(self.dispatcher.dispatch(self.message, self.client))
+        self.assertEqual(self.calls, [self.message])
+
+    def test_missing_field(self):
+        del self.message[MESSAGE_TEXT]
+        self.assertFalse(self.dispatcher.dispatch(self.message, self.client))
+        self.assertEqual(self.calls, [])
+
+    def test_not_owner(self):
+        """Sender must be logged in on the same connection"""
+        self.assertFalse(self.dispatcher.dispatch(self.message, object()))
+        self.message[SENDER] = 'Guest'
+        self.assertFalse(self.dispatcher.dispatch(self.message, self.client))
+        self.assertEqual(self.calls, [])
+
+    def test_field_types(self):
+        """Names of a wrong type are refused, not looked up"""
+        for value in (['Test'], {'Test': 1}, None, 1):
+            self.assertFalse(self.dispatcher.dispatch(dict(self.message, **{SENDER: value}), self.client))
+            self.assertFalse(self.dispatcher.dispatch(dict(self.message, **{DESTINATION: value}), self.client))
+        self.assertEqual(self.calls, [])
+
+    def test_without_owner(self):
+        message = {ACTION: PUBLIC_KEY_REQUEST, ACCOUNT_NAME: 'Guest'}
+        self.assertTrue(self.dispatcher.dispatch(message, object()))
+
+    def test_unknown_action(self):
+        self.assertFalse(self.dispatcher.dispatch({ACTION: 'unknown'}, self.client))
+        self.assertFalse(self.dispatcher.dispatch({TIME: 1.1}, self.client))
+        self.assertFalse(self.dispatcher.dispatch({ACTION: ['list']}, self.client))
+
+    def test_register_new_action(self):
+        self.dispatcher.register('ping', lambda message, client: self.calls.append(message))
+        self.assertTrue(self.dispatcher.dispatch({ACTION: 'ping'}, self.client))
+        self.dispatcher.unregister('ping')
+        self.assertFalse(self.dispatcher.dispatch({ACTION: 'ping'}, self.client))
+
+
+if __name__ == '__main__':
+    unittest.main()
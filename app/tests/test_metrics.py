@@ -0,0 +1,62 @@
+import unittest
+import os
+import random
+import sys
+from types import SimpleNamespace
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+from server.metrics import Histogram, ServerMetrics
+
+
+class TestHistogram(unittest.TestCase):
+    def test_small_values_exact(self):
+        histogram = Histogram(precision_bits=7)
+        for value in range(1, 101):
+            histogram.record(value)
+        self.assertEqual(histogram.quantile(0.5), 50)
+        self.assertEqual(histogram.quantile(0.99), 99)
+        self.assertEqual(histogram.count, 100)
+        self.assertEqual(histogram.total, 5050)
+
+    def test_relative_error(self):
+        histogram = Histogram(precision_bits=7)
+        values = sorted(random.randint(1, 10 ** 9) for _ in range(10000))
+        for value in values:
+            histogram.record(value)
+        for q in (0.5, 0.99, 0.999):
+            expected = values[round(q * len(values)) - 1]
+            self.assertGreaterEqual(histogram.quantile(q), expected)
+            self.assertLessEqual(histogram.quantile(q), expected * (1 + 2 ** -6))
+
+    def test_bucket_limits(self):
+        histogram = Histogram(precision_bits=4)
+        for value in range(5000):
+            index = histogram.index(value)
+            self.assertLessEqual(value, histogram.bucket_limit(index))
+            if index:
+                self.assertGreater(value, histogram.bucket_limit(index - 1))
+
+    def test_max_value(self):
+        histogram = Histogram(max_value=1000)
+        histogram.record(10 ** 6)
+        self.assertEqual(histogram.quantile(1), histogram.bucket_limit(histogram.index(1000)))
+
+
+class TestServerMetrics(unittest.TestCase):
+    def test_render(self):
+        metrics = ServerMetrics()
+        metrics.connections = 3
+        metrics.action_time('message', 100)
+        metrics.db_time.record(1000)
+        server = SimpleNamespace(connections={1: 1}, names={}, queue_depths=lambda: [('test1', 10)])
+        text = metrics.render(server)
+        self.assertIn('messenger_connections_total 3\n', text)
+        self.assertIn('messenger_connections_open 1\n', text)
+        self.assertIn('messenger_outbound_queued_bytes 10\n', text)
+        self.assertIn('messenger_action_seconds{action="message",quantile="0.5"} 0.0001\n', text)
+        self.assertIn('messenger_action_seconds_count{action="message"} 1\n', text)
+        self.assertIn('messenger_db_call_seconds_sum 0.001\n', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
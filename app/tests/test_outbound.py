@@ -0,0 +1,76 @@
+import unittest
+import os
+import sys
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+from server.outbound import OutboundBuffer
+
+
+class PartialSocket:
+    """Mock socket which takes at most limit bytes per send"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.data = bytearray()
+
+    def send(self, data):
+        sent = min(len(data), self.limit)
+        self.data += data[:sent]
+        return sent
+
+
+class TestOutboundBuffer(unittest.TestCase):
+    def test_partial_send(self):
+        buffer = OutboundBuffer(1000)
+        buffer.append(b'a' * 10)
+        buffer.append(b'b' * 10)
+        sock = PartialSocket(7)
+        self.assertEqual(buffer.send(sock), 7)
+        self.assertEqual(len(buffer), 13)
+        while buffer:
+            buffer.send(sock)
+        self.assertEqual(bytes(sock.data), b'a' * 10 + b'b' * 10)
+
+    def test_memory_only(self):
+        """Without spill the buffer grows in memory, the limits are checked by the server"""
+        buffer = OutboundBuffer(10)
+        buffer.append(b'x' * 100)
+        self.assertEqual(len(buffer), 100)
+        self.assertIsNone(buffer.spill_file)
+
+    def test_spill(self):
+        buffer = OutboundBuffer(10, spill=True)
+        chunks = [bytes([ord('a') + index]) * 6 for index in range(5)]
+        for chunk in chunks:
+            buffer.append(chunk)
+        self.assertEqual(len(buffer.memory), 6)
+        self.assertEqual(buffer.spilled, 24)
+        self.assertEqual(len(buffer), 30)
+        sock = PartialSocket(4)
+        while buffer:
+            buffer.send(sock)
+        self.assertEqual(bytes(sock.data), b''.join(chunks))
+        self.assertEqual(buffer.spill_position, 0)
+
+    def test_spill_keeps_order(self):
+        """Data which comes while the spilled part is sent goes after it"""
+        buffer = OutboundBuffer(4, spill=True)
+        buffer.append(b'1234')
+        buffer.append(b'5678')
+        sock = PartialSocket(4)
+        buffer.send(sock)
+        buffer.append(b'9')
+        while buffer:
+            buffer.send(sock)
+        self.assertEqual(bytes(sock.data), b'123456789')
+
+    def test_close(self):
+        buffer = OutboundBuffer(4, spill=True)
+        buffer.append(b'123456789')
+        buffer.close()
+        self.assertFalse(buffer)
+        self.assertIsNone(buffer.spill_file)
+
+
+if __name__ == '__main__':
+    unittest.main()
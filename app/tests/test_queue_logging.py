@@ -0,0 +1,105 @@
+import unittest
+import logging
+import os
+import queue
+import sys
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+from logs.queue_logging import DroppingQueueHandler, LogListener, set_level
+
+
+class MemoryHandler(logging.Handler):
+    """Keeps the handled records, counts the flushes"""
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+        self.flushes = 0
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def flush_batch(self):
+        self.flushes += 1
+
+
+def make_record(level, msg='test'):
+    return logging.makeLogRecord({'levelno': level, 'levelname': logging.getLevelName(level), 'msg': msg})
+
+
+class TestQueueLogging(unittest.TestCase):
+    def test_debug_dropped_first(self):
+        handler = DroppingQueueHandler(queue.Queue(4), debug_limit=2)
+        for _ in range(3):
+            handler.handle(make_record(logging.DEBUG))
+        handler.handle(make_record(logging.INFO))
+        handler.handle(make_record(logging.ERROR))
+        handler.handle(make_record(logging.ERROR))
+        self.assertEqual(handler.queue.qsize(), 4)
+        self.assertEqual(handler.take_dropped(), 2)
+        self.assertEqual(handler.take_dropped(), 0)
+
+    def test_batch_flush(self):
+        queue_handler = DroppingQueueHandler(queue.Queue(1000))
+        handler = MemoryHandler()
+        for i in range(10):
+            queue_handler.handle(make_record(logging.INFO, str(i)))
+        # The stop mark is queued before the start, so all the records are one batch
+        queue_handler.queue.put(None)
+        listener = LogListener(queue_handler, handler, batch_size=100)
+        listener.start()
+        listener.thread.join()
+        self.assertEqual([record.msg for record in handler.records], [str(i) for i in range(10)])
+        self.assertEqual(handler.flushes, 1)
+
+    def test_dropped_reported(self):
+        queue_handler = DroppingQueueHandler(queue.Queue(1))
+        handler = MemoryHandler()
+        queue_handler.handle(make_record(logging.INFO))
+        queue_handler.handle(make_record(logging.INFO))
+        listener = LogListener(queue_handler, handler)
+        listener.start()
+        listener.stop()
+        self.assertEqual(handler.records[-1].levelno, logging.WARNING)
+        self.assertIn('1 log records were dropped', handler.records[-1].getMessage())
+
+    def test_formatted_by_listener(self):
+        """Neither the dropped nor the queued records are formatted by the thread which logs"""
+        formatted = []
+
+        class Arg:
+            def __str__(self):
+                formatted.append(self)
+                return 'arg'
+
+        queue_handler = DroppingQueueHandler(queue.Queue(4), debug_limit=1)
+        queue_handler.handle(make_record(logging.INFO))
+        debug = make_record(logging.DEBUG, 'debug %s')
+        debug.args = (Arg(),)
+        queue_handler.handle(debug)
+        args = [Arg()]
+        info = make_record(logging.INFO, 'info %s')
+        info.args = args
+        queue_handler.handle(info)
+        args.append('changed')
+        self.assertEqual((formatted, queue_handler.take_dropped()), ([], 1))
+        queue_handler.queue.put(None)
+        handler = MemoryHandler()
+        listener = LogListener(queue_handler, handler)
+        listener.start()
+        listener.thread.join()
+        self.assertEqual(handler.records[1].getMessage(), 'info arg')
+        self.assertEqual(len(formatted), 1)
+
+    def test_set_level(self):
+        logger = logging.getLogger('test_queue_logging')
+        set_level('warning', ('test_queue_logging',))
+        self.assertEqual(logger.level, logging.WARNING)
+        set_level(logging.DEBUG, ('test_queue_logging',))
+        self.assertEqual(logger.level, logging.DEBUG)
+        with self.assertRaises(ValueError):
+            set_level('verbose', ('test_queue_logging',))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,337 @@
+import unittest
+import os
+import sys
+import sqlite3
+import tempfile
+import threading
+from unittest import mock
+
+from sqlalchemy.exc import OperationalError
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+from server.server_database import ServerStorage
+from server.migrations import SCHEMA_VERSION, upgrade
+from common.variables import VERSION, FULL, USERS, CONTACTS, ADDED, REMOVED
+
+# Enough for any DB call of the tests, seconds
+DB_TIMEOUT = 2
+
+
+class TestUserCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.database = ServerStorage(':memory:')
+        self.database.add_user('test1', b'hash1')
+        self.database.add_user('test2', b'hash2')
+
+    def tearDown(self) -> None:
+        self.database.session.close()
+        self.database.engine.dispose()
+
+    def test_hit(self):
+        self.assertTrue(self.database.check_user('test1'))
+        self.assertEqual(self.database.get_hash('test2'), b'hash2')
+        self.assertEqual(self.database.cache_hits, 2)
+        self.assertEqual(self.database.cache_misses, 0)
+
+    def test_miss(self):
+        self.assertFalse(self.database.check_user('test3'))
+        self.database.users.clear()
+        self.assertTrue(self.database.check_user('test1'))
+        self.assertTrue(self.database.check_user('test1'))
+        self.assertEqual(self.database.cache_misses, 2)
+        self.assertEqual(self.database.cache_hits, 1)
+
+    def test_load_users(self):
+        self.database.users.clear()
+        self.database.load_users()
+        self.assertEqual(set(self.database.users), {'test1', 'test2'})
+
+    def test_login_updates_pubkey(self):
+        self.database.user_login('test1', '127.0.0.1', 7777, 'key1')
+        self.assertEqual(self.database.get_pubkey('test1'), 'key1')
+
+    def test_login_key_changed(self):
+        self.assertFalse(self.database.user_login('test1', '127.0.0.1', 7777, 'key1'))
+        self.assertFalse(self.database.user_login('test1', '127.0.0.1', 7777, 'key1'))
+        self.assertTrue(self.database.user_login('test1', '127.0.0.1', 7777, 'key2'))
+
+    def test_get_pubkeys(self):
+        self.database.user_login('test1', '127.0.0.1', 7777, 'key1')
+        self.assertEqual(self.database.get_pubkeys(['test1', 'test2', 'test3']), {'test1': 'key1'})
+
+    def test_contact_owners(self):
+        self.database.add_user('test3', b'hash3')
+        self.database.add_contact('test2', 'test1')
+        self.database.add_contact('test1', 'test3')
+        self.assertEqual(self.database.contact_owners('test1'), ['test2'])
+        self.assertEqual(self.database.contact_owners('test2'), [])
+        self.assertEqual(self.database.contact_owners('test4'), [])
+
+    def test_remove_user(self):
+        self.database.remove_user('test1')
+        self.assertFalse(self.database.check_user('test1'))
+
+    def test_remove_user_read_meanwhile(self):
+        """The user read into the cache by the other thread before the commit is not left there"""
+        entry = self.database.get_user('test1')
+        log_change = self.database.log_change
+
+        def read_meanwhile(*args):
+            self.database.users['test1'] = entry
+            log_change(*args)
+
+        self.database.log_change = read_meanwhile
+        self.database.remove_user('test1')
+        self.assertFalse(self.database.check_user('test1'))
+
+    def test_message_of_removed_user(self):
+        self.database.remove_user('test1')
+        with self.assertLogs('server_log', 'WARNING'):
+            self.database.process_message('test1', 'test2')
+        self.assertEqual(self.database.counters, {})
+
+    def test_process_message(self):
+        """Message counters are updated without username lookups"""
+        self.database.process_message('test1', 'test2')
+        self.assertEqual(self.database.cache_misses, 0)
+        history = {row[0]: row[2:] for row in self.database.message_history()}
+        self.assertEqual(history, {'test1': (1, 0), 'test2': (0, 1)})
+
+
+class TestMessageCounters(unittest.TestCase):
+    def setUp(self) -> None:
+        self.database = ServerStorage(':memory:', flush_interval=60, flush_messages=3)
+        self.database.add_user('test1', b'hash1')
+        self.database.add_user('test2', b'hash2')
+
+    def tearDown(self) -> None:
+        self.database.session.close()
+        self.database.engine.dispose()
+
+    def stored_counters(self):
+        """Counters as they are written in DB"""
+        rows = self.database.session.query(ServerStorage.UserHistory.sent, ServerStorage.UserHistory.accepted)
+        return sorted(tuple(row) for row in rows.all())
+
+    def test_write_behind(self):
+        self.database.process_message('test1', 'test2')
+        self.database.process_message('test1', 'test2')
+        self.assertEqual(self.stored_counters(), [(0, 0), (0, 0)])
+        history = {row[0]: row[2:] for row in self.database.message_history()}
+        self.assertEqual(history, {'test1': (2, 0), 'test2': (0, 2)})
+
+    def test_flush_by_count(self):
+        for _ in range(3):
+            self.database.process_message('test2', 'test1')
+        self.assertEqual(self.stored_counters(), [(0, 3), (3, 0)])
+        self.assertEqual(self.database.counters, {})
+
+    def test_flush_by_time(self):
+        self.database.process_message('test1', 'test2')
+        self.database.flush_counters_if_due()
+        self.assertEqual(self.stored_counters(), [(0, 0), (0, 0)])
+        self.database.flush_interval = 0
+        self.database.flush_counters_if_due()
+        self.assertEqual(self.stored_counters(), [(0, 1), (1, 0)])
+
+    def test_failed_flush(self):
+        """Counters which were not written are kept and written by the next flush"""
+        self.database.process_message('test1', 'test2')
+        execute = self.database.session.execute
+        self.database.session.execute = mock.Mock(side_effect=OperationalError('UPDATE', {}, Exception('locked')))
+        with self.assertLogs('server_log', 'ERROR'), self.assertRaises(OperationalError):
+            self.database.flush_counters()
+        self.database.session.execute = execute
+        history = {row[0]: row[2:] for row in self.database.message_history()}
+        self.assertEqual(history, {'test1': (1, 0), 'test2': (0, 1)})
+        self.database.flush_counters()
+        self.assertEqual(self.stored_counters(), [(0, 1), (1, 0)])
+
+
+class TestFlushReaders(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.database = ServerStorage(os.path.join(self.directory.name, 'test.db3'))
+        self.database.add_user('test1', b'hash1')
+        self.database.add_user('test2', b'hash2')
+
+    def tearDown(self) -> None:
+        self.database.session.remove()
+        self.database.engine.dispose()
+        self.directory.cleanup()
+
+    def test_read_during_flush(self):
+        """Reader of the other thread does not see the counters which are written but not committed yet"""
+        self.database.process_message('test1', 'test2')
+        history = []
+        reader = threading.Thread(target=lambda: history.extend(self.database.message_history()))
+        commit = self.database.session.commit
+
+        def read_and_commit():
+            reader.start()
+            reader.join(0.1)
+            self.assertTrue(reader.is_alive())
+            commit()
+
+        self.database.session.commit = read_and_commit
+        self.database.flush_counters()
+        self.database.session.commit = commit
+        reader.join(DB_TIMEOUT)
+        self.assertEqual({row[0]: row[2:] for row in history}, {'test1': (1, 0), 'test2': (0, 1)})
+
+
+class TestChangeLog(unittest.TestCase):
+    def setUp(self) -> None:
+        self.database = ServerStorage(':memory:')
+        self.database.add_user('test1', b'hash1')
+        self.database.add_user('test2', b'hash2')
+
+    def tearDown(self) -> None:
+        self.database.session.close()
+        self.database.engine.dispose()
+
+    def test_full(self):
+        changes = self.database.get_changes('test1', 0)
+        self.assertEqual(changes[VERSION], 2)
+        self.assertTrue(changes[FULL])
+        self.assertEqual(changes[USERS][ADDED], ['test1', 'test2'])
+
+    def test_delta(self):
+        self.database.add_contact('test1', 'test2')
+        self.database.add_user('test3', b'hash3')
+        self.database.add_user('test4', b'hash4')
+        self.database.remove_user('test4')
+        self.database.remove_user('test2')
+        changes = self.database.get_changes('test1', 2)
+        self.assertEqual(changes[VERSION], self.database.version)
+        self.assertFalse(changes[FULL])
+        self.assertEqual(changes[USERS], {ADDED: ['test3'], REMOVED: ['test4', 'test2']})
+        self.assertEqual(changes[CONTACTS], {ADDED: [], REMOVED: []})
+
+    def test_other_user_contacts(self):
+        """Contacts changes are sent only to the owner of the list"""
+        self.database.add_contact('test2', 'test1')
+        self.database.remove_contact('test2', 'test1')
+        self.assertEqual(self.database.get_changes('test1', 2)[CONTACTS], {ADDED: [], REMOVED: []})
+        self.assertEqual(self.database.get_changes('test2', 3)[CONTACTS], {ADDED: [], REMOVED: ['test1']})
+
+    def test_up_to_date(self):
+        changes = self.database.get_changes('test1', self.database.version)
+        self.assertFalse(changes[FULL])
+        self.assertEqual(changes[USERS], {ADDED: [], REMOVED: []})
+
+
+class TestUserSearch(unittest.TestCase):
+    def setUp(self) -> None:
+        self.database = ServerStorage(':memory:')
+        for name in ('anna', 'andrew', 'ann', 'bob', 'anton', 'boris'):
+            self.database.add_user(name, b'hash')
+
+    def tearDown(self) -> None:
+        self.database.session.close()
+        self.database.engine.dispose()
+
+    def test_prefix(self):
+        self.assertEqual(self.database.search_users('ann'), (['ann', 'anna'], None))
+        self.assertEqual(self.database.search_users('c'), ([], None))
+
+    def test_pages(self):
+        names, cursor = self.database.search_users('an', limit=2)
+        self.assertEqual((names, cursor), (['andrew', 'ann'], 'ann'))
+        names, cursor = self.database.search_users('an', cursor, limit=2)
+        self.assertEqual((names, cursor), (['anna', 'anton'], None))
+
+    def test_empty_prefix(self):
+        self.assertEqual(self.database.search_users('', limit=10)[0],
+                         ['andrew', 'ann', 'anna', 'anton', 'bob', 'boris'])
+
+
+class TestStorageProfile(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.database = ServerStorage(os.path.join(self.directory.name, 'test.db3'), profile='safe')
+        self.database.add_user('test1', b'hash1')
+
+    def tearDown(self) -> None:
+        self.database.session.remove()
+        self.database.engine.dispose()
+        self.directory.cleanup()
+
+    def test_pragmas(self):
+        pragmas = {pragma: self.database.session.execute(f'PRAGMA {pragma}').scalar()
+                   for pragma in ('journal_mode', 'synchronous')}
+        self.assertEqual(pragmas, {'journal_mode': 'wal', 'synchronous': 2})
+
+    def test_unknown_profile(self):
+        self.assertRaises(ValueError, ServerStorage, ':memory:', profile='unknown')
+
+    def test_session_per_thread(self):
+        sessions = []
+        thread = threading.Thread(target=lambda: sessions.append(self.database.session()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(sessions[0], self.database.session())
+
+    def test_read_while_writing(self):
+        """Other thread reads while the write transaction is not committed"""
+        self.database.session.add(ServerStorage.User('test2', b'hash2'))
+        self.database.session.flush()
+        users = []
+        thread = threading.Thread(target=lambda: users.extend(self.database.users_list()))
+        thread.start()
+        thread.join(DB_TIMEOUT)
+        self.assertEqual([user[0] for user in users], ['test1'])
+        self.database.session.commit()
+
+
+class TestMigrations(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'test.db3')
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def create_v1(self):
+        """Tables of the first schema with a duplicated contact"""
+        connection = sqlite3.connect(self.path)
+        connection.executescript('''
+            CREATE TABLE user (id INTEGER PRIMARY KEY, username VARCHAR UNIQUE, last_login DATETIME,
+                password_hash VARCHAR, pub_key TEXT);
+            CREATE TABLE login_history (id INTEGER PRIMARY KEY, user INTEGER, ip VARCHAR, port INTEGER,
+                last_login DATETIME);
+            CREATE TABLE active_user (id INTEGER PRIMARY KEY, user INTEGER, ip VARCHAR, port INTEGER,
+                last_login DATETIME);
+            CREATE TABLE users_contacts (id INTEGER PRIMARY KEY, user INTEGER, contact VARCHAR);
+            CREATE TABLE user_history (id INTEGER PRIMARY KEY, user INTEGER, sent INTEGER, accepted INTEGER);
+            INSERT INTO user (id, username, password_hash) VALUES (1, 'test1', 'hash1'), (2, 'test2', 'hash2');
+            INSERT INTO user_history (user, sent, accepted) VALUES (1, 0, 0), (2, 0, 0);
+            INSERT INTO users_contacts (user, contact) VALUES (1, '2'), (1, '2');
+        ''')
+        connection.close()
+
+    def test_upgrade_v1(self):
+        self.create_v1()
+        self.assertEqual(upgrade(self.path), 1)
+        self.assertEqual(upgrade(self.path), SCHEMA_VERSION)
+        connection = sqlite3.connect(self.path)
+        self.assertEqual(connection.execute('SELECT user, contact, typeof(contact) FROM users_contacts').fetchall(),
+                         [(1, 2, 'integer')])
+        self.assertRaises(sqlite3.IntegrityError, connection.execute,
+                          'INSERT INTO users_contacts (user, contact) VALUES (1, 2)')
+        connection.close()
+
+        database = ServerStorage(self.path)
+        self.assertEqual(database.get_contacts('test1'), ['test2'])
+        database.session.remove()
+        database.engine.dispose()
+
+    def test_new_database(self):
+        database = ServerStorage(self.path)
+        self.assertEqual(database.session.execute('PRAGMA user_version').scalar(), SCHEMA_VERSION)
+        database.session.remove()
+        database.engine.dispose()
+
+
+if __name__ == '__main__':
+    unittest.main()
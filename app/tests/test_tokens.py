@@ -0,0 +1,33 @@
+import unittest
+import os
+import sys
+import time
+from unittest import mock
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+from server.tokens import make_token, check_token
+from common.variables import RESUME_TOKEN_TTL
+
+
+class TestTokens(unittest.TestCase):
+    def test_valid(self):
+        token = make_token(b'hash1', 'test1')
+        self.assertTrue(check_token(b'hash1', 'test1', token))
+
+    def test_other_user_or_password(self):
+        token = make_token(b'hash1', 'test1')
+        self.assertFalse(check_token(b'hash1', 'test2', token))
+        self.assertFalse(check_token(b'hash2', 'test1', token))
+
+    def test_expired(self):
+        token = make_token(b'hash1', 'test1')
+        with mock.patch('time.time', return_value=time.time() + RESUME_TOKEN_TTL + 1):
+            self.assertFalse(check_token(b'hash1', 'test1', token))
+
+    def test_malformed(self):
+        for token in (None, '', 'abc', '1:2:3', 'x:abc', '99999999999:\u00e9'):
+            self.assertFalse(check_token(b'hash1', 'test1', token))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,310 @@
+import unittest
+import os
+import socket
+import sys
+import threading
+import time
+from unittest import mock
+
+from Crypto.PublicKey import RSA
+from PyQt5.QtCore import Qt
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+from common.variables import *
+from common.utils import encode_message, get_message, FrameDecoder
+from client.transport import ClientTransport
+from client.client_database import key_fingerprint
+from common.errors import ServerError
+
+# Enough for any step of the tests, seconds
+TEST_TIMEOUT = 2
+
+
+class PairTransport(ClientTransport):
+    """Transport connected to one end of a socketpair, the test plays the server at the other end"""
+
+    def connection_init(self, ip, port):
+        self.transport, self.server = socket.socketpair()
+        self.transport.settimeout(TEST_TIMEOUT)
+        self.server.settimeout(TEST_TIMEOUT)
+        self.decoder = FrameDecoder()
+        # Reply to the lists sync of __init__, it is the first request
+        self.server.sendall(encode_message({RESPONSE: 202, REQUEST_ID: 1, LIST_INFO: {VERSION: 0}}))
+
+    def reconnect(self):
+        return False
+
+
+class TransportTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.keys = RSA.generate(1024)
+
+    def setUp(self) -> None:
+        self.database = mock.Mock()
+        self.database.get_version.return_value = 0
+        self.database.get_contacts.return_value = []
+        self.transport = PairTransport('127.0.0.1', DEFAULT_SERVER_PORT, self.database, 'test1', 'password', self.keys)
+        self.server = self.transport.server
+        self.decoder = FrameDecoder()
+        # The sync request of __init__
+        self.assertEqual(self.read()[ACTION], SYNC)
+
+    def tearDown(self) -> None:
+        self.transport.transport_shutdown()
+        if self.transport.is_alive():
+            self.transport.join(TEST_TIMEOUT)
+        self.transport.transport.close()
+        self.server.close()
+
+    def read(self):
+        """Next request which came to the server"""
+        return get_message(self.server, self.decoder)
+
+    def reply(self, request, response=200, fields=None):
+        message = {RESPONSE: response, REQUEST_ID: request[REQUEST_ID]}
+        message.update(fields or {})
+        self.server.sendall(encode_message(message))
+
+    def contacts_request(self, contact):
+        return self.transport.request({ACTION: ADD_CONTACT, TIME: 1.1, USER: 'test1', ACCOUNT_NAME: contact})
+
+
+class TestRequests(TransportTestCase):
+    def test_request_ids(self):
+        futures = [self.contacts_request(contact) for contact in ('test2', 'test3')]
+        requests = [self.read(), self.read()]
+        self.assertEqual([request[REQUEST_ID] for request in requests], [future.request_id for future in futures])
+        self.assertEqual([future.request_id for future in futures], [2, 3])
+        self.assertEqual(set(self.transport.requests), {2, 3})
+
+    def test_out_of_order(self):
+        """Each reply resolves the Future of its own request, whatever the order"""
+        first, second = self.contacts_request('test2'), self.contacts_request('test3')
+        first_request, second_request = self.read(), self.read()
+        self.reply(second_request, 202, {LIST_INFO: 'second'})
+        self.reply(first_request, 202, {LIST_INFO: 'first'})
+        self.assertEqual(self.transport.wait(first)[LIST_INFO], 'first')
+        self.assertTrue(second.done())
+        self.assertEqual(self.transport.wait(second)[LIST_INFO], 'second')
+        self.assertEqual(self.transport.requests, {})
+
+    def test_timeout(self):
+        self.transport.start()
+        future = self.contacts_request('test2')
+        self.read()
+        with mock.patch('client.transport.REPLY_TIMEOUT', 0.1), self.assertRaises(TimeoutError):
+            self.transport.wait(future)
+        self.assertEqual(self.transport.requests, {})
+        # The late reply does not resolve the next request
+        self.reply({REQUEST_ID: future.request_id}, 400, {ERROR: 'Late'})
+        next_future = self.contacts_request('test3')
+        self.reply(self.read())
+        self.assertEqual(self.transport.wait(next_future), {RESPONSE: 200, REQUEST_ID: 3})
+
+    def test_pushes(self):
+        """Messages without the request id are processed as the server pushes"""
+        future = self.contacts_request('test2')
+        request = self.read()
+        self.server.sendall(encode_message({ACTION: PUBLIC_KEY_CHANGED, ACCOUNT_NAME: 'test2', PUBLIC_KEY: 'key2'}))
+        self.server.sendall(encode_message({RESPONSE: 205, VERSION: 0}))
+        self.reply(request)
+        changed, updated = [], []
+        self.transport.key_changed.connect(changed.append, Qt.DirectConnection)
+        self.transport.message_205.connect(lambda: updated.append(True), Qt.DirectConnection)
+        self.assertEqual(self.transport.wait(future)[RESPONSE], 200)
+        self.database.save_keys.assert_called_once_with({'test2': 'key2'})
+        self.assertEqual((changed, updated), (['test2'], [True]))
+
+
+class TestConnection(TransportTestCase):
+    def signal_event(self, signal):
+        """Event set when the signal is emitted, in the thread which emits it"""
+        event = threading.Event()
+        signal.connect(lambda *args: event.set(), Qt.DirectConnection)
+        return event
+
+    def test_writer_queue(self):
+        """Requests are queued to the writer thread, the sender does not wait while the server does not read"""
+        text = 'x' * 100000
+        futures = [self.contacts_request(text) for _ in range(20)]
+        self.assertGreater(self.transport.outgoing.qsize(), 0)
+        requests = [self.read() for _ in futures]
+        self.assertEqual([request[REQUEST_ID] for request in requests], [future.request_id for future in futures])
+        self.assertEqual(requests[-1][ACCOUNT_NAME], text)
+
+    def test_receiver(self):
+        """Receiver thread processes the pushes and the replies as they come"""
+        changed = self.signal_event(self.transport.key_changed)
+        self.transport.start()
+        self.server.sendall(encode_message({ACTION: PUBLIC_KEY_CHANGED, ACCOUNT_NAME: 'test2', PUBLIC_KEY: 'key2'}))
+        self.assertTrue(changed.wait(TEST_TIMEOUT))
+        future = self.contacts_request('test2')
+        self.reply(self.read())
+        self.assertEqual(future.result(TEST_TIMEOUT)[RESPONSE], 200)
+
+    def test_connection_lost(self):
+        """Waiting requests fail at once when the server closes the connection"""
+        lost = self.signal_event(self.transport.connection_lost)
+        self.transport.start()
+        future = self.contacts_request('test2')
+        self.read()
+        self.server.close()
+        self.assertIsInstance(future.exception(TEST_TIMEOUT), ConnectionResetError)
+        self.assertTrue(lost.wait(TEST_TIMEOUT))
+        self.transport.join(TEST_TIMEOUT)
+        self.assertFalse(self.transport.running)
+        self.assertEqual(self.transport.requests, {})
+        with self.assertRaises(ConnectionResetError):
+            self.contacts_request('test3')
+
+    def test_writer_fails(self):
+        """Send error of the writer fails the waiting requests too"""
+        future = self.contacts_request('test2')
+        self.read()
+        self.server.close()
+        self.contacts_request('test3')
+        self.assertIsInstance(future.exception(TEST_TIMEOUT), ConnectionResetError)
+        self.assertFalse(self.transport.connected)
+        self.transport.writer.join(TEST_TIMEOUT)
+        self.assertFalse(self.transport.writer.is_alive())
+
+    def test_lists_synced(self):
+        """After 205 the receiver requests the changes and goes on reading while the reply is awaited"""
+        changed = self.signal_event(self.transport.key_changed)
+        updated = self.signal_event(self.transport.message_205)
+        self.transport.start()
+        self.server.sendall(encode_message({RESPONSE: 205, VERSION: 5}))
+        request = self.read()
+        self.assertEqual((request[ACTION], request[SINCE]), (SYNC, 0))
+        self.server.sendall(encode_message({ACTION: PUBLIC_KEY_CHANGED, ACCOUNT_NAME: 'test2', PUBLIC_KEY: 'key2'}))
+        self.assertTrue(changed.wait(TEST_TIMEOUT))
+        self.assertFalse(updated.is_set())
+        self.reply(request, 202, {LIST_INFO: {VERSION: 5}})
+        self.assertTrue(updated.wait(TEST_TIMEOUT))
+        self.database.apply_changes.assert_called_with({VERSION: 5})
+
+    def test_reconnect_resumes(self):
+        """After the connection is lost the session is resumed by the token, the password is not sent"""
+        servers = []
+
+        def connect(ip, port):
+            self.transport.transport, server = socket.socketpair()
+            self.transport.decoder = FrameDecoder()
+            server.settimeout(TEST_TIMEOUT)
+            server.sendall(encode_message({RESPONSE: 200, TOKEN: 'token2'}))
+            servers.append(server)
+
+        self.transport.token = 'token1'
+        self.transport.connection_failed(OSError('Lost'), self.transport.transport)
+        self.addCleanup(self.server.close)
+        with mock.patch.object(self.transport, 'connect', connect), \
+                mock.patch('client.transport.backoff_delay', return_value=0):
+            self.assertTrue(ClientTransport.reconnect(self.transport))
+        self.server, self.decoder = servers[0], FrameDecoder()
+        request = self.read()
+        self.assertEqual((request[ACTION], request[USER][ACCOUNT_NAME], request[TOKEN]), (RESUME, 'test1', 'token1'))
+        self.assertEqual(self.transport.token, 'token2')
+        self.assertTrue(self.transport.connected)
+        # Changes missed while offline are requested on the new connection
+        self.assertEqual(self.read()[ACTION], SYNC)
+        self.assertEqual(len(servers), 1)
+
+
+class TestSendMessage(TransportTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        pem = self.keys.publickey().export_key().decode('ascii')
+        self.database.get_key.return_value = (key_fingerprint(pem), pem)
+        self.results = []
+        self.done = threading.Event()
+        for signal in (self.transport.message_sent, self.transport.send_failed):
+            signal.connect(self.result, Qt.DirectConnection)
+        self.transport.start()
+
+    def result(self, to, value):
+        self.results.append((to, value))
+        self.done.set()
+
+    def test_sent(self):
+        """send_message does not wait for the server, message_sent comes with the reply"""
+        self.transport.send_message('test2', 'Hi')
+        request = self.read()
+        self.assertEqual(request[DESTINATION], 'test2')
+        self.assertIn(SESSION_KEY, request)
+        self.assertNotIn('Hi', request[MESSAGE_TEXT])
+        self.assertFalse(self.done.is_set())
+        self.reply(request)
+        self.assertTrue(self.done.wait(TEST_TIMEOUT))
+        self.assertEqual(self.results, [('test2', 'Hi')])
+
+    def test_refused(self):
+        self.transport.send_message('test2', 'Hi')
+        self.reply(self.read(), 400, {ERROR: 'User is offline'})
+        self.assertTrue(self.done.wait(TEST_TIMEOUT))
+        (to, err), = self.results
+        self.assertIsInstance(err, ServerError)
+        self.assertEqual((to, err.text), ('test2', 'User is offline'))
+
+    def test_no_key(self):
+        self.database.get_key.return_value = None
+        self.transport.send_message('test2', 'Hi')
+        request = self.read()
+        self.assertEqual(request[ACTION], PUBLIC_KEY_REQUEST)
+        self.reply(request, 202, {LIST_INFO: {}})
+        self.assertTrue(self.done.wait(TEST_TIMEOUT))
+        self.assertIsInstance(self.results[0][1], ServerError)
+
+    def test_timeout(self):
+        with mock.patch('client.transport.REPLY_TIMEOUT', 0.1):
+            self.transport.send_message('test2', 'Hi')
+            self.read()
+            self.assertTrue(self.done.wait(TEST_TIMEOUT))
+        self.assertIsInstance(self.results[0][1], TimeoutError)
+        self.assertEqual(self.transport.requests, {})
+
+    def test_plaintext_marked(self):
+        """Message which came not encrypted is saved with the mark"""
+        self.transport.receive({ACTION: MESSAGE, SENDER: 'test2', DESTINATION: 'test1', TIME: 1.1,
+                                MESSAGE_TEXT: 'Hi'})
+        self.database.save_message.assert_called_once_with('test2', 'in', PLAINTEXT_MARK + 'Hi')
+
+
+class TestSearchUsers(TransportTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.results = []
+        self.done = threading.Event()
+        self.transport.users_found.connect(self.found, Qt.DirectConnection)
+        self.transport.start()
+
+    def found(self, request_id, users, cursor):
+        self.results.append((request_id, users, cursor))
+        self.done.set()
+
+    def test_found(self):
+        """search_users does not wait for the server, users_found comes with the reply"""
+        request_id = self.transport.search_users('te', 'test1')
+        request = self.read()
+        self.assertEqual((request[ACTION], request[PREFIX], request[CURSOR]), (USERS_SEARCH, 'te', 'test1'))
+        self.assertFalse(self.done.is_set())
+        self.reply(request, 202, {LIST_INFO: ['test2', 'test3'], CURSOR: 'test3'})
+        self.assertTrue(self.done.wait(TEST_TIMEOUT))
+        self.assertEqual(self.results, [(request_id, ['test2', 'test3'], 'test3')])
+
+    def test_error(self):
+        """Error reply and the timeout are logged, users_found is not emitted"""
+        with mock.patch('client.transport.REPLY_TIMEOUT', 0.1), self.assertLogs('client_log', 'ERROR') as logs:
+            self.transport.search_users('te')
+            self.reply(self.read(), 400, {ERROR: 'Bad request'})
+            self.transport.search_users('te')
+            self.read()
+            deadline = time.monotonic() + TEST_TIMEOUT
+            while len(logs.records) < 2 and time.monotonic() < deadline:
+                time.sleep(0.01)
+        self.assertEqual([record.getMessage() for record in logs.records], ['Cannot search users'] * 2)
+        self.assertEqual((self.results, self.transport.requests), ([], {}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,7 +6,13 @@ import sys
 sys.path.append(os.path.join(os.getcwd(), '..'))
 from common.variables import TIME, ACTION, PRESENCE, RESPONSE, USER, ACCOUNT_NAME,\
     ERROR, ENCODING, MAX_PACKAGE_LENGTH
-from common.utils import send_json_message, get_message
+from common.utils import send_json_message, get_message, encode_message, FrameDecoder
+
+
+def make_frame(test_dict):
+    """Frame as it goes on the wire: 4 bytes big endian payload length + json payload"""
+    payload = json.dumps(test_dict).encode(ENCODING)
+    return len(payload).to_bytes(4, 'big') + payload
 
 
 class TestSocket:
@@ -18,14 +24,13 @@ class TestSocket:
         self.encoded_message = None
         self.received_message = None
 
-    def send(self, message_to_send):
+    def sendall(self, message_to_send):
         """
-        Mock "send" function of socket module
+        Mock "sendall" function of socket module
         :param message_to_send:
         :return:
         """
-        json_test_message = json.dumps(self.test_dict)
-        self.encoded_message = json_test_message.encode(ENCODING)
+        self.encoded_message = make_frame(self.test_dict)
         self.received_message = message_to_send
 
     def recv(self, max_len):
@@ -34,8 +39,7 @@ class TestSocket:
         :param max_len:
         :return:
         """
-        json_test_message = json.dumps(self.test_dict)
-        return json_test_message.encode(ENCODING)
+        return make_frame(self.test_dict)
 
 
 class TestUtils(unittest.TestCase):
@@ -70,3 +74,39 @@ class TestUtils(unittest.TestCase):
         test_socket = TestSocket(self.test_dict_send)
         send_json_message(test_socket, self.test_dict_send)
         self.assertRaises(TypeError, send_json_message, test_socket, "wrong_dictionary")
+
+
+class TestFrameDecoder(unittest.TestCase):
+    def setUp(self) -> None:
+        self.first = {RESPONSE: 200}
+        self.second = {ACTION: PRESENCE, TIME: 5, USER: {ACCOUNT_NAME: 'Test'}}
+
+    def test_split_frame(self):
+        decoder = FrameDecoder()
+        frame = encode_message(self.second)
+        decoder.feed(frame[:3])
+        self.assertIsNone(decoder.next_message())
+        decoder.feed(frame[3:10])
+        self.assertIsNone(decoder.next_message())
+        decoder.feed(frame[10:])
+        self.assertEqual(decoder.next_message(), self.second)
+        self.assertEqual(decoder.buffer, bytearray())
+
+    def test_joined_frames(self):
+        decoder = FrameDecoder()
+        data = encode_message(self.first) + encode_message(self.second)
+        decoder.feed(data + data[:5])
+        self.assertEqual(list(decoder.messages()), [self.first, self.second])
+        self.assertEqual(decoder.buffer, data[:5])
+
+    def test_frame_too_large(self):
+        decoder = FrameDecoder(max_frame_size=10)
+        decoder.feed(encode_message(self.second))
+        self.assertRaises(ValueError, decoder.next_message)
+
+    def test_big_message(self):
+        big_dict = {RESPONSE: 202, 'data_list': [f'user_{i}' for i in range(1000)]}
+        test_socket = TestSocket(big_dict)
+        # Bigger than the old single recv(1024)
+        self.assertGreater(len(make_frame(big_dict)), 1024)
+        self.assertEqual(get_message(test_socket), big_dict)